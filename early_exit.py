@@ -0,0 +1,155 @@
+""" Confidence-based early exit for models.Classifier
+
+    python early_exit.py --model_file results/results/save/model_steps_5000.pt --task imdb \
+                         --exit_layers 4,8 --exit_file results/model_exits.pt
+
+    Exit heads (pooler + classifier) are added after the blocks in --exit_layers and trained on the
+    supervised split : after the fact (backbone of the UDA checkpoint frozen, default) or jointly
+    (--joint, backbone and every exit fine-tuned together on the sum of the exit losses).
+    At inference every example leaves the batch at the first exit whose max probability reaches the
+    threshold, the speed / accuracy curve over --thresholds is printed (and saved to --curve_file).
+"""
+import json
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+
+import models
+from utils import optim, configuration
+
+parser = argparse.ArgumentParser(description='Confidence-based early exit for Classifier')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--model_file', default='', type=str)           # Classifier checkpoint (Trainer.save)
+parser.add_argument('--exit_file', default='', type=str)            # EarlyExitClassifier, saved after training
+parser.add_argument('--exit_layers', default='4,8', type=str)
+parser.add_argument('--num_labels', default=2, type=int)
+parser.add_argument('--task', default='imdb', type=str)
+parser.add_argument('--train_cap', default=-1, type=int)
+parser.add_argument('--dev_cap', default=-1, type=int)
+parser.add_argument('--data_seed', default=42, type=int)
+parser.add_argument('--joint', action='store_true')                 # also fine-tune the backbone
+parser.add_argument('--epochs', default=1, type=int)                # 0 : load --exit_file and only evaluate
+parser.add_argument('--lr', default=1e-4, type=float)               # 2e-5 is the usual value with --joint
+parser.add_argument('--warmup', default=0.1, type=float)
+parser.add_argument('--train_batch_size', default=16, type=int)
+parser.add_argument('--eval_batch_size', default=32, type=int)
+parser.add_argument('--thresholds', default='0.6,0.7,0.8,0.9,0.95,0.99', type=str)
+parser.add_argument('--curve_file', default='', type=str)
+parser.add_argument('--threads', default=0, type=int)
+
+
+def build_model(cfg, device):
+    "EarlyExitClassifier from --exit_file, or from the Classifier checkpoint with the exits copied from its head"
+    model = models.EarlyExitClassifier(
+        configuration.model.from_json(cfg.model_cfg), cfg.num_labels,
+        [int(l) for l in cfg.exit_layers.split(',') if l]
+    )
+    if cfg.epochs == 0:
+        print('Loading the exits from', cfg.exit_file)
+        model.load_state_dict(torch.load(cfg.exit_file, map_location='cpu'))
+    elif cfg.model_file:
+        print('Loading the model from', cfg.model_file)
+        missing, unexpected = model.load_state_dict(torch.load(cfg.model_file, map_location='cpu'), strict=False)
+        assert not unexpected and all(k.startswith('exits.') for k in missing), (missing, unexpected)
+        model.init_exits_from_head()
+    return model.to(device)
+
+
+def train_exits(model, dataset, cfg, device):
+    "sum of the cross entropies of every exit (final head included) on the supervised split"
+    for name, p in model.named_parameters():
+        p.requires_grad = cfg.joint or name.startswith('exits.')
+    loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=cfg.train_batch_size)
+    optim_cfg = argparse.Namespace(lr=cfg.lr, warmup=cfg.warmup, total_steps=cfg.epochs * len(loader))
+    optimizer = optim.optim4GPU(optim_cfg, model)
+
+    model.train()
+    for epoch in range(cfg.epochs):
+        loss_sum = 0.
+        for batch in loader:
+            input_ids, segment_ids, input_mask, label_ids = [t.to(device) for t in batch[:4]]
+            optimizer.zero_grad()
+            logits = model.exit_logits(input_ids, segment_ids, input_mask)
+            if not cfg.joint:
+                logits = logits[:-1]    # the final head is frozen with the backbone
+            loss = sum(F.cross_entropy(l, label_ids) for l in logits)
+            loss.backward()
+            optimizer.step()
+            loss_sum += loss.item()
+        print('Epoch %d/%d : exit loss %.4f' % (epoch + 1, cfg.epochs, loss_sum / len(loader)))
+    for p in model.parameters():
+        p.requires_grad = True
+    return model.eval()
+
+
+def evaluate(model, dataset, batch_size, device, threshold=None):
+    """ accuracy, mean number of blocks run per example and seconds spent in the forward
+        threshold None : the plain Classifier forward (every example runs every block) """
+    loader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    n_layers = len(model.transformer.blocks)
+    correct, total, blocks, elapsed = 0, 0, 0, 0.
+    with torch.no_grad():
+        for batch in loader:
+            input_ids, segment_ids, input_mask, label_ids = [t.to(device) for t in batch[:4]]
+            start = time.time()
+            if threshold is None:
+                logits = model(input_ids, segment_ids, input_mask)
+                exits = torch.full_like(label_ids, n_layers)
+            else:
+                logits, exits = model.early_exit(input_ids, segment_ids, input_mask, threshold)
+            pred = logits.argmax(-1).cpu()  # synchronizes before the clock stops
+            elapsed += time.time() - start
+            correct += (pred == label_ids.cpu()).sum().item()
+            blocks += exits.sum().item()
+            total += label_ids.size(0)
+    return correct / total, blocks / total, elapsed
+
+
+def datasets(cfg):
+    from dataset import DataSet
+    data_cfg = argparse.Namespace(
+        task=cfg.task, data_seed=cfg.data_seed, train_cap=cfg.train_cap, dev_cap=cfg.dev_cap,
+        unsup_cap=-1, uda_mode=False
+    )
+    train_dataset, val_dataset, _ = DataSet(data_cfg).get_dataset()
+    return train_dataset, val_dataset
+
+
+def main(cfg):
+    if cfg.threads > 0:
+        torch.set_num_threads(cfg.threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    train_dataset, val_dataset = datasets(cfg)
+
+    model = build_model(cfg, device)
+    if cfg.epochs > 0:
+        model = train_exits(model, train_dataset, cfg, device)
+        if cfg.exit_file:
+            torch.save(model.state_dict(), cfg.exit_file)
+            print('Saved the exits to', cfg.exit_file)
+    model.eval()
+
+    n_layers = len(model.transformer.blocks)
+    acc, _, base_t = evaluate(model, val_dataset, cfg.eval_batch_size, device)
+    curve = [{'threshold': None, 'acc': acc, 'blocks': float(n_layers), 'time': base_t, 'speedup': 1.}]
+    for threshold in [float(t) for t in cfg.thresholds.split(',') if t]:
+        acc, blocks, t = evaluate(model, val_dataset, cfg.eval_batch_size, device, threshold)
+        curve.append({'threshold': threshold, 'acc': acc, 'blocks': blocks, 'time': t, 'speedup': base_t / t})
+
+    print('exits after blocks %s of %d' % (model.exit_layers, n_layers))
+    print('%-9s %8s %8s %9s %8s' % ('threshold', 'acc', 'blocks', 'time(s)', 'speedup'))
+    for r in curve:
+        print('%-9s %8.4f %8.2f %9.2f %7.2fx' % (
+            'full' if r['threshold'] is None else '%.3f' % r['threshold'], r['acc'], r['blocks'], r['time'], r['speedup']))
+    if cfg.curve_file:
+        with open(cfg.curve_file, 'w') as f:
+            json.dump({'exit_layers': model.exit_layers, 'n_layers': n_layers, 'curve': curve}, f, indent=2)
+        print('Saved the curve to', cfg.curve_file)
+    return curve
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
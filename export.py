@@ -0,0 +1,140 @@
+""" Inference-only export of models.Classifier (TorchScript / ONNX) and runtime benchmark
+
+    python export.py --model_file results/results/save/model_steps_5000.pt \
+                     --torchscript_file classifier.pt --onnx_file classifier.onnx
+"""
+import time
+import inspect
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from inference import load_classifier
+
+parser = argparse.ArgumentParser(description='Export Classifier for inference')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--model_file', default='', type=str)
+parser.add_argument('--num_labels', default=2, type=int)
+parser.add_argument('--torchscript_file', default='', type=str)
+parser.add_argument('--onnx_file', default='', type=str)
+parser.add_argument('--opset', default=14, type=int)
+parser.add_argument('--batch_sizes', default='1,8,32', type=str)
+parser.add_argument('--seq_lens', default='32,128,256', type=str)
+parser.add_argument('--runs', default=10, type=int)
+parser.add_argument('--threads', default=0, type=int)
+
+INPUT_NAMES = ['input_ids', 'segment_ids', 'input_mask']
+
+
+class InferenceClassifier(nn.Module):
+    """ Classifier restricted to (input_ids, segment_ids, input_mask) -> logits,
+        the training-only branches (mixup, clone_ids, output_h/input_h) never run """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(self, input_ids, segment_ids, input_mask):
+        return self.model(input_ids, segment_ids, input_mask)
+
+
+def example_inputs(batch_size, seq_len, vocab_size=30522):
+    input_ids = torch.randint(1, vocab_size, (batch_size, seq_len))
+    input_mask = torch.ones_like(input_ids)
+    input_mask[batch_size // 2:, seq_len // 2:] = 0      # padded rows
+    return input_ids * input_mask, torch.zeros_like(input_ids), input_mask
+
+
+def export_torchscript(model, file, example):
+    "trace the inference graph; batch and sequence sizes stay symbolic"
+    with torch.no_grad():
+        traced = torch.jit.trace(InferenceClassifier(model), example, check_trace=False)
+    traced.save(file)
+    return torch.jit.load(file)
+
+
+def export_onnx(model, file, example, opset=14):
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in INPUT_NAMES}
+    dynamic_axes['logits'] = {0: 'batch'}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False    # TorchScript based exporter (dynamic_axes)
+    with torch.no_grad():
+        torch.onnx.export(
+            InferenceClassifier(model), example, file,
+            input_names=INPUT_NAMES, output_names=['logits'],
+            dynamic_axes=dynamic_axes, opset_version=opset, **kwargs
+        )
+
+
+def onnx_runner(file):
+    "callable running the ONNX graph with onnxruntime (None if it is not installed)"
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime is not installed, skipping the ONNX benchmark')
+        return None
+    session = onnxruntime.InferenceSession(file, providers=['CPUExecutionProvider'])
+
+    def run(input_ids, segment_ids, input_mask):
+        feed = {n: t.numpy() for n, t in zip(INPUT_NAMES, (input_ids, segment_ids, input_mask))}
+        return torch.from_numpy(session.run(None, feed)[0])
+    return run
+
+
+def benchmark(runners, batch_sizes, seq_lens, runs=10, vocab_size=30522):
+    """ latency (ms / batch), throughput (examples / sec) and max |logits - eager logits|
+        runners : {name: callable}, the 'eager' entry is the reference """
+    results = []
+    for batch_size in batch_sizes:
+        for seq_len in seq_lens:
+            example = example_inputs(batch_size, seq_len, vocab_size)
+            with torch.no_grad():
+                reference = runners['eager'](*example)
+                for name, run in runners.items():
+                    diff = (run(*example) - reference).abs().max().item()
+                    times = []
+                    for _ in range(runs):
+                        start = time.time()
+                        run(*example)
+                        times.append(time.time() - start)
+                    latency = float(np.median(times))
+                    results.append({
+                        'runtime': name, 'batch_size': batch_size, 'seq_len': seq_len,
+                        'latency_ms': latency * 1000, 'throughput': batch_size / latency,
+                        'max_abs_diff': diff
+                    })
+    return results
+
+
+def main(cfg):
+    if cfg.threads > 0:
+        torch.set_num_threads(cfg.threads)
+
+    model = load_classifier('custom', cfg.model_cfg, cfg.model_file, cfg.num_labels)
+    vocab_size = model.transformer.embed.tok_embed.num_embeddings
+    example = example_inputs(2, 16, vocab_size)
+
+    runners = {'eager': InferenceClassifier(model)}
+    if cfg.torchscript_file:
+        runners['torchscript'] = export_torchscript(model, cfg.torchscript_file, example)
+        print('Saved TorchScript graph to', cfg.torchscript_file)
+    if cfg.onnx_file:
+        export_onnx(model, cfg.onnx_file, example, cfg.opset)
+        print('Saved ONNX graph to', cfg.onnx_file)
+        run = onnx_runner(cfg.onnx_file)
+        if run:
+            runners['onnx'] = run
+
+    batch_sizes = [int(b) for b in cfg.batch_sizes.split(',')]
+    seq_lens = [int(s) for s in cfg.seq_lens.split(',')]
+    print('%-12s %6s %6s %12s %14s %12s' % ('runtime', 'batch', 'seq', 'latency(ms)', 'throughput/s', 'max|diff|'))
+    for r in benchmark(runners, batch_sizes, seq_lens, cfg.runs, vocab_size):
+        print('%-12s %6d %6d %12.2f %14.1f %12.2e' % (
+            r['runtime'], r['batch_size'], r['seq_len'], r['latency_ms'], r['throughput'], r['max_abs_diff']))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,217 @@
+""" Inference helpers for trained classifiers (model loading, dynamic batching, caching) """
+import time
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import models
+from utils import configuration, tokenization
+
+
+def load_classifier(model, model_cfg, model_file, num_labels, device='cpu'):
+    """ build models.Classifier (model='custom') or BertForSequenceClassificationCustom (model='bert')
+        and load a checkpoint saved by Trainer.save """
+    if model == 'custom':
+        classifier = models.Classifier(configuration.model.from_json(model_cfg), num_labels)
+    elif model == 'bert':
+        from models_bert import BertForSequenceClassificationCustom
+        classifier = BertForSequenceClassificationCustom.from_pretrained(
+            'bert-base-uncased',
+            num_labels=num_labels,
+            output_attentions=False,
+            output_hidden_states=False,
+        )
+    else:
+        raise ValueError('model have to be custom or bert : %s' % model)
+
+    if model_file:
+        print('Loading the model from', model_file)
+        state_dict = torch.load(model_file, map_location=device)
+        if model == 'custom':
+            models.fit_to_state_dict(classifier, state_dict)     # pruned checkpoint (prune.py)
+        classifier.load_state_dict(state_dict)
+    return classifier.to(device).eval()
+
+
+def classifier_logits(model, model_type, input_ids, segment_ids, input_mask):
+    "plain inference forward for both model types"
+    if model_type == 'bert':
+        return model(input_ids=input_ids, attention_mask=input_mask)
+    return model(input_ids, segment_ids, input_mask)
+
+
+class TextEncoder(object):
+    """ FullTokenizer based encoder : text -> [CLS] tokens [SEP] ids """
+    def __init__(self, vocab, max_len=128, do_lower_case=True, vocab_map=None):
+        self.tokenizer = tokenization.FullTokenizer(vocab_file=vocab, do_lower_case=do_lower_case, vocab_map=vocab_map)
+        self.max_len = max_len
+
+    def __call__(self, text):
+        tokens = self.tokenizer.tokenize(self.tokenizer.convert_to_unicode(text))
+        # keep the tail of long sentences like dataset.DataSet.preprocess
+        if len(tokens) > self.max_len - 2:
+            tokens = tokens[-(self.max_len - 2):]
+        return self.tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+
+
+class LRUCache(object):
+    """ thread-safe LRU cache keyed by token ids """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.capacity:
+                self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class LatencyStats(object):
+    """ request latency percentiles and throughput counters """
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.batched_examples = 0
+
+    def record(self, latency, cache_hit=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.cache_hits += int(cache_hit)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_examples += size
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            elapsed = time.time() - self.start
+            return {
+                'requests': self.requests,
+                'cache_hits': self.cache_hits,
+                'batches': self.batches,
+                'avg_batch_size': self.batched_examples / max(self.batches, 1),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'throughput': self.requests / max(elapsed, 1e-9),  # requests / sec
+            }
+
+
+class _Request(object):
+    def __init__(self, ids):
+        self.ids = ids
+        self.result = None
+        self.done = threading.Event()
+
+
+def length_groups(requests):
+    "requests split into power-of-two length buckets (1, 2, 3-4, 5-8, ...), each sorted by length"
+    groups = {}
+    for r in sorted(requests, key=lambda r: len(r.ids)):
+        groups.setdefault((len(r.ids) - 1).bit_length(), []).append(r)
+    return list(groups.values())
+
+
+class DynamicBatcher(object):
+    """ Collects concurrent requests for at most max_wait_ms (or max_batch_size requests),
+        groups them into power-of-two length buckets and runs one padded forward per bucket """
+    def __init__(self, model, model_type, device='cpu', max_batch_size=32, max_wait_ms=5, cache_size=10000):
+        self.model = model
+        self.model_type = model_type
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.cache = LRUCache(cache_size)
+        self.stats = LatencyStats()
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self._loop, daemon=True)
+        self.worker.start()
+
+    def predict(self, ids):
+        "class probabilities of one encoded sentence (blocks until its batch ran)"
+        start = time.time()
+        key = tuple(ids)
+        probs = self.cache.get(key)
+        if probs is not None:
+            self.stats.record(time.time() - start, cache_hit=True)
+            return probs
+
+        request = _Request(ids)
+        with self.cond:
+            self.queue.append(request)
+            self.cond.notify()
+        request.done.wait()
+        if isinstance(request.result, Exception):
+            raise request.result
+
+        self.cache.put(key, request.result)
+        self.stats.record(time.time() - start)
+        return request.result
+
+    def _collect(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            deadline = time.time() + self.max_wait
+            while len(self.queue) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            n = min(len(self.queue), self.max_batch_size)
+            return [self.queue.popleft() for _ in range(n)]
+
+    def _loop(self):
+        while True:
+            # one forward per length bucket so little compute goes to padding
+            for requests in length_groups(self._collect()):
+                try:
+                    self._run(requests)
+                except Exception as e:
+                    for r in requests:
+                        r.result = e
+                for r in requests:
+                    r.done.set()
+
+    def _run(self, requests):
+        max_len = len(requests[-1].ids)
+        input_ids = torch.zeros(len(requests), max_len, dtype=torch.long)
+        input_mask = torch.zeros(len(requests), max_len, dtype=torch.long)
+        for i, r in enumerate(requests):
+            input_ids[i, :len(r.ids)] = torch.tensor(r.ids, dtype=torch.long)
+            input_mask[i, :len(r.ids)] = 1
+        input_ids, input_mask = input_ids.to(self.device), input_mask.to(self.device)
+        segment_ids = torch.zeros_like(input_ids)
+
+        with torch.no_grad():
+            logits = classifier_logits(self.model, self.model_type, input_ids, segment_ids, input_mask)
+            probs = F.softmax(logits, dim=-1).cpu().tolist()
+        for r, p in zip(requests, probs):
+            r.result = p
+        self.stats.record_batch(len(requests))
@@ -29,6 +29,7 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 
 from utils import tokenization
+from utils.vocab import VocabMap
 from utils.utils import truncate_tokens_pair
 
 
@@ -210,7 +211,8 @@ class load_data:
         self.TaskDataset = dataset_class(cfg.task)
         self.pipeline = None
         if cfg.need_prepro:
-            tokenizer = tokenization.FullTokenizer(vocab_file=cfg.vocab, do_lower_case=cfg.do_lower_case)
+            vocab_map = VocabMap.load(cfg.vocab_map) if getattr(cfg, 'vocab_map', '') else None
+            tokenizer = tokenization.FullTokenizer(vocab_file=cfg.vocab, do_lower_case=cfg.do_lower_case, vocab_map=vocab_map)
             self.pipeline = [Tokenizing(tokenizer.convert_to_unicode, tokenizer.tokenize),
                         AddSpecialTokensWithTruncation(cfg.max_seq_length),
                         TokenIndexing(tokenizer.convert_tokens_to_ids, self.TaskDataset.labels, cfg.max_seq_length)]
@@ -3,9 +3,43 @@ def get_loss(model, sup_batch, unsup_batch, global_step): #original get_loss
 
     # batch
     input_ids, segment_ids, input_mask, label_ids = sup_batch
+    sup_size = label_ids.shape[0]
+    unsup_stats = {}
     if unsup_batch:
         ori_input_ids, ori_segment_ids, ori_input_mask, \
-        aug_input_ids, aug_segment_ids, aug_input_mask = unsup_batch
+        aug_input_ids, aug_segment_ids, aug_input_mask = unsup_batch[:6]
+
+        # ori (computed first so that the confidence mask is known before the aug forward)
+        def ori_forward(rows):
+            with torch.no_grad():
+                ori_logits = model(ori_input_ids[rows], ori_segment_ids[rows], ori_input_mask[rows])
+                return F.softmax(ori_logits, dim=-1)    # KLdiv target
+
+        with torch.no_grad():
+            if teacher_cache is not None:   # example indices are the last unsup column
+                ori_prob = teacher_cache.get(ori_forward, unsup_batch[6], global_step)
+            else:
+                ori_prob = ori_forward(slice(None))
+            # temp control
+            #ori_prob = ori_prob**(1/cfg.uda_softmax_temp)
+
+            # confidence-based masking
+            if cfg.uda_confidence_thresh != -1:
+                unsup_loss_mask = torch.max(ori_prob, dim=-1)[0] > cfg.uda_confidence_thresh
+                unsup_loss_mask = unsup_loss_mask.type(torch.float32)
+            else:
+                unsup_loss_mask = torch.ones(len(ori_prob), dtype=torch.float32)
+            unsup_loss_mask = unsup_loss_mask.to(_get_device())
+
+        if cfg.confidence_skip:
+            # masked rows contribute exactly zero loss : only the surviving aug rows run forward/backward.
+            # The unsup loader over-draws (unsup_overdraw) so that a full batch usually survives
+            keep = unsup_loss_mask.nonzero().view(-1)
+            unsup_stats = {'masked_frac': 1. - len(keep) / len(unsup_loss_mask)}
+            keep = keep[:cfg.train_batch_size]
+            aug_input_ids, aug_segment_ids, aug_input_mask = aug_input_ids[keep], aug_segment_ids[keep], aug_input_mask[keep]
+            ori_prob, unsup_loss_mask = ori_prob[keep], unsup_loss_mask[keep]
+            unsup_stats['n_unsup_kept'] = len(keep)
 
         input_ids = torch.cat((input_ids, aug_input_ids), dim=0)
         segment_ids = torch.cat((segment_ids, aug_segment_ids), dim=0)
@@ -20,8 +54,19 @@ def get_loss(model, sup_batch, unsup_batch, global_step): #original get_loss
     )
     logits = model(input_h=hidden)
 
+    if cfg.fused_uda_loss:    # same objective in one pass (utils.uda_objective)
+        tsa_thresh = None
+        if cfg.tsa and cfg.tsa != "none":
+            tsa_thresh = get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./logits.shape[-1], end=1)
+        final_loss, sup_loss, unsup_loss, _, _ = uda_objective(
+            logits, label_ids, ori_prob if unsup_batch else None, tsa_thresh,
+            cfg.uda_confidence_thresh, cfg.uda_softmax_temp, cfg.uda_coeff
+        )
+        if unsup_batch:
+            return final_loss, sup_loss, unsup_loss, cfg.uda_coeff*unsup_loss, unsup_stats
+        return sup_loss, None, None
+
     # sup loss
-    sup_size = label_ids.shape[0]            
     sup_loss = sup_criterion(logits[:sup_size], label_ids)  # shape : train_batch_size
     if cfg.tsa and cfg.tsa != "none":
         tsa_thresh = get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./logits.shape[-1], end=1)
@@ -34,21 +79,6 @@ def get_loss(model, sup_batch, unsup_batch, global_step): #original get_loss
 
     # unsup loss
     if unsup_batch:
-        # ori
-        with torch.no_grad():
-            ori_logits = model(ori_input_ids, ori_segment_ids, ori_input_mask)
-            ori_prob   = F.softmax(ori_logits, dim=-1)    # KLdiv target
-            # temp control
-            #ori_prob = ori_prob**(1/cfg.uda_softmax_temp)
-
-            # confidence-based masking
-            if cfg.uda_confidence_thresh != -1:
-                unsup_loss_mask = torch.max(ori_prob, dim=-1)[0] > cfg.uda_confidence_thresh
-                unsup_loss_mask = unsup_loss_mask.type(torch.float32)
-            else:
-                unsup_loss_mask = torch.ones(len(logits) - sup_size, dtype=torch.float32)
-            unsup_loss_mask = unsup_loss_mask.to(_get_device())
-                    
         # aug
         uda_softmax_temp = cfg.uda_softmax_temp if cfg.uda_softmax_temp > 0 else 1.
         aug_log_prob = F.log_softmax(logits[sup_size:] / uda_softmax_temp, dim=-1)
@@ -69,9 +99,19 @@ def get_loss(model, sup_batch, unsup_batch, global_step): #original get_loss
         unsup_loss = torch.sum(unsup_loss * unsup_loss_mask, dim=-1) / torch.max(torch.sum(unsup_loss_mask, dim=-1), torch_device_one())
         final_loss = sup_loss + cfg.uda_coeff*unsup_loss
 
-        return final_loss, sup_loss, unsup_loss
+        return final_loss, sup_loss, unsup_loss, cfg.uda_coeff*unsup_loss, unsup_stats
     return sup_loss, None, None
 
+def guess_labels(model, ori_inputs, aug_inputs, temp):
+    """ MixMatch label guessing : sharpened mean of the ori and aug predictions
+        (both views go through the model as one batch) """
+    with torch.no_grad():
+        inputs = [torch.cat((o, a), dim=0) for o, a in zip(ori_inputs, aug_inputs)]
+        outputs_u, outputs_u2 = torch.softmax(model(*inputs), dim=1).chunk(2)
+        p = (outputs_u + outputs_u2) / 2
+        pt = p**(1/temp)
+        return pt / pt.sum(dim=1, keepdim=True)
+
 # original get_loss, restructured
 def get_loss_test(model, sup_batch, unsup_batch, global_step):
     # logits -> prob(softmax) -> log_prob(log_softmax)
@@ -143,13 +183,11 @@ def mixmatch_loss_no_mixup(model, sup_batch, unsup_batch, global_step):
     sup_loss = torch.mean(sup_loss)
 
     #unsup loss
-    with torch.no_grad():
-        outputs_u = model(ori_input_ids, ori_segment_ids, ori_input_mask)
-        outputs_u2 = model(aug_input_ids, aug_segment_ids, aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
 
     targets_u = torch.cat([targets_u, targets_u], dim=0)
 
@@ -189,13 +227,11 @@ def get_label_guess_loss(model, sup_batch, unsup_batch, global_step):
         sup_loss = torch.mean(sup_loss)
 
     #unsup loss
-    with torch.no_grad():
-        outputs_u = model(ori_input_ids, ori_segment_ids, ori_input_mask)
-        outputs_u2 = model(aug_input_ids, aug_segment_ids, aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
 
     targets_u = torch.cat([targets_u, targets_u], dim=0)
 
@@ -222,7 +258,7 @@ def get_sup_loss(model, sup_batch, unsup_batch, global_step):
     # convert label ids to hot vectors
     sup_size = input_ids.size(0)
     label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1)
-    label_ids = label_ids.cuda(non_blocking=True)
+    label_ids = label_ids.to(_get_device(), non_blocking=True)
 
     # for mixup
     l = np.random.beta(cfg.alpha, cfg.alpha)
@@ -276,7 +312,7 @@ def get_loss_mixup(model, sup_batch, unsup_batch, global_step):
     # convert label ids to hot vectors
     sup_size = input_ids.size(0)
     label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1)
-    label_ids = label_ids.cuda(non_blocking=True)
+    label_ids = label_ids.to(_get_device(), non_blocking=True)
 
     input_ids = torch.cat((input_ids, aug_input_ids), dim=0)
     segment_ids = torch.cat((segment_ids, aug_segment_ids), dim=0)
@@ -360,14 +396,12 @@ def get_mixmatch_loss_two(model, sup_batch, unsup_batch, global_step):
     batch_size = input_ids.shape[0]
     sup_size = label_ids.shape[0]
 
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
     with torch.no_grad():
-        # compute guessed labels of unlabel samples
-        outputs_u = model(input_ids=ori_input_ids, segment_ids=ori_segment_ids, input_mask=ori_input_mask)
-        outputs_u2 = model(input_ids=aug_input_ids, segment_ids=aug_segment_ids, input_mask=aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
         targets_u = torch.cat((targets_u, targets_u), dim=0)
 
         # confidence-based masking
@@ -414,16 +448,13 @@ def get_mixmatch_loss_sep(model, sup_batch, unsup_batch, global_step):
     sup_size = input_ids.size(0)
 
     # Transform label to one-hot
-    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).cuda()
+    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).to(_get_device())
 
-    with torch.no_grad():
-        # compute guessed labels of unlabel samples
-        outputs_u = model(input_ids=ori_input_ids, segment_ids=ori_segment_ids, input_mask=ori_input_mask)
-        outputs_u2 = model(input_ids=aug_input_ids, segment_ids=aug_segment_ids, input_mask=aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
 
     concat_input_ids = torch.cat((input_ids, ori_input_ids, aug_input_ids), dim=0)
     concat_seg_ids = torch.cat((segment_ids, ori_segment_ids, aug_segment_ids), dim=0)
@@ -487,16 +518,13 @@ def get_mixmatch_loss_short(model, sup_batch, unsup_batch, global_step):
     sup_size = input_ids.size(0)
 
     # Transform label to one-hot
-    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).cuda()
+    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).to(_get_device())
 
-    with torch.no_grad():
-        # compute guessed labels of unlabel samples
-        outputs_u = model(input_ids=ori_input_ids, segment_ids=ori_segment_ids, input_mask=ori_input_mask)
-        outputs_u2 = model(input_ids=aug_input_ids, segment_ids=aug_segment_ids, input_mask=aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
 
     concat_input_ids = torch.cat((input_ids, ori_input_ids, aug_input_ids), dim=0)
     concat_seg_ids = torch.cat((segment_ids, ori_segment_ids, aug_segment_ids), dim=0)
@@ -539,6 +567,11 @@ def get_mixmatch_loss_short(model, sup_batch, unsup_batch, global_step):
     return final_loss, Lx, Lu
 
 def get_mixmatch_loss(model, sup_batch, unsup_batch, global_step):
+    if not cfg.mixmatch_interleave:
+        # no BatchNorm in the transformer : interleaving only splits the batch into three forwards,
+        # without it this is the single-forward get_mixmatch_loss_short
+        return get_mixmatch_loss_short(model, sup_batch, unsup_batch, global_step)
+
     input_ids, segment_ids, input_mask, label_ids = sup_batch
     if unsup_batch:
         ori_input_ids, ori_segment_ids, ori_input_mask, \
@@ -547,16 +580,13 @@ def get_mixmatch_loss(model, sup_batch, unsup_batch, global_step):
     batch_size = input_ids.shape[0]
 
     # Transform label to one-hot
-    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).cuda()
+    label_ids = torch.zeros(batch_size, 2).scatter_(1, label_ids.cpu().view(-1,1), 1).to(_get_device())
 
-    with torch.no_grad():
-        # compute guessed labels of unlabel samples
-        outputs_u = model(input_ids=ori_input_ids, segment_ids=ori_segment_ids, input_mask=ori_input_mask)
-        outputs_u2 = model(input_ids=aug_input_ids, segment_ids=aug_segment_ids, input_mask=aug_input_mask)
-        p = (torch.softmax(outputs_u, dim=1) + torch.softmax(outputs_u2, dim=1)) / 2
-        pt = p**(1/cfg.uda_softmax_temp)
-        targets_u = pt / pt.sum(dim=1, keepdim=True)
-        targets_u = targets_u.detach()
+    # guessed labels of unlabel samples (ori and aug in one no-grad forward)
+    targets_u = guess_labels(
+        model, (ori_input_ids, ori_segment_ids, ori_input_mask),
+        (aug_input_ids, aug_segment_ids, aug_input_mask), cfg.uda_softmax_temp
+    )
 
     concat_input_ids = [input_ids, ori_input_ids, aug_input_ids]
     concat_seg_ids = [segment_ids, ori_segment_ids, aug_segment_ids]
@@ -637,7 +667,7 @@ def get_uda_mixup_loss(model, sup_batch, unsup_batch, global_step):
 
     # convert label_ids to hot vector
     sup_size = input_ids.size(0)
-    label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1).cuda()
+    label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1).to(_get_device())
 
     if unsup_batch:
         ori_input_ids, ori_segment_ids, ori_input_mask, \
@@ -680,6 +710,29 @@ def get_uda_mixup_loss(model, sup_batch, unsup_batch, global_step):
     sup_logits = logits[:sup_size]
     unsup_logits = logits[sup_size:]
 
+    mixed_ori_prob = None
+    if unsup_batch:
+        # ori (one no-grad forward, the target of both loss paths)
+        with torch.no_grad():
+            ori_logits = model(ori_input_ids, ori_segment_ids, ori_input_mask)
+            ori_prob   = F.softmax(ori_logits, dim=-1)    # KLdiv target
+            # ori_log_prob = F.log_softmax(ori_logits, dim=-1)
+
+            ori_prob_a, ori_prob_b = ori_prob, ori_prob[unsup_idx]
+            mixed_ori_prob = unsup_l * ori_prob_a + (1 - unsup_l) * ori_prob_b
+
+    if cfg.fused_uda_loss:    # same objective in one pass (utils.uda_objective)
+        tsa_thresh = None
+        if cfg.tsa and cfg.tsa != "none":
+            tsa_thresh = get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./logits.shape[-1], end=1)
+        final_loss, sup_loss, unsup_loss, _, _ = uda_objective(
+            logits, mixed_sup_label, mixed_ori_prob, tsa_thresh,
+            cfg.uda_confidence_thresh, cfg.uda_softmax_temp, cfg.uda_coeff
+        )
+        if unsup_batch:
+            return final_loss, sup_loss, unsup_loss
+        return sup_loss, None, None
+
     # sup loss
     sup_loss = -torch.sum(F.log_softmax(sup_logits, dim=1) * mixed_sup_label, dim=1)
 
@@ -694,15 +747,7 @@ def get_uda_mixup_loss(model, sup_batch, unsup_batch, global_step):
 
     # unsup loss
     if unsup_batch:
-        # ori
         with torch.no_grad():
-            ori_logits = model(ori_input_ids, ori_segment_ids, ori_input_mask)
-            ori_prob   = F.softmax(ori_logits, dim=-1)    # KLdiv target
-            # ori_log_prob = F.log_softmax(ori_logits, dim=-1)
-
-            ori_prob_a, ori_prob_b = ori_prob, ori_prob[unsup_idx]
-            mixed_ori_prob = unsup_l * ori_prob_a + (1 - unsup_l) * ori_prob_b
-
             # confidence-based masking
             if cfg.uda_confidence_thresh != -1:
                 unsup_loss_mask = torch.max(mixed_ori_prob, dim=-1)[0] > cfg.uda_confidence_thresh
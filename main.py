@@ -23,13 +23,21 @@ from models_bert import BertForSequenceClassificationCustom
 
 import train
 from load_data import load_data
-from utils.utils import set_seeds, get_device, _get_device, torch_device_one, mixup_op, pad_for_word_mixup, simple_pad, sigmoid_rampup
+from utils.utils import set_seeds, get_device, _get_device, torch_device_one, mixup_op, pad_for_word_mixup, simple_pad
 from utils import optim, configuration
+from utils.teacher_cache import TeacherCache
+from utils.schedules import schedule_tables
+from utils.uda_objective import uda_objective
+from utils.distributed import init_distributed
+from utils.ema import WeightEMA
+from utils.vocab import VocabMap, remap_datasets
+from utils.frozen_cache import FrozenCache
 import numpy as np
 
 
 from dataset import DataSet
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
 
 parser = argparse.ArgumentParser(description='PyTorch UDA Training')
 
@@ -74,12 +82,22 @@ parser.add_argument('--tsa', default='linear_schedule', type=str)
 parser.add_argument('--uda_softmax_temp', default=0.85, type=float)
 parser.add_argument('--uda_confidence_thresh', default=0.45, type=float)
 parser.add_argument('--unsup_criterion', default='KL', type=str)
+parser.add_argument('--teacher_cache', action='store_true')
+parser.add_argument('--teacher_cache_steps', default=1000, type=int)
+parser.add_argument('--teacher_cache_reuse', default=0, type=int)
+parser.add_argument('--confidence_skip', action='store_true')    # get_loss_ict : new confidence filter, changes the ICT loss
+parser.add_argument('--unsup_overdraw', default=2, type=int)
+parser.add_argument('--fused_uda_loss', action='store_true')
 
 #MixMatch
 parser.add_argument('--alpha', default=1, type=float)
 parser.add_argument('--lambda_u', default=75, type=int)
 parser.add_argument('--T', default=0.5, type=float)
 parser.add_argument('--ema_decay', default=0.999, type=float)
+parser.add_argument('--ema_every', default=1, type=int)
+parser.add_argument('--ema_dtype', default='fp32', choices=['fp32', 'bf16'])
+parser.add_argument('--ema_offload', action='store_true')
+parser.add_argument('--mixmatch_interleave', action='store_true')
 parser.add_argument('--sup_mixup',  choices=['cls', 'word', 'word_cls', 'word_cls_only'])
 parser.add_argument('--mixup', choices=['cls', 'word', 'word_cls', 'word_cls_only'])
 parser.add_argument('--simple_pad', action='store_true')
@@ -88,7 +106,20 @@ parser.add_argument('--no_grad_clone', action='store_true')
 parser.add_argument('--consistency_rampup_starts', default=0, type=int)
 parser.add_argument('--consistency_rampup_ends', default=0, type=int)
 
+#Distillation
+parser.add_argument('--distill', action='store_true')
+parser.add_argument('--teacher_file', default="", type=str)
+parser.add_argument('--student_layers', default=6, type=int)
+parser.add_argument('--student_init_blocks', default="", type=str)
+parser.add_argument('--distill_temp', default=2.0, type=float)
+parser.add_argument('--distill_alpha', default=0.5, type=float)
+
 parser.add_argument('--data_parallel', default=True, type=bool)
+parser.add_argument('--distributed', action='store_true')
+parser.add_argument('--dist_init_file', default='results/dist_rendezvous', type=str)
+parser.add_argument('--rank', default=0, type=int)
+parser.add_argument('--world_size', default=1, type=int)
+parser.add_argument('--num_threads', default=0, type=int)
 parser.add_argument('--need_prepro', default=False, type=bool)
 parser.add_argument('--sup_data_dir', default='data/imdb_sup_train.txt', type=str)
 parser.add_argument('--unsup_data_dir', default="data/imdb_unsup_train.txt", type=str)
@@ -97,13 +128,30 @@ parser.add_argument('--eval_data_dir', default="data/imdb_sup_test.txt", type=st
 parser.add_argument('--model_file', default="", type=str)
 parser.add_argument('--pretrain_file', default="BERT_Base_Uncased/bert_model.ckpt", type=str)
 parser.add_argument('--vocab', default="BERT_Base_Uncased/vocab.txt", type=str)
+parser.add_argument('--vocab_map', default='', type=str)     # task vocab of prune_vocab.py (use its model_cfg / pretrain_file)
 
 parser.add_argument('--save_steps', default=100, type=int)
 parser.add_argument('--check_steps', default=250, type=int)
 parser.add_argument('--results_dir', default="results", type=str)
+parser.add_argument('--metrics_formats', default='tensorboard,columnar', type=str)    # written by a background thread
+parser.add_argument('--metrics_flush_secs', default=10., type=float)
 
 parser.add_argument('--is_position', default=False, type=bool)
 
+#Compiled execution
+parser.add_argument('--compile', action='store_true')
+parser.add_argument('--compile_buckets', default='64,128,256', type=str)
+parser.add_argument('--compile_cache', default='results/compile_cache', type=str)
+
+#Profiling
+parser.add_argument('--profile', action='store_true')                # per-phase step times in tensorboard
+parser.add_argument('--profile_steps', default='', type=str)         # 'N:M' : torch.profiler trace of steps N..M
+parser.add_argument('--memory_report', action='store_true')          # activation / state / RSS memory per module and step
+parser.add_argument('--memory_steps', default=5, type=int)           # steps recorded before the report
+parser.add_argument('--lazy_embedding', action='store_true')        # BertAdam updates only the tok_embed rows of the batch
+parser.add_argument('--freeze_layers', default=0, type=int)         # embeddings + first k blocks frozen, cached for sup / eval
+parser.add_argument('--frozen_cache_dir', default='', type=str)     # memory-map the frozen cache there (else host memory)
+
 cfg, unknown = parser.parse_known_args()
 
 
@@ -124,11 +172,8 @@ NUM_LABELS = {
 }
 
 def linear_rampup(current, rampup_length):
-    if rampup_length == 0:
-        return 1.0
-    else:
-        current = np.clip(float(current) / float(rampup_length), 0.0, 1.0)
-        return float(current)
+    # device tensor read from the precomputed table (1.0 when rampup_length == 0)
+    return schedule_tables(cfg.total_steps, _get_device()).linear_rampup(current, rampup_length)
 
 class SemiLoss(object):
     def __call__(self, outputs_x, targets_x, outputs_u, targets_u, current_step, lambda_u, total_steps):
@@ -141,24 +186,40 @@ class SemiLoss(object):
 
 # TSA
 def get_tsa_thresh(schedule, global_step, num_train_steps, start, end):
-    training_progress = torch.tensor(float(global_step) / float(num_train_steps))
-    if schedule == 'linear_schedule':
-        threshold = training_progress
-    elif schedule == 'exp_schedule':
-        scale = 5
-        threshold = torch.exp((training_progress - 1) * scale)
-    elif schedule == 'log_schedule':
-        scale = 5
-        threshold = 1 - torch.exp((-training_progress) * scale)
-    output = threshold * (end - start) + start
-    return output.to(_get_device())
-
-
-def main():
+    # linear / exp / log thresholds of every step are precomputed on the device (utils.schedules)
+    return schedule_tables(num_train_steps, _get_device()).tsa(schedule, global_step, start, end)
+
+
+def uda_tsa_thresh(global_step, n_labels):
+    "TSA threshold of the step for uda_objective, None without TSA"
+    if cfg.tsa and cfg.tsa != "none":
+        return get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./n_labels, end=1)
+    return None
+
+
+def main(datasets=None, pretrained=None):
+    """ datasets : (train, val, unsup) TensorDatasets loaded by the caller (sweep.py), else read here
+        pretrained : transformer state_dict used instead of reading cfg.pretrain_file """
     # Load Configuration
     model_cfg = configuration.model.from_json(cfg.model_cfg)        # BERT_cfg
     set_seeds(cfg.seed)
 
+    def train_sampler(dataset):
+        # each rank draws its own shard of the shuffled dataset
+        return DistributedSampler(dataset, seed=cfg.seed) if cfg.distributed else RandomSampler(dataset)
+
+    # the over-drawn unsup batch is only cut down by get_loss_ict (--uda_test_mode_two), where the
+    # skip is a confidence filter added to the ICT objective (losses.get_loss is not called here)
+    assert not cfg.confidence_skip or (cfg.mode == 'train_eval' and cfg.uda_test_mode_two and not (
+        cfg.distill or cfg.mixmatch_mode or cfg.uda_test_mode)), '--confidence_skip needs --uda_test_mode_two'
+
+    # the distill targets are already precomputed teacher logits (and get_distill_loss unpacks nine unsup columns)
+    assert not (cfg.distill and cfg.teacher_cache), '--teacher_cache does not apply to --distill'
+
+    if cfg.distributed:
+        rank, world_size = init_distributed(cfg)
+        print('Rank %d of %d (%d threads)' % (rank, world_size, torch.get_num_threads()))
+
     # Load Data & Create Criterion
     #data = load_data(cfg)
 
@@ -169,13 +230,35 @@ def main():
     #    data_iter = [data.sup_data_iter()]
 
     # my own implementation
-    dataset = DataSet(cfg)
-    train_dataset, val_dataset, unsup_dataset = dataset.get_dataset()
+    if datasets is None:
+        dataset = DataSet(cfg)
+        datasets = dataset.get_dataset()
+    if cfg.vocab_map:      # ids renumbered to the rows of the pruned embedding table
+        vocab_map = VocabMap.load(cfg.vocab_map)
+        assert model_cfg.vocab_size == len(vocab_map), \
+            'model_cfg vocab_size %d, vocab map %d ids' % (model_cfg.vocab_size, len(vocab_map))
+        datasets = remap_datasets(datasets, vocab_map)
+    train_dataset, val_dataset, unsup_dataset = datasets
+
+    if cfg.distill:
+        # teacher logits are computed once in bulk and carried as the last dataset column,
+        # so student epochs never run the teacher
+        teacher = models.Classifier(model_cfg, NUM_LABELS[cfg.task])
+        teacher.load_state_dict(torch.load(cfg.teacher_file, map_location='cpu'))
+        train_dataset = TensorDataset(
+            *train_dataset.tensors,
+            train.precompute_logits(teacher, train_dataset, cfg.eval_batch_size, _get_device())
+        )
+        if unsup_dataset:
+            unsup_dataset = TensorDataset(
+                *unsup_dataset.tensors,
+                train.precompute_logits(teacher, unsup_dataset, cfg.eval_batch_size, _get_device())
+            )
 
     # Create the DataLoaders for our training and validation sets.
     train_dataloader = DataLoader(
                 train_dataset,  # The training samples.
-                sampler = RandomSampler(train_dataset), # Select batches randomly
+                sampler = train_sampler(train_dataset), # Select batches randomly
                 batch_size = cfg.train_batch_size # Trains with this batch size.
             )
 
@@ -185,12 +268,22 @@ def main():
                 batch_size = cfg.eval_batch_size # Evaluate with this batch size.
             )
 
+    teacher_cache = None
+    if unsup_dataset and cfg.teacher_cache:
+        # example indices as the last column, keys of the cached ori probabilities
+        unsup_dataset = TensorDataset(*unsup_dataset.tensors, torch.arange(len(unsup_dataset)))
+        teacher_cache = TeacherCache(
+            len(unsup_dataset), NUM_LABELS[cfg.task],
+            max_age=cfg.teacher_cache_steps, max_reuse=cfg.teacher_cache_reuse, device=_get_device()
+        )
+
     unsup_dataloader = None
     if unsup_dataset:
         unsup_dataloader = DataLoader(
             unsup_dataset,
-            sampler = RandomSampler(unsup_dataset),
-            batch_size = cfg.train_batch_size
+            sampler = train_sampler(unsup_dataset),
+            # --confidence_skip : draw extra candidates, only confident ones run the aug forward/backward
+            batch_size = cfg.train_batch_size * (cfg.unsup_overdraw if cfg.confidence_skip else 1)
         )
 
     if cfg.uda_mode or cfg.mixmatch_mode:
@@ -201,7 +294,13 @@ def main():
     ema_optimizer = None
     ema_model = None
 
-    if cfg.model == "custom":
+    if cfg.distill:
+        model = models.Classifier(model_cfg._replace(n_layers=cfg.student_layers), NUM_LABELS[cfg.task])
+        block_ids = [int(b) for b in cfg.student_init_blocks.split(',')] if cfg.student_init_blocks else None
+        block_ids = models.init_from_teacher(model, teacher.cpu(), block_ids)
+        print('Student blocks initialized from teacher blocks', block_ids)
+        del teacher
+    elif cfg.model == "custom":
         model = models.Classifier(model_cfg, NUM_LABELS[cfg.task])
     elif cfg.model == "bert":
         model = BertForSequenceClassificationCustom.from_pretrained(
@@ -211,6 +310,13 @@ def main():
             output_hidden_states = False, # Whether the model returns all hidden-states.
         )
 
+    if cfg.freeze_layers:
+        # partial fine-tuning : embeddings + first blocks frozen (no dropout), their sup / eval outputs cached
+        assert isinstance(model, models.Classifier), '--freeze_layers needs the custom model'
+        model.transformer.freeze_lower(cfg.freeze_layers)
+        model.transformer.frozen_cache = FrozenCache([train_dataset, val_dataset], model_cfg.dim, cfg.frozen_cache_dir)
+        if cfg.sup_mixup and 'word' in cfg.sup_mixup:
+            print('--sup_mixup %s pads the sup rows per step, most of them miss the frozen cache' % cfg.sup_mixup)
 
     if cfg.uda_mode:
         if cfg.unsup_criterion == 'KL':
@@ -223,14 +329,17 @@ def main():
         train_criterion = SemiLoss()
         criterion = nn.CrossEntropyLoss()
         optimizer = torch.optim.Adam(model.parameters(), lr=cfg.lr)
-        ema_model = models.Classifier(model_cfg,  NUM_LABELS[cfg.task])
-        for param in ema_model.parameters():
-            param.detach_()
-        ema_optimizer= WeightEMA(cfg, model, ema_model, alpha=cfg.ema_decay)
+        # shadow weights only (no second model), swapped into the model for evaluation
+        ema_optimizer = WeightEMA(cfg, model, alpha=cfg.ema_decay)
     else:
         sup_criterion = nn.CrossEntropyLoss(reduction='none')
         optimizer = optim.optim4GPU(cfg, model)
     
+    pretrain_file = cfg.pretrain_file
+    if pretrained is not None and cfg.model == "custom" and not cfg.distill:
+        model.transformer.load_state_dict(pretrained)
+        pretrain_file = None
+
     # Create trainer
     trainer = train.Trainer(cfg, model, data_iter, optimizer, get_device(), ema_model, ema_optimizer)
 
@@ -242,7 +351,7 @@ def main():
         # convert label ids to hot vectors
         sup_size = input_ids.size(0)
         label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1)
-        label_ids = label_ids.cuda(non_blocking=True)
+        label_ids = label_ids.to(_get_device(), non_blocking=True)
 
         # sup mixup
         sup_l = np.random.beta(cfg.alpha, cfg.alpha)
@@ -279,6 +388,10 @@ def main():
         if cfg.sup_mixup:
             label_ids = mixup_op(label_ids, sup_l, sup_idx)
 
+        if cfg.fused_uda_loss:    # TSA-masked cross-entropy in one pass (utils.uda_objective)
+            sup_loss = uda_objective(logits, label_ids, tsa_thresh=uda_tsa_thresh(global_step, logits.shape[-1]))[1]
+            return sup_loss, sup_loss, sup_loss, sup_loss
+
         sup_loss = -torch.sum(F.log_softmax(logits, dim=1) * label_ids, dim=1)
 
         if cfg.tsa and cfg.tsa != "none":
@@ -298,12 +411,12 @@ def main():
         input_ids, segment_ids, input_mask, og_label_ids, num_tokens = sup_batch
         ori_input_ids, ori_segment_ids, ori_input_mask, \
         aug_input_ids, aug_segment_ids, aug_input_mask, \
-        ori_num_tokens, aug_num_tokens = unsup_batch
+        ori_num_tokens, aug_num_tokens = unsup_batch[:8]
 
         # convert label ids to hot vectors
         sup_size = input_ids.size(0)
         label_ids = torch.zeros(sup_size, 2).scatter_(1, og_label_ids.cpu().view(-1,1), 1)
-        label_ids = label_ids.cuda(non_blocking=True)
+        label_ids = label_ids.to(_get_device(), non_blocking=True)
 
         # sup mixup
         sup_l = np.random.beta(cfg.alpha, cfg.alpha)
@@ -352,37 +465,69 @@ def main():
         if cfg.sup_mixup:
             label_ids = mixup_op(label_ids, sup_l, sup_idx)
 
-        sup_loss = -torch.sum(F.log_softmax(logits, dim=1) * label_ids, dim=1)
-
-        if cfg.tsa and cfg.tsa != "none":
-            tsa_thresh = get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./logits.shape[-1], end=1)
-            larger_than_threshold = torch.exp(-sup_loss) > tsa_thresh   # prob = exp(log_prob), prob > tsa_threshold
-            # larger_than_threshold = torch.sum(  F.softmax(pred[:sup_size]) * torch.eye(num_labels)[sup_label_ids]  , dim=-1) > tsa_threshold
-            loss_mask = torch.ones_like(og_label_ids, dtype=torch.float32) * (1 - larger_than_threshold.type(torch.float32))
-            sup_loss = torch.sum(sup_loss * loss_mask, dim=-1) / torch.max(torch.sum(loss_mask, dim=-1), torch_device_one())
+        sup_logits = logits
+        if cfg.fused_uda_loss:
+            # utils.uda_objective : computed with the unsup MSE at the end, alone when there is no unsup term
+            tsa_thresh = uda_tsa_thresh(global_step, logits.shape[-1])
+            sup_loss = None
         else:
-            sup_loss = torch.mean(sup_loss)
+            sup_loss = -torch.sum(F.log_softmax(logits, dim=1) * label_ids, dim=1)
+
+            if cfg.tsa and cfg.tsa != "none":
+                tsa_thresh = get_tsa_thresh(cfg.tsa, global_step, cfg.total_steps, start=1./logits.shape[-1], end=1)
+                larger_than_threshold = torch.exp(-sup_loss) > tsa_thresh   # prob = exp(log_prob), prob > tsa_threshold
+                # larger_than_threshold = torch.sum(  F.softmax(pred[:sup_size]) * torch.eye(num_labels)[sup_label_ids]  , dim=-1) > tsa_threshold
+                loss_mask = torch.ones_like(og_label_ids, dtype=torch.float32) * (1 - larger_than_threshold.type(torch.float32))
+                sup_loss = torch.sum(sup_loss * loss_mask, dim=-1) / torch.max(torch.sum(loss_mask, dim=-1), torch_device_one())
+            else:
+                sup_loss = torch.mean(sup_loss)
+
+        def sup_only():
+            return sup_loss if sup_loss is not None else uda_objective(sup_logits, label_ids, tsa_thresh=tsa_thresh)[1]
 
         if cfg.no_unsup_loss:
+            sup_loss = sup_only()
             return sup_loss, sup_loss, sup_loss, sup_loss
 
         # unsup loss
-        with torch.no_grad():
-            if cfg.model == "bert":
-                ori_logits = model(
-                    input_ids = ori_input_ids,
-                    attention_mask = ori_input_mask,
-                    no_pretrained_pool=cfg.no_pretrained_pool
-                )
-            else:
-                ori_logits = model(ori_input_ids, ori_segment_ids, ori_input_mask)
-            ori_prob   = F.softmax(ori_logits, dim=-1)    # KLdiv target
+        def ori_forward(rows):
+            with torch.no_grad():
+                if cfg.model == "bert":
+                    ori_logits = model(
+                        input_ids = ori_input_ids[rows],
+                        attention_mask = ori_input_mask[rows],
+                        no_pretrained_pool=cfg.no_pretrained_pool
+                    )
+                else:
+                    ori_logits = model(ori_input_ids[rows], ori_segment_ids[rows], ori_input_mask[rows])
+                return F.softmax(ori_logits, dim=-1)    # KLdiv target
+
+        if teacher_cache is not None:   # only stale rows run the ori forward
+            ori_prob = teacher_cache.get(ori_forward, unsup_batch[8], global_step)
+        else:
+            ori_prob = ori_forward(slice(None))
+
+        unsup_stats = {}
+        if cfg.confidence_skip:
+            # confidence filter : only the confident rows of the over-drawn batch (unsup_overdraw) run the
+            # consistency forward/backward, at most train_batch_size of them. The ICT loss has no
+            # confidence mask, so this is not loss-neutral : the MSE is averaged over the kept rows only
+            keep = (ori_prob.max(dim=-1)[0] > cfg.uda_confidence_thresh).nonzero().view(-1)
+            unsup_stats['masked_frac'] = 1. - len(keep) / len(ori_prob)
+            keep = keep[:cfg.train_batch_size]
+            unsup_stats['n_unsup_kept'] = len(keep)
+            ori_input_ids, ori_segment_ids, ori_input_mask, ori_num_tokens, ori_prob = [
+                t[keep] for t in (ori_input_ids, ori_segment_ids, ori_input_mask, ori_num_tokens, ori_prob)
+            ]
+            if not len(keep):
+                sup_loss = sup_only()
+                return sup_loss, sup_loss, sup_loss * 0, sup_loss * 0, unsup_stats
 
 
         # mixup
         l = np.random.beta(cfg.alpha, cfg.alpha)
         l = max(l, 1-l)
-        idx = torch.randperm(hidden.size(0))
+        idx = torch.randperm(ori_input_ids.size(0))
 
         
         if cfg.mixup and 'word' in cfg.mixup:
@@ -428,13 +573,53 @@ def main():
         if cfg.mixup:
             ori_prob = mixup_op(ori_prob, l, idx)
 
-        probs_u = torch.softmax(logits, dim=1)
-        unsup_loss = torch.mean((probs_u - ori_prob)**2)
-
-        w = cfg.uda_coeff * sigmoid_rampup(global_step, cfg.consistency_rampup_ends - cfg.consistency_rampup_starts)
-        final_loss = sup_loss + w*unsup_loss
+        w = cfg.uda_coeff * schedule_tables(cfg.total_steps, _get_device()).sigmoid_rampup(
+            global_step, cfg.consistency_rampup_ends - cfg.consistency_rampup_starts
+        )
+        if cfg.fused_uda_loss:    # sup cross-entropy and unsup MSE in one pass
+            final_loss, sup_loss, unsup_loss, _, _ = uda_objective(
+                torch.cat((sup_logits, logits), dim=0), label_ids, ori_prob, tsa_thresh, coeff=w, criterion='MSE'
+            )
+        else:
+            probs_u = torch.softmax(logits, dim=1)
+            unsup_loss = torch.mean((probs_u - ori_prob)**2)
+            final_loss = sup_loss + w*unsup_loss
+        if cfg.confidence_skip:
+            return final_loss, sup_loss, unsup_loss, w*unsup_loss, unsup_stats
         return final_loss, sup_loss, unsup_loss, w*unsup_loss
 
+    def get_distill_loss(model, sup_batch, unsup_batch, global_step):
+        # soft targets : teacher logits precomputed in the last column of each batch
+        T = cfg.distill_temp
+
+        def soft_loss(logits, teacher_logits):
+            return F.kl_div(
+                F.log_softmax(logits / T, dim=-1), F.softmax(teacher_logits / T, dim=-1), reduction='batchmean'
+            ) * T * T
+
+        input_ids, segment_ids, input_mask, label_ids, num_tokens, t_logits = sup_batch
+        logits = model(input_ids, segment_ids, input_mask)
+        sup_loss = cfg.distill_alpha * F.cross_entropy(logits, label_ids) \
+                 + (1 - cfg.distill_alpha) * soft_loss(logits, t_logits)
+
+        if unsup_batch is None or cfg.no_unsup_loss:
+            return sup_loss, sup_loss, sup_loss, sup_loss
+
+        ori_input_ids, ori_segment_ids, ori_input_mask, \
+        aug_input_ids, aug_segment_ids, aug_input_mask, \
+        ori_num_tokens, aug_num_tokens, t_ori_logits = unsup_batch
+
+        # the teacher prediction on the original is the target of both the original and the augmented view
+        logits = model(
+            torch.cat((ori_input_ids, aug_input_ids), dim=0),
+            torch.cat((ori_segment_ids, aug_segment_ids), dim=0),
+            torch.cat((ori_input_mask, aug_input_mask), dim=0)
+        )
+        unsup_loss = soft_loss(logits, torch.cat((t_ori_logits, t_ori_logits), dim=0))
+
+        final_loss = sup_loss + cfg.uda_coeff * unsup_loss
+        return final_loss, sup_loss, unsup_loss, cfg.uda_coeff * unsup_loss
+
     # evaluation
     def get_acc(model, batch):
         # input_ids, segment_ids, input_mask, label_id, sentence = batch
@@ -449,22 +634,32 @@ def main():
         return accuracy, result
 
     if cfg.mode == 'train':
-        trainer.train(get_loss, None, cfg.model_file, cfg.pretrain_file)
+        if cfg.distill:
+            trainer.train(get_distill_loss, None, cfg.model_file, None)
+        else:
+            trainer.train(get_loss, None, cfg.model_file, pretrain_file)
 
     if cfg.mode == 'train_eval':
-        if cfg.mixmatch_mode:
-            trainer.train(get_mixmatch_loss_short, get_acc, cfg.model_file, cfg.pretrain_file)
+        if cfg.distill:     # the student is initialized from the teacher, not from pretrain_file
+            trainer.train(get_distill_loss, get_acc, cfg.model_file, None)
+        elif cfg.mixmatch_mode:
+            trainer.train(get_mixmatch_loss_short, get_acc, cfg.model_file, pretrain_file)
         elif cfg.uda_test_mode:
-            trainer.train(get_sup_loss, get_acc, cfg.model_file, cfg.pretrain_file)
+            trainer.train(get_sup_loss, get_acc, cfg.model_file, pretrain_file)
         elif cfg.uda_test_mode_two:
-            trainer.train(get_loss_ict, get_acc, cfg.model_file, cfg.pretrain_file)
+            trainer.train(get_loss_ict, get_acc, cfg.model_file, pretrain_file)
         else:
-            trainer.train(get_sup_loss, get_acc, cfg.model_file, cfg.pretrain_file)
+            trainer.train(get_sup_loss, get_acc, cfg.model_file, pretrain_file)
 
     if cfg.mode == 'eval':
         results = trainer.eval(get_acc, cfg.model_file, None)
         total_accuracy = torch.cat(results).mean().item()
         print('Accuracy :' , total_accuracy)
+        return {'eval_acc': total_accuracy}
+
+    if trainer.max_acc:
+        acc, step, val_loss, train_loss = trainer.max_acc
+        return {'max_acc': float(acc), 'max_acc_step': step, 'val_loss': float(val_loss), 'train_loss': float(train_loss)}
 
 
 if __name__ == '__main__':
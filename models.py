@@ -15,6 +15,7 @@
 
 
 """ Transformer Model Classes & Config Class """
+import os
 import pdb
 import math
 import json
@@ -129,7 +130,7 @@ class MultiHeadedSelfAttention(nn.Module):
         self.proj_k = nn.Linear(cfg.dim, cfg.dim) #(preload)
         self.proj_v = nn.Linear(cfg.dim, cfg.dim) #(preload)
         self.drop = nn.Dropout(cfg.p_drop_attn)
-        self.scores = None # for visualization
+        self.capture = None # callback(scores), set by AttentionCapture (scores are not kept otherwise)
         self.n_heads = cfg.n_heads
 
     def forward(self, x, mask):
@@ -152,7 +153,8 @@ class MultiHeadedSelfAttention(nn.Module):
         h = (scores @ v).transpose(1, 2).contiguous()
         # -merge-> (B, S, D)
         h = merge_last(h, 2)
-        self.scores = scores
+        if self.capture is not None:
+            self.capture(scores)
         return h
 
 
@@ -169,6 +171,17 @@ class PositionWiseFeedForward(nn.Module):
         return self.fc2(gelu(self.fc1(x)))
 
 
+def prune_linear(linear, index, dim):
+    "copy of linear keeping only the outputs (dim=0) or the inputs (dim=1) in index"
+    weight = linear.weight.detach().index_select(dim, index)
+    bias = linear.bias.detach()[index] if dim == 0 else linear.bias.detach()
+    pruned = nn.Linear(weight.size(1), weight.size(0)).to(weight.device, weight.dtype)
+    with torch.no_grad():
+        pruned.weight.copy_(weight)
+        pruned.bias.copy_(bias)
+    return pruned
+
+
 class Block(nn.Module):
     """ Transformer Block """
     def __init__(self, cfg):
@@ -186,6 +199,26 @@ class Block(nn.Module):
         h = self.norm2(h + self.drop(self.pwff(h)))
         return h
 
+    def prune_heads(self, heads):
+        "remove the attention heads in heads (indices among the current heads), at least one has to stay"
+        attn = self.attn
+        width = attn.proj_q.out_features // attn.n_heads
+        keep = [h for h in range(attn.n_heads) if h not in set(heads)]
+        assert keep, 'every head of the block would be pruned'
+        index = torch.tensor([h * width + i for h in keep for i in range(width)], device=self.proj.weight.device)
+        attn.proj_q, attn.proj_k, attn.proj_v = (prune_linear(l, index, 0) for l in [attn.proj_q, attn.proj_k, attn.proj_v])
+        self.proj = prune_linear(self.proj, index, 1)
+        attn.n_heads = len(keep)
+
+    def prune_neurons(self, neurons):
+        "remove the intermediate neurons of pwff (fc1 outputs / fc2 inputs) in neurons"
+        pwff = self.pwff
+        keep = [n for n in range(pwff.fc1.out_features) if n not in set(neurons)]
+        assert keep, 'every neuron of the block would be pruned'
+        index = torch.tensor(keep, device=pwff.fc1.weight.device)
+        pwff.fc1 = prune_linear(pwff.fc1, index, 0)
+        pwff.fc2 = prune_linear(pwff.fc2, index, 1)
+
 
 class Transformer(nn.Module):
     """ Transformer with Self-Attentive Blocks"""
@@ -193,6 +226,48 @@ class Transformer(nn.Module):
         super().__init__()
         self.embed = Embeddings(cfg)
         self.blocks = nn.ModuleList([Block(cfg) for _ in range(cfg.n_layers)])   # h 번 반복
+        self.n_frozen = 0           # freeze_lower()
+        self.frozen_cache = None    # utils.frozen_cache.FrozenCache of the frozen outputs (sup / eval sets)
+
+    def freeze_lower(self, n_frozen):
+        """ no gradient for the embeddings and the first n_frozen blocks, and no dropout in them :
+            they stay in eval mode in train() too, so their output is a function of the input only
+            and can be cached. The upper blocks and the head keep their dropout (the dropout noise
+            of the lower layers, also on the unsup aug forward, is gone). Word mixup has to happen
+            at or above the frozen boundary (Classifier draws mixup layers from n_frozen up) """
+        self.n_frozen = n_frozen
+        for module in [self.embed] + list(self.blocks[:n_frozen]):
+            for p in module.parameters():
+                p.requires_grad = False
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.n_frozen:
+            self.embed.eval()
+            for block in self.blocks[:self.n_frozen]:
+                block.eval()
+        return self
+
+    def frozen_forward(self, x, seg, mask):
+        "output of the embeddings and the frozen blocks"
+        with torch.no_grad():
+            h, _ = self.embed(x, seg, None, None, 1, None, -1, False, False)
+            for block in self.blocks[:self.n_frozen]:
+                h = block(h, mask)
+        return h
+
+    def lower(self, x, seg, mask):
+        if self.frozen_cache is not None:
+            return self.frozen_cache.lookup(x, seg, mask, self.frozen_forward)
+        return self.frozen_forward(x, seg, mask)
+
+    @staticmethod
+    def word_mixup(h, hc, l, shuffle_idx):
+        if hc is not None:
+            h_a, h_b = h, hc[shuffle_idx]
+            return l * h_a + (1-l) * h_b, None
+        return mixup_op(h, l, shuffle_idx), None
 
     def forward(
             self, 
@@ -200,12 +275,18 @@ class Transformer(nn.Module):
             clone_ids=None, mixup=None, shuffle_idx=None, l=1, 
             mixup_layer=-1, simple_pad=False, no_grad_clone=False
         ):
-        h, hc = self.embed(
-            x, seg, mixup, shuffle_idx, l, clone_ids, mixup_layer, simple_pad, no_grad_clone
-        )
+        if self.n_frozen:
+            h = self.lower(x, seg, mask)
+            hc = self.lower(clone_ids, seg, mask) if mixup and 'word' in mixup and clone_ids is not None else None
+            if mixup_layer == self.n_frozen and mixup and 'word' in mixup:     # word, word_cls, word_cls_only
+                h, hc = self.word_mixup(h, hc, l, shuffle_idx)
+        else:
+            h, hc = self.embed(
+                x, seg, mixup, shuffle_idx, l, clone_ids, mixup_layer, simple_pad, no_grad_clone
+            )
 
-        layer = 1
-        for block in self.blocks:
+        layer = self.n_frozen + 1
+        for block in self.blocks[self.n_frozen:]:
             h = block(h, mask)
             
             if hc is not None:
@@ -215,13 +296,8 @@ class Transformer(nn.Module):
                 else:
                     hc = block(hc, mask)
 
-            if mixup_layer == layer and (mixup == 'word' or mixup == 'word_cls'):
-                if hc is not None:
-                    h_a, h_b = h, hc[shuffle_idx]
-                    h = l * h_a + (1-l) * h_b
-                    hc = None
-                else:
-                    h = mixup_op(h, l, shuffle_idx)
+            if mixup_layer == layer and mixup and 'word' in mixup:
+                h, hc = self.word_mixup(h, hc, l, shuffle_idx)
 
 
             layer += 1
@@ -256,14 +332,15 @@ class Classifier(nn.Module):
         ):
         if input_h is None:
 
+            lowest = self.transformer.n_frozen  # word mixup at or above the frozen blocks
             if mixup == 'word':
-                mixup_layer = random.randint(0, self.layers) if manifold_mixup else 0
+                mixup_layer = random.randint(lowest, self.layers) if manifold_mixup else lowest
             elif mixup == 'word_cls':
-                mixup_layer = random.randint(0, self.layers+1) if manifold_mixup else 0
+                mixup_layer = random.randint(lowest, self.layers+1) if manifold_mixup else lowest
             elif mixup == 'cls':
                 mixup_layer = self.layers + 1
             elif mixup == 'word_cls_only':
-                mixup_layer = random.choice([0, self.layers + 1])
+                mixup_layer = random.choice([lowest, self.layers + 1])
             else:
                 mixup_layer = -1
 
@@ -290,3 +367,169 @@ class Classifier(nn.Module):
             pooled_h = input_h
         logits = self.classifier(self.drop(pooled_h))
         return logits
+
+
+
+class ExitHead(nn.Module):
+    """ pooler + classifier on the [CLS] hidden state of an intermediate block """
+    def __init__(self, cfg, n_labels):
+        super().__init__()
+        self.fc = nn.Linear(cfg.dim, cfg.dim)
+        self.activ = nn.Tanh()
+        self.drop = nn.Dropout(cfg.p_drop_hidden)
+        self.classifier = nn.Linear(cfg.dim, n_labels)
+
+    def forward(self, h):
+        return self.classifier(self.drop(self.activ(self.fc(h[:, 0]))))
+
+
+class EarlyExitClassifier(Classifier):
+    """ Classifier with exit heads after the blocks in exit_layers (number of blocks run, 1 .. n_layers-1)
+        forward() is the plain Classifier forward (final head), so Classifier checkpoints load with
+        strict=False and the training losses are unchanged. exit_logits() gives the logits of every exit,
+        early_exit() stops each example at the first exit whose max probability reaches threshold """
+    def __init__(self, cfg, n_labels, exit_layers):
+        super().__init__(cfg, n_labels)
+        self.exit_layers = sorted(exit_layers)
+        assert all(0 < l < cfg.n_layers for l in self.exit_layers), \
+            'exit layers have to be in 1 .. %d : %s' % (cfg.n_layers - 1, exit_layers)
+        self.exits = nn.ModuleList([ExitHead(cfg, n_labels) for _ in self.exit_layers])
+
+    def init_exits_from_head(self):
+        "start every exit head from the final pooler / classifier (e.g. after loading a UDA checkpoint)"
+        for head in self.exits:
+            head.fc.load_state_dict(self.fc.state_dict())
+            head.classifier.load_state_dict(self.classifier.state_dict())
+
+    def head(self, h):
+        return self.classifier(self.drop(self.activ(self.fc(h[:, 0]))))
+
+    def exit_logits(self, input_ids, segment_ids, input_mask):
+        "[logits of each exit in exit_layers order] + [final logits]"
+        h, _ = self.transformer.embed(input_ids, segment_ids, None, None, 1, None, -1, False, False)
+        heads = dict(zip(self.exit_layers, self.exits))
+        logits = []
+        for layer, block in enumerate(self.transformer.blocks, 1):
+            h = block(h, input_mask)
+            if layer in heads:
+                logits.append(heads[layer](h))
+        return logits + [self.head(h)]
+
+    @torch.no_grad()
+    def early_exit(self, input_ids, segment_ids, input_mask, threshold):
+        """ per-example exits inside the batch : the examples that are confident enough leave at an exit,
+            the blocks after it only run on the rest. returns (logits, number of blocks run) per example """
+        batch_size, n_layers = input_ids.size(0), len(self.transformer.blocks)
+        logits = None
+        exits = torch.full((batch_size,), n_layers, dtype=torch.long, device=input_ids.device)
+        active = torch.arange(batch_size, device=input_ids.device)
+        heads = dict(zip(self.exit_layers, self.exits))
+
+        h, _ = self.transformer.embed(input_ids, segment_ids, None, None, 1, None, -1, False, False)
+        mask = input_mask
+        for layer, block in enumerate(self.transformer.blocks, 1):
+            h = block(h, mask)
+            if layer not in heads:
+                continue
+            out = heads[layer](h)
+            if logits is None:
+                logits = out.new_zeros(batch_size, out.size(-1))
+            done = F.softmax(out, dim=-1).max(-1)[0] >= threshold
+            if done.any():
+                logits[active[done]] = out[done]
+                exits[active[done]] = layer
+                keep = ~done
+                if not keep.any():
+                    return logits, exits
+                active, h, mask = active[keep], h[keep], mask[keep]
+        out = self.head(h)
+        if logits is None:
+            logits = out.new_zeros(batch_size, out.size(-1))
+        logits[active] = out
+        return logits, exits
+
+
+def fit_to_state_dict(model, state_dict):
+    """ shrink the attention and feed-forward layers of model to the shapes of a pruned checkpoint
+        (prune.py), the weights are overwritten by load_state_dict afterwards. True if model changed """
+    changed = False
+    for name, module in model.named_modules():
+        if not isinstance(module, Block):
+            continue
+        prefix = name + '.' if name else ''
+        width = module.attn.proj_q.out_features // module.attn.n_heads
+        n_heads = state_dict[prefix + 'attn.proj_q.weight'].size(0) // width
+        if n_heads < module.attn.n_heads:
+            module.prune_heads(range(n_heads, module.attn.n_heads))
+            changed = True
+        n_neurons = state_dict[prefix + 'pwff.fc1.weight'].size(0)
+        if n_neurons < module.pwff.fc1.out_features:
+            module.prune_neurons(range(n_neurons, module.pwff.fc1.out_features))
+            changed = True
+    return changed
+
+
+def init_from_teacher(student, teacher, block_ids=None):
+    """ initialize a shallower Classifier from a trained one
+        embeddings, pooler and classifier are copied, student block i starts from teacher block block_ids[i]
+        (default : evenly spaced, always keeping the last teacher block) """
+    n_student, n_teacher = len(student.transformer.blocks), len(teacher.transformer.blocks)
+    if block_ids is None:
+        block_ids = [(i + 1) * n_teacher // n_student - 1 for i in range(n_student)]
+    assert len(block_ids) == n_student, 'need one teacher block per student block : %s' % (block_ids,)
+
+    student.transformer.embed.load_state_dict(teacher.transformer.embed.state_dict())
+    for block, i in zip(student.transformer.blocks, block_ids):
+        block.load_state_dict(teacher.transformer.blocks[i].state_dict())
+    student.fc.load_state_dict(teacher.fc.state_dict())
+    student.classifier.load_state_dict(teacher.classifier.state_dict())
+    return block_ids
+
+
+class AttentionCapture(object):
+    """ Opt-in capture of the attention probabilities (B, H, S, S) of a model's blocks
+        layers / heads / samples : indices to keep (None : all)
+        out_dir : save every capture to out_dir/attn_layer<l>_<n>.pt instead of keeping it in .maps
+        maps[layer] : detached host tensors, one per forward of the block
+
+        with AttentionCapture(model, layers=[11], heads=[0, 1], samples=[0]) as capture:
+            model(input_ids, segment_ids, input_mask)
+        capture.maps[11][0]     # (1, 2, S, S) """
+    def __init__(self, model, layers=None, heads=None, samples=None, out_dir=None):
+        self.heads = heads
+        self.samples = samples
+        self.out_dir = out_dir
+        self.maps = {}
+        self.counts = {}
+        self.modules = [
+            (layer, m) for layer, m in enumerate(
+                m for m in model.modules() if isinstance(m, MultiHeadedSelfAttention))
+            if layers is None or layer in layers
+        ]
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+    def record(self, layer, scores):
+        scores = scores.detach()
+        if self.samples is not None:
+            scores = scores[self.samples]
+        if self.heads is not None:
+            scores = scores[:, self.heads]
+        scores = scores.cpu()
+        n = self.counts[layer] = self.counts.get(layer, -1) + 1
+        if self.out_dir:
+            torch.save(
+                {'layer': layer, 'heads': self.heads, 'samples': self.samples, 'scores': scores},
+                os.path.join(self.out_dir, 'attn_layer%02d_%04d.pt' % (layer, n))
+            )
+        else:
+            self.maps.setdefault(layer, []).append(scores)
+
+    def __enter__(self):
+        for layer, m in self.modules:
+            m.capture = lambda scores, layer=layer: self.record(layer, scores)
+        return self
+
+    def __exit__(self, *exc):
+        for _, m in self.modules:
+            m.capture = None
@@ -0,0 +1,129 @@
+""" Structured pruning of models.Classifier (attention heads and feed-forward neurons)
+
+    python prune.py --model_file results/results/save/model_steps_5000.pt --task imdb \
+                    --sparsities 0.1,0.3,0.5 --pruned_dir results/pruned
+
+    The importance of every head and neuron is scored once on the supervised split (gradient of the
+    loss w.r.t. a mask on its output). For each sparsity the least important ones are removed, the
+    Linear layers are shrunk, the model is fine-tuned for --recovery_steps and saved to
+    <pruned_dir>/model_pruned_<sparsity>.pt (loads through Trainer.load / inference.load_classifier).
+"""
+import os
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+
+from inference import load_classifier
+from utils import optim, pruning
+
+parser = argparse.ArgumentParser(description='Structured pruning of Classifier')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--model_file', default='', type=str)
+parser.add_argument('--pruned_dir', default='', type=str)
+parser.add_argument('--num_labels', default=2, type=int)
+parser.add_argument('--task', default='imdb', type=str)
+parser.add_argument('--train_cap', default=-1, type=int)
+parser.add_argument('--dev_cap', default=-1, type=int)
+parser.add_argument('--data_seed', default=42, type=int)
+parser.add_argument('--sparsities', default='0.1,0.3,0.5', type=str)   # fraction of the heads / neurons removed
+parser.add_argument('--targets', default='heads,neurons', type=str)
+parser.add_argument('--score_batches', default=-1, type=int)          # -1 : the whole supervised split
+parser.add_argument('--recovery_steps', default=200, type=int)
+parser.add_argument('--lr', default=2e-5, type=float)
+parser.add_argument('--warmup', default=0.1, type=float)
+parser.add_argument('--train_batch_size', default=16, type=int)
+parser.add_argument('--eval_batch_size', default=32, type=int)
+parser.add_argument('--threads', default=0, type=int)
+
+
+def recover(model, dataset, cfg, device):
+    "short supervised fine-tuning of the pruned model"
+    loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=cfg.train_batch_size)
+    optim_cfg = argparse.Namespace(lr=cfg.lr, warmup=cfg.warmup, total_steps=cfg.recovery_steps)
+    optimizer = optim.optim4GPU(optim_cfg, model)
+    model.train()
+    step = 0
+    while step < cfg.recovery_steps:
+        for batch in loader:
+            input_ids, segment_ids, input_mask, label_ids = [t.to(device) for t in batch[:4]]
+            optimizer.zero_grad()
+            loss = F.cross_entropy(model(input_ids, segment_ids, input_mask), label_ids)
+            loss.backward()
+            optimizer.step()
+            step += 1
+            if step == cfg.recovery_steps:
+                break
+    return model.eval()
+
+
+def evaluate(model, dataset, batch_size, device):
+    "accuracy and seconds spent in the forward"
+    loader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    correct, total, elapsed = 0, 0, 0.
+    with torch.no_grad():
+        for batch in loader:
+            input_ids, segment_ids, input_mask, label_ids = [t.to(device) for t in batch[:4]]
+            start = time.time()
+            pred = model(input_ids, segment_ids, input_mask).argmax(-1).cpu()
+            elapsed += time.time() - start
+            correct += (pred == label_ids.cpu()).sum().item()
+            total += label_ids.size(0)
+    return correct / total, elapsed
+
+
+def datasets(cfg):
+    from dataset import DataSet
+    data_cfg = argparse.Namespace(
+        task=cfg.task, data_seed=cfg.data_seed, train_cap=cfg.train_cap, dev_cap=cfg.dev_cap,
+        unsup_cap=-1, uda_mode=False
+    )
+    train_dataset, val_dataset, _ = DataSet(data_cfg).get_dataset()
+    return train_dataset, val_dataset
+
+
+def n_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def main(cfg):
+    if cfg.threads > 0:
+        torch.set_num_threads(cfg.threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    train_dataset, val_dataset = datasets(cfg)
+    targets = cfg.targets.split(',')
+
+    model = load_classifier('custom', cfg.model_cfg, cfg.model_file, cfg.num_labels, device)
+    loader = DataLoader(train_dataset, sampler=SequentialSampler(train_dataset), batch_size=cfg.train_batch_size)
+    head_scores, neuron_scores = pruning.importance(model, loader, device, cfg.score_batches)
+    if cfg.pruned_dir:
+        os.makedirs(cfg.pruned_dir, exist_ok=True)
+
+    acc, base_t = evaluate(model, val_dataset, cfg.eval_batch_size, device)
+    rows = [(0., 0, 0, n_params(model), acc, base_t)]
+    for sparsity in [float(s) for s in cfg.sparsities.split(',') if s]:
+        pruned = copy.deepcopy(model)
+        heads, neurons = pruning.prune(
+            pruned, head_scores, neuron_scores,
+            sparsity if 'heads' in targets else 0., sparsity if 'neurons' in targets else 0.
+        )
+        if cfg.recovery_steps > 0:
+            pruned = recover(pruned, train_dataset, cfg, device)
+        acc, t = evaluate(pruned, val_dataset, cfg.eval_batch_size, device)
+        rows.append((sparsity, heads, neurons, n_params(pruned), acc, t))
+        if cfg.pruned_dir:
+            file = os.path.join(cfg.pruned_dir, 'model_pruned_%g.pt' % sparsity)
+            torch.save(pruned.state_dict(), file)
+            print('Saved the pruned model to', file)
+
+    print('%-8s %7s %8s %9s %8s %9s %8s' % ('sparsity', 'heads', 'neurons', 'params(M)', 'acc', 'time(s)', 'speedup'))
+    for sparsity, heads, neurons, params, acc, t in rows:
+        print('%-8.2f %7d %8d %9.2f %8.4f %9.2f %7.2fx' % (sparsity, heads, neurons, params / 1e6, acc, t, base_t / t))
+    return rows
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
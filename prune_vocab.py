@@ -0,0 +1,76 @@
+""" Task-specific vocabulary pruning of the token embedding table
+
+    python prune_vocab.py --task imdb --uda_mode --out_dir results/vocab_imdb \
+                          --pretrain_file BERT_Base_Uncased/bert_model.ckpt
+    python main.py --model_cfg results/vocab_imdb/bert_config.json \
+                   --pretrain_file results/vocab_imdb/pretrained.pt --vocab_map results/vocab_imdb/vocab_map.json ...
+
+    The tokenized train / eval / unsup splits are scanned for the ids they use. Those ids and the special
+    tokens are renumbered into a compact vocab ([UNK] for everything else) and written to out_dir :
+    vocab_map.json, bert_config.json (vocab_size of the task vocab), pretrained.pt (pretrained transformer
+    with the sliced tok_embed) and model.pt (--model_file sliced, for inference / serve.py --vocab_map).
+"""
+import os
+import json
+import argparse
+
+import torch
+
+import models
+from train import load_pretrained
+from utils import configuration, tokenization, vocab
+
+parser = argparse.ArgumentParser(description='Task-specific vocabulary pruning')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--vocab', default='BERT_Base_Uncased/vocab.txt', type=str)
+parser.add_argument('--pretrain_file', default='', type=str)
+parser.add_argument('--model_file', default='', type=str)       # trained Classifier with the full vocab
+parser.add_argument('--out_dir', default='results/vocab', type=str)
+parser.add_argument('--task', default='imdb', type=str)
+parser.add_argument('--uda_mode', action='store_true')          # also scan the unsup split
+parser.add_argument('--train_cap', default=-1, type=int)
+parser.add_argument('--dev_cap', default=-1, type=int)
+parser.add_argument('--unsup_cap', default=-1, type=int)
+parser.add_argument('--data_seed', default=42, type=int)
+parser.add_argument('--min_count', default=1, type=int)         # ids seen less often map to [UNK]
+
+MB = 1024. ** 2
+
+
+def main(cfg):
+    from dataset import DataSet
+    os.makedirs(cfg.out_dir, exist_ok=True)
+    model_cfg = configuration.model.from_json(cfg.model_cfg)
+
+    counts = vocab.count_ids(DataSet(cfg).get_dataset())
+    vocab_map = vocab.build(counts, tokenization.load_vocab(cfg.vocab), cfg.min_count)
+    assert vocab_map.full_size == model_cfg.vocab_size, \
+        'vocab %d tokens, model_cfg %d' % (vocab_map.full_size, model_cfg.vocab_size)
+    vocab_map.save(os.path.join(cfg.out_dir, 'vocab_map.json'))
+    with open(os.path.join(cfg.out_dir, 'bert_config.json'), 'w') as f:
+        json.dump(dict(model_cfg._asdict(), vocab_size=len(vocab_map)), f, indent=4)
+
+    if cfg.pretrain_file:
+        transformer = models.Transformer(model_cfg)
+        load_pretrained(transformer, cfg.pretrain_file)
+        state_dict = vocab.prune_state_dict(transformer.state_dict(), vocab_map)
+        torch.save({'transformer.' + k: v for k, v in state_dict.items()}, os.path.join(cfg.out_dir, 'pretrained.pt'))
+    if cfg.model_file:
+        state_dict = torch.load(cfg.model_file, map_location='cpu')
+        torch.save(vocab.prune_state_dict(state_dict, vocab_map, 'transformer.'), os.path.join(cfg.out_dir, 'model.pt'))
+
+    total = sum(counts.values())
+    unk = sum(n for i, n in counts.items() if vocab_map.table[i] == vocab_map.table[vocab_map.unk_id])
+    # parameter + gradient + BertAdam next_m / next_v of the table, fp32
+    table_mb = lambda rows: 4 * rows * model_cfg.dim * 4 / MB
+    print('task vocab %d of %d ids (%.1f%%), %.3f%% of the tokens map to [UNK]' % (
+        len(vocab_map), vocab_map.full_size, 100. * len(vocab_map) / vocab_map.full_size, 100. * unk / total))
+    print('tok_embed %.1fM -> %.1fM parameters, training state %.0f MB -> %.0f MB' % (
+        vocab_map.full_size * model_cfg.dim / 1e6, len(vocab_map) * model_cfg.dim / 1e6,
+        table_mb(vocab_map.full_size), table_mb(len(vocab_map))))
+    print('Saved the task vocab to', cfg.out_dir)
+    return vocab_map
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
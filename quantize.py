@@ -0,0 +1,103 @@
+""" Int8 dynamic quantization of models.Classifier for CPU inference
+
+    python quantize.py --model_file results/results/save/model_steps_5000.pt \
+                       --quantized_file results/model_int8.pt --tasks imdb,sst
+"""
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, SequentialSampler
+
+import models
+from inference import load_classifier
+from utils import configuration
+
+parser = argparse.ArgumentParser(description='Int8 dynamic quantization of Classifier')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--model_file', default='', type=str)
+parser.add_argument('--quantized_file', default='', type=str)
+parser.add_argument('--num_labels', default=2, type=int)
+parser.add_argument('--tasks', default='imdb,sst', type=str)
+parser.add_argument('--dev_cap', default=-1, type=int)
+parser.add_argument('--data_seed', default=42, type=int)
+parser.add_argument('--eval_batch_size', default=16, type=int)
+parser.add_argument('--threads', default=0, type=int)
+
+
+def quantizable_layers(model):
+    """ names of the Linear layers of attention (proj_q/k/v), Block.proj,
+        PositionWiseFeedForward (fc1/fc2) and the classifier head (fc, classifier) """
+    names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, (models.MultiHeadedSelfAttention, models.PositionWiseFeedForward)):
+            names.update(name + '.' + n for n, m in module.named_children() if isinstance(m, nn.Linear))
+        elif isinstance(module, models.Block):
+            names.add(name + '.proj')
+    names.update(['fc', 'classifier'])
+    return names
+
+
+def quantize_classifier(model):
+    "int8 dynamic quantization (weights int8, activations quantized on the fly)"
+    model = model.cpu().eval()
+    return torch.quantization.quantize_dynamic(model, quantizable_layers(model), dtype=torch.qint8)
+
+
+def save_quantized(model, file):
+    torch.save(model.state_dict(), file)
+
+
+def load_quantized(model_cfg, file, num_labels):
+    "rebuild the quantized module structure and load an artifact saved by save_quantized"
+    model = quantize_classifier(models.Classifier(configuration.model.from_json(model_cfg), num_labels))
+    model.load_state_dict(torch.load(file, map_location='cpu'))
+    return model
+
+
+def evaluate(model, dataset, batch_size):
+    "accuracy and seconds spent in the forward"
+    loader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    correct, total, elapsed = 0, 0, 0.
+    with torch.no_grad():
+        for input_ids, segment_ids, input_mask, label_ids in loader:
+            start = time.time()
+            logits = model(input_ids, segment_ids, input_mask)
+            elapsed += time.time() - start
+            correct += (logits.argmax(-1) == label_ids).sum().item()
+            total += label_ids.size(0)
+    return correct / total, elapsed
+
+
+def dev_dataset(task, cfg):
+    from dataset import DataSet
+    data_cfg = argparse.Namespace(
+        task=task, data_seed=cfg.data_seed, dev_cap=cfg.dev_cap,
+        train_cap=1, unsup_cap=-1, uda_mode=False    # the train split is not used here
+    )
+    _, val_dataset, _ = DataSet(data_cfg).get_dataset()
+    return val_dataset
+
+
+def main(cfg):
+    if cfg.threads > 0:
+        torch.set_num_threads(cfg.threads)
+
+    model = load_classifier('custom', cfg.model_cfg, cfg.model_file, cfg.num_labels)
+    q_model = quantize_classifier(load_classifier('custom', cfg.model_cfg, cfg.model_file, cfg.num_labels))
+    if cfg.quantized_file:
+        save_quantized(q_model, cfg.quantized_file)
+        q_model = load_quantized(cfg.model_cfg, cfg.quantized_file, cfg.num_labels)
+        print('Saved the quantized model to', cfg.quantized_file)
+
+    print('%-6s %8s %8s %8s %9s %9s %8s' % ('task', 'fp32', 'int8', 'delta', 'fp32(s)', 'int8(s)', 'speedup'))
+    for task in [t for t in cfg.tasks.split(',') if t]:
+        dataset = dev_dataset(task, cfg)
+        acc, t = evaluate(model, dataset, cfg.eval_batch_size)
+        q_acc, q_t = evaluate(q_model, dataset, cfg.eval_batch_size)
+        print('%-6s %8.4f %8.4f %+8.4f %9.2f %9.2f %7.2fx' % (task, acc, q_acc, q_acc - acc, t, q_t, t / q_t))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,117 @@
+""" HTTP (TCP or Unix socket) server for trained classifiers
+
+    POST /predict  {"texts": ["...", ...]}  ->  {"predictions": [{"label": 1, "probs": [..]}, ...]}
+    GET  /stats                             ->  p50/p99 latency, throughput and cache counters
+"""
+import os
+import json
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from inference import load_classifier, TextEncoder, DynamicBatcher
+from utils.vocab import VocabMap
+
+parser = argparse.ArgumentParser(description='Classifier inference server')
+parser.add_argument('--model', default='custom', type=str)
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--model_file', default='', type=str)
+parser.add_argument('--vocab', default='BERT_Base_Uncased/vocab.txt', type=str)
+parser.add_argument('--vocab_map', default='', type=str)     # task vocab of prune_vocab.py (with its model_cfg)
+parser.add_argument('--do_lower_case', default=True, type=bool)
+parser.add_argument('--num_labels', default=2, type=int)
+parser.add_argument('--max_seq_length', default=128, type=int)
+
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8000, type=int)
+parser.add_argument('--unix_socket', default='', type=str)
+parser.add_argument('--max_batch_size', default=32, type=int)
+parser.add_argument('--max_wait_ms', default=5, type=float)
+parser.add_argument('--cache_size', default=10000, type=int)
+parser.add_argument('--threads', default=0, type=int)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_handler(encoder, batcher, pool):
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            return str(self.client_address or 'unix')
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, batcher.stats.summary())
+            else:
+                self._reply(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._reply(404, {'error': 'unknown path'})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                texts = body['texts'] if 'texts' in body else [body['text']]
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, {'error': 'bad request : %s' % e})
+
+            # every sentence is queued separately so it can share a batch with other clients
+            probs = list(pool.map(lambda t: batcher.predict(encoder(t)), texts))
+            self._reply(200, {'predictions': [
+                {'label': max(range(len(p)), key=p.__getitem__), 'probs': p} for p in probs
+            ]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(cfg):
+    if cfg.threads > 0:
+        torch.set_num_threads(cfg.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    model = load_classifier(cfg.model, cfg.model_cfg, cfg.model_file, cfg.num_labels, device)
+    vocab_map = VocabMap.load(cfg.vocab_map) if cfg.vocab_map else None
+    encoder = TextEncoder(cfg.vocab, cfg.max_seq_length, cfg.do_lower_case, vocab_map)
+    batcher = DynamicBatcher(
+        model, cfg.model, device,
+        max_batch_size=cfg.max_batch_size,
+        max_wait_ms=cfg.max_wait_ms,
+        cache_size=cfg.cache_size
+    )
+    pool = ThreadPoolExecutor(max_workers=cfg.max_batch_size)
+    handler = make_handler(encoder, batcher, pool)
+
+    if cfg.unix_socket:
+        if os.path.exists(cfg.unix_socket):
+            os.remove(cfg.unix_socket)
+        server = ThreadingUnixHTTPServer(cfg.unix_socket, handler)
+        print('Serving on unix socket', cfg.unix_socket)
+    else:
+        server = ThreadingHTTPServer((cfg.host, cfg.port), handler)
+        print('Serving on http://%s:%d' % (cfg.host, cfg.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary()))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
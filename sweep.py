@@ -0,0 +1,147 @@
+""" Concurrent hyperparameter sweep over main.py configs
+
+    python sweep.py --configs config/uda_3_*.json --concurrency 4 --threads_per_trial 2 --total_steps 2000
+
+    Each config json overrides main.py flags (arguments sweep.py does not know are passed to every trial).
+    Datasets and pretrained weights are loaded once into shared memory and handed to the trials,
+    which only allocate their own model, optimizer and batches.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+parser = argparse.ArgumentParser(description='Concurrent sweep over main.py configs')
+parser.add_argument('--configs', nargs='+', required=True)
+parser.add_argument('--concurrency', default=2, type=int)
+parser.add_argument('--threads_per_trial', default=0, type=int)    # 0 : cpu_count // concurrency
+parser.add_argument('--sweep_dir', default='sweep', type=str)       # trials write to results/<sweep_dir>/<config>
+parser.add_argument('--summary_file', default='', type=str)
+
+# DataSet.get_dataset only depends on these flags
+DATA_KEYS = ('task', 'data_seed', 'train_cap', 'dev_cap', 'unsup_cap', 'uda_mode')
+
+
+def trial_configs(cfg, main_args):
+    import main
+    trials = {}
+    for file in cfg.configs:
+        trial = main.parser.parse_args(main_args)
+        with open(file) as f:
+            for k, v in json.load(f).items():
+                if hasattr(trial, k):     # keys main.py has no flag for (e.g. n_sup) are ignored
+                    setattr(trial, k, v)
+        name = os.path.splitext(os.path.basename(file))[0]
+        trial.results_dir = os.path.join(cfg.sweep_dir, name)
+        trial.hide_tqdm = True
+        trials[name] = trial
+    return trials
+
+
+def share(tensors):
+    for t in tensors:
+        t.share_memory_()
+
+
+def load_shared_datasets(trials):
+    "one (train, val, unsup) per distinct DATA_KEYS, tensors moved to shared memory"
+    from dataset import DataSet
+    datasets = {}
+    for trial in trials.values():
+        key = tuple(getattr(trial, k) for k in DATA_KEYS)
+        if key not in datasets:
+            print('Loading dataset', dict(zip(DATA_KEYS, key)))
+            splits = DataSet(trial).get_dataset()
+            for split in splits:
+                if split:
+                    share(split.tensors)
+            datasets[key] = splits
+    return datasets
+
+
+def load_shared_pretrained(trials):
+    "transformer weights per distinct (model_cfg, pretrain_file), in shared memory"
+    import models
+    from train import load_pretrained
+    from utils import configuration
+    weights = {}
+    for trial in trials.values():
+        key = (trial.model_cfg, trial.pretrain_file)
+        if trial.model != 'custom' or not trial.pretrain_file or key in weights:
+            continue
+        transformer = models.Transformer(configuration.model.from_json(trial.model_cfg))
+        load_pretrained(transformer, trial.pretrain_file)
+        state = transformer.state_dict()
+        share(state.values())
+        weights[key] = state
+    return weights
+
+
+def run_trial(name, trial, datasets, pretrained, threads, log_file):
+    "one trial in its own process : the shared tensors arrive as handles, not copies"
+    sys.stdout = sys.stderr = open(log_file, 'w', buffering=1)
+    torch.set_num_threads(threads)
+    import main
+    main.cfg = trial
+    start = time.time()
+    try:
+        result = main.main(datasets, pretrained) or {}
+    except Exception:
+        traceback.print_exc()
+        result = {'error': traceback.format_exc().strip().splitlines()[-1]}
+    result['time'] = time.time() - start
+    return name, result
+
+
+def main(cfg, main_args):
+    trials = trial_configs(cfg, main_args)
+    datasets = load_shared_datasets(trials)
+    weights = load_shared_pretrained(trials)
+
+    threads = cfg.threads_per_trial or max(1, (os.cpu_count() or 1) // cfg.concurrency)
+    log_dir = os.path.join('results', cfg.sweep_dir + '_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    print('%d trials, %d at a time, %d threads each' % (len(trials), cfg.concurrency, threads))
+
+    # fresh process per trial (maxtasksperchild=1), the pool only bounds the concurrency
+    pool = mp.get_context('spawn').Pool(cfg.concurrency, maxtasksperchild=1)
+    jobs = [
+        pool.apply_async(run_trial, (
+            name, trial,
+            datasets[tuple(getattr(trial, k) for k in DATA_KEYS)],
+            weights.get((trial.model_cfg, trial.pretrain_file)),
+            threads, os.path.join(log_dir, name + '.log')
+        ))
+        for name, trial in trials.items()
+    ]
+    pool.close()
+
+    results = {}
+    for job in jobs:
+        name, result = job.get()
+        results[name] = result
+        print('finished', name, json.dumps(result))
+    pool.join()
+
+    print('\n%-24s %8s %8s %10s %9s' % ('config', 'max_acc', 'step', 'val_loss', 'time(s)'))
+    for name, r in sorted(results.items(), key=lambda x: -x[1].get('max_acc', -1)):
+        if 'error' in r:
+            print('%-24s failed : %s' % (name, r['error']))
+        else:
+            print('%-24s %8.4f %8d %10.4f %9.0f' % (
+                name, r.get('max_acc', float('nan')), r.get('max_acc_step', -1), r.get('val_loss', float('nan')), r['time']))
+
+    summary_file = cfg.summary_file or os.path.join(log_dir, 'summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved the summary to', summary_file)
+    return results
+
+
+if __name__ == '__main__':
+    main(*parser.parse_known_args())
@@ -28,14 +28,46 @@ from logger import *
 import torch
 import torch.nn as nn
 from torch.nn import CrossEntropyLoss
+from torch.utils.data import DataLoader, SequentialSampler
 
+import models
 from utils import checkpoint
+from utils.compiled import CompiledClassifier, set_compile_cache
+from utils.distributed import is_main_process, broadcast_flag, wrap_ddp
+from utils.profiler import StepProfiler
+from utils.memory import MemoryReport
 # from utils.logger import Logger
-from tensorboardX import SummaryWriter
-from utils.utils import output_logging, bin_accuracy, multi_accuracy, AverageMeterSet
+from utils.metrics import MetricsSink
+from utils.utils import output_logging, bin_accuracy, multi_accuracy, DeviceMeterSet
 import pdb
 
 
+def precompute_logits(model, dataset, batch_size, device, columns=(0, 1, 2)):
+    """ run model once over the whole dataset (in order) and keep its logits on the host
+        columns : positions of input_ids, segment_ids, input_mask in a dataset item """
+    model = model.to(device).eval()
+    loader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+    logits = []
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='Teacher logits'):
+            input_ids, segment_ids, input_mask = (batch[c].to(device) for c in columns)
+            logits.append(model(input_ids, segment_ids, input_mask).float().cpu())
+    return torch.cat(logits)
+
+
+def load_pretrained(transformer, pretrain_file):
+    """ load a tensorflow (.ckpt) or pytorch (.pt) pretrained checkpoint into models.Transformer """
+    print('Loading the pretrained model from', pretrain_file)
+    if pretrain_file.endswith('.ckpt'):  # checkpoint file in tensorflow
+        checkpoint.load_model(transformer, pretrain_file)
+    elif pretrain_file.endswith('.pt'):  # pretrain model file in pytorch
+        transformer.load_state_dict(
+            {key[12:]: value
+                for key, value in torch.load(pretrain_file).items()
+                if key.startswith('transformer')}
+        )   # load only transformer parts
+
+
 class Trainer(object):
     """Training Helper class"""
     def __init__(self, cfg, model, data_iter, optimizer, device, ema_model, ema_optimizer):
@@ -45,6 +77,7 @@ class Trainer(object):
         self.device = device
         self.ema_model = ema_model
         self.ema_optimizer = ema_optimizer
+        self.max_acc = None     # (acc, step, val_loss, train_loss) of the best check after train()
 
         # data iter
         if len(data_iter) == 1:
@@ -59,6 +92,15 @@ class Trainer(object):
             self.eval_iter = data_iter[2]
 
     def train(self, get_loss, get_acc, model_file, pretrain_file):
+        "train, the metrics sink is flushed and closed however training ends"
+        self.writer = None
+        try:
+            return self._train(get_loss, get_acc, model_file, pretrain_file)
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+
+    def _train(self, get_loss, get_acc, model_file, pretrain_file):
 
         if self.cfg.uda_mode or self.cfg.mixmatch_mode:
             ssl_mode = True
@@ -66,13 +108,17 @@ class Trainer(object):
             ssl_mode = False
         """ train uda"""
 
+        # only rank 0 logs, saves and decides early stopping in distributed mode
+        is_main = is_main_process()
+
         # tensorboardX logging
-        if self.cfg.results_dir:
+        if self.cfg.results_dir and is_main:
             dir = os.path.join('results', self.cfg.results_dir)
             if os.path.exists(dir) and os.path.isdir(dir):
                 shutil.rmtree(dir)
 
-            writer = SummaryWriter(log_dir=dir)
+            # scalars are queued and written by a background thread, flushed at close / exit
+            writer = self.writer = MetricsSink(dir, self.cfg.metrics_formats.split(','), self.cfg.metrics_flush_secs)
 
             #logger_path = dir + 'log.txt'
             #logger = Logger(logger_path, title='uda')
@@ -81,7 +127,7 @@ class Trainer(object):
             #else:
             #    logger.set_names(['Train Loss', 'Train Loss X', 'Train Loss U', 'Train Loss W U', 'Valid Acc', 'Valid Loss', 'LR'])
             
-        meters = AverageMeterSet()
+        meters = DeviceMeterSet()     # loss sums stay on the device, read back at the checks
 
         self.model.train()
 
@@ -91,7 +137,20 @@ class Trainer(object):
         model = self.model.to(self.device)
         ema_model = self.ema_model.to(self.device) if self.ema_model else None
 
-        if self.cfg.data_parallel:                       # Parallel GPU mode
+        # --memory_report : hooks on the unwrapped model, report of the first memory_steps steps
+        memory = MemoryReport(
+            self.cfg, self.model, self.optimizer, self.device,
+            os.path.join('results', self.cfg.results_dir or '', 'memory.json') if is_main else None
+        )
+
+        compiled = None
+        if self.cfg.compile and self.cfg.model == "custom":    # compiled forward/backward per length bucket
+            set_compile_cache(self.cfg.compile_cache)
+            model = compiled = CompiledClassifier(model, self.cfg.compile_buckets)
+
+        if self.cfg.distributed:                         # one process per rank, gradients all-reduced
+            model = wrap_ddp(model)
+        elif self.cfg.data_parallel:                     # Parallel GPU mode
             model = nn.DataParallel(model)
             ema_model = nn.DataParallel(ema_model) if ema_model else None
 
@@ -106,64 +165,96 @@ class Trainer(object):
         # Progress bar is set by unsup or sup data
         # uda_mode == True --> sup_iter is repeated
         # uda_mode == False --> sup_iter is not repeated
-        iter_bar = tqdm(self.unsup_iter, total=self.cfg.total_steps, disable=self.cfg.hide_tqdm) if ssl_mode \
-              else tqdm(self.sup_iter, total=self.cfg.total_steps, disable=self.cfg.hide_tqdm)
+        hide_tqdm = self.cfg.hide_tqdm or not is_main
+        iter_bar = tqdm(self.unsup_iter, total=self.cfg.total_steps, disable=hide_tqdm) if ssl_mode \
+              else tqdm(self.sup_iter, total=self.cfg.total_steps, disable=hide_tqdm)
+
+        # --profile / --profile_steps : phase timers and torch.profiler window (no-ops otherwise)
+        profiler = StepProfiler(self.cfg, self.device, os.path.join('results', self.cfg.results_dir or '', 'trace'))
 
         start = time.time()
+        check_start = start
+        desc_time = 0.
 
         for i, batch in enumerate(iter_bar):
             # Device assignment
             if ssl_mode:
-                sup_batch = [t.to(self.device) for t in next(self.sup_iter)]
-                unsup_batch = [t.to(self.device) for t in batch]
-
-                unsup_batch_size = unsup_batch_size or unsup_batch[0].shape[0]
-
-                if unsup_batch[0].shape[0] != unsup_batch_size:
+                sup_host = next(self.sup_iter)     # timed by step_begin, with the unsup fetch
+                if batch[0].shape[0] != (unsup_batch_size or batch[0].shape[0]):
                     continue
+                unsup_batch_size = batch[0].shape[0]
+
+                profiler.step_begin(global_step + 1, (sup_host[0], batch[0], batch[3]) if profiler.enabled else ())
+                with profiler.phase('h2d'):
+                    sup_batch = [t.to(self.device) for t in sup_host]
+                    unsup_batch = [t.to(self.device) for t in batch]
             else:
-                sup_batch = [t.to(self.device) for t in batch]
+                profiler.step_begin(global_step + 1, (batch[0],) if profiler.enabled else ())
+                with profiler.phase('h2d'):
+                    sup_batch = [t.to(self.device) for t in batch]
                 unsup_batch = None
 
+            if compiled is not None:    # bucket of the step from the host num_tokens columns, no device sync
+                num_tokens = (sup_host[4], batch[6], batch[7]) if ssl_mode else (batch[4],)
+                compiled.n_tokens = max(int(t.max()) for t in num_tokens)
+
             # update
-            self.optimizer.zero_grad()
-            final_loss, sup_loss, unsup_loss, weighted_unsup_loss = get_loss(model, sup_batch, unsup_batch, global_step)
+            memory.step_begin()
+            with profiler.phase('optimizer'):
+                self.optimizer.zero_grad()
+            with profiler.phase('forward'):
+                outputs = get_loss(model, sup_batch, unsup_batch, global_step)
+            final_loss, sup_loss, unsup_loss, weighted_unsup_loss = outputs[:4]
+            extras = outputs[4] if len(outputs) > 4 else {}    # optional per-step statistics of the loss
 
             if self.cfg.no_sup_loss:
                 final_loss = unsup_loss
             elif self.cfg.no_unsup_loss:
                 final_loss = sup_loss
 
-            meters.update('train_loss', final_loss.item())
-            meters.update('sup_loss', sup_loss.item())
-            meters.update('unsup_loss', unsup_loss.item())
-            meters.update('w_unsup_loss', weighted_unsup_loss.item())
+            meters.update('train_loss', final_loss)
+            meters.update('sup_loss', sup_loss)
+            meters.update('unsup_loss', unsup_loss)
+            meters.update('w_unsup_loss', weighted_unsup_loss)
             meters.update('lr', self.optimizer.get_lr()[0])
+            for k, v in extras.items():
+                meters.update(k, v)
 
-            final_loss.backward()
-            self.optimizer.step()
+            with profiler.phase('backward'):
+                final_loss.backward()
+            with profiler.phase('optimizer'):
+                self.optimizer.step()
 
             if self.ema_optimizer:
-                self.ema_optimizer.step()
+                with profiler.phase('ema'):
+                    self.ema_optimizer.step()
+            memory.step_end(global_step + 1)
 
             # print loss
             global_step += 1
-            loss_sum += final_loss.item()
-            if not self.cfg.hide_tqdm:
+            loss_sum += final_loss.detach()
+            if not hide_tqdm and time.time() - desc_time >= 1.:     # the losses are read back once a second
+                desc_time = time.time()
                 if ssl_mode:
                     iter_bar.set_description('final=%5.3f unsup=%5.3f sup=%5.3f'\
                             % (final_loss.item(), unsup_loss.item(), sup_loss.item()))
                 else:
                     iter_bar.set_description('loss=%5.3f' % (final_loss.item()))
 
-            if global_step % self.cfg.save_steps == 0:
-                self.save(global_step)
+            if global_step % self.cfg.save_steps == 0 and is_main:
+                with profiler.phase('save'):
+                    self.save(global_step)
 
-            if get_acc and global_step % self.cfg.check_steps == 0 and global_step > self.cfg.check_after:
-                if self.cfg.mixmatch_mode:
-                    results = self.eval(get_acc, None, ema_model)
-                else:
-                    total_accuracy, avg_val_loss = self.validate()
+            check = get_acc and global_step % self.cfg.check_steps == 0 and global_step > self.cfg.check_after
+            stop = False
+            if check and is_main:
+                with profiler.phase('validate'):
+                    self.apply_deferred_decay()
+                    if self.ema_optimizer:      # evaluate the averaged weights
+                        with self.ema_optimizer.average_parameters():
+                            total_accuracy, avg_val_loss = self.validate()
+                    else:
+                        total_accuracy, avg_val_loss = self.validate()
 
                 # logging
                 writer.add_scalars('data/eval_acc', {'eval_acc' : total_accuracy}, global_step)
@@ -178,11 +269,18 @@ class Trainer(object):
                     writer.add_scalars('data/unsup_loss', {'unsup_loss': meters['unsup_loss'].avg}, global_step)
                     writer.add_scalars('data/w_unsup_loss', {'w_unsup_loss': meters['w_unsup_loss'].avg}, global_step)
                     writer.add_scalars('data/lr', {'lr': meters['lr'].avg}, global_step)
+                elapsed = time.time() - check_start
+                for k in extras:
+                    writer.add_scalars('data/' + k, {k: meters[k].avg}, global_step)
+                    if k.startswith('n_'):     # counts : effective examples / sec since the last check
+                        writer.add_scalars('data/' + k + '_per_sec', {k + '_per_sec': meters[k].sum / elapsed}, global_step)
+                check_start = time.time()
 
                 meters.reset()
 
                 if max_acc[0] < total_accuracy:
-                    self.save(global_step)
+                    with profiler.phase('save'):
+                        self.save(global_step)
                     max_acc = total_accuracy, global_step, avg_val_loss, final_loss.item()
                     no_improvement = 0
                 else:
@@ -201,20 +299,32 @@ class Trainer(object):
                     %(max_acc[0], max_acc[2], max_acc[3], max_acc[1], global_step), end='\n\n'
                 )
                 
-                if no_improvement == self.cfg.early_stopping:
+                stop = no_improvement == self.cfg.early_stopping
+
+            profiler.step_end(global_step)
+            if profiler.enabled and is_main and global_step % self.cfg.check_steps == 0:
+                profiler.log(writer, global_step)
+
+            if check and broadcast_flag(stop):     # the decision of rank 0 on every rank
+                if is_main:
                     print("Early stopped")
                     total_time = time.time() - start
                     print('Total Training Time: %d' %(total_time), end='\n')
-                    break
+                break
 
 
             if self.cfg.total_steps and self.cfg.total_steps < global_step:
+                profiler.close()
                 print('The total steps have been reached')
                 total_time = time.time() - start
                 print('Total Training Time: %d' %(total_time), end='\n') 
+                if not is_main:
+                    return
                 if get_acc:
-                    if self.cfg.mixmatch_mode:
-                        results = self.eval(get_acc, None, ema_model)
+                    self.apply_deferred_decay()
+                    if self.ema_optimizer:      # evaluate the averaged weights
+                        with self.ema_optimizer.average_parameters():
+                            total_accuracy, avg_val_loss = self.validate()
                     else:
                         total_accuracy, avg_val_loss = self.validate()
                     if max_acc[0] < total_accuracy:
@@ -224,8 +334,10 @@ class Trainer(object):
                     print("  Train Loss: {0:.2f}".format(final_loss.item()))
                     print('Max Accuracy : %5.3f Best Val Loss :  %5.3f Best Train Loss :  %5.3f Max global_steps : %d Cur global_steps : %d' %(max_acc[0], max_acc[2], max_acc[3], max_acc[1], global_step), end='\n\n')
                 self.save(global_step)
+                self.max_acc = max_acc
                 return
-        writer.close()
+        profiler.close()
+        self.max_acc = max_acc
         return global_step
 
 
@@ -323,30 +435,52 @@ class Trainer(object):
         if model_file:
             print('Loading the model from', model_file)
             if torch.cuda.is_available():
-                self.model.load_state_dict(torch.load(model_file))
+                state_dict = torch.load(model_file)
             else:
-                self.model.load_state_dict(torch.load(model_file, map_location='cpu'))
+                state_dict = torch.load(model_file, map_location='cpu')
+            self.fit_to_state_dict(state_dict)
+            self.model.load_state_dict(state_dict)
 
         elif pretrain_file:
-            print('Loading the pretrained model from', pretrain_file)
-            if pretrain_file.endswith('.ckpt'):  # checkpoint file in tensorflow
-                checkpoint.load_model(self.model.transformer, pretrain_file)
-            elif pretrain_file.endswith('.pt'):  # pretrain model file in pytorch
-                self.model.transformer.load_state_dict(
-                    {key[12:]: value
-                        for key, value in torch.load(pretrain_file).items()
-                        if key.startswith('transformer')}
-                )   # load only transformer parts
+            load_pretrained(self.model.transformer, pretrain_file)
     
+    def fit_to_state_dict(self, state_dict):
+        """ pruned checkpoint (prune.py) : shrink the model to its shapes, the optimizer and the ema
+            shadow weights are rebound to the new parameters """
+        names = {p: n for n, p in self.model.named_parameters()}
+        if not models.fit_to_state_dict(self.model, state_dict):
+            return
+        print('Pruned checkpoint, the heads / neurons of the model are shrunk to it')
+        params = dict(self.model.named_parameters())
+        for group in self.optimizer.param_groups:
+            group['params'] = [params[names[p]] for p in group['params']]
+        self.optimizer.state.clear()
+        if self.ema_optimizer:
+            self.ema_optimizer.reset()
+
+    def apply_deferred_decay(self):
+        "--lazy_embedding : weight decay of the embedding rows BertAdam skipped, before evaluating / saving"
+        if hasattr(self.optimizer, 'apply_deferred_decay'):
+            self.optimizer.apply_deferred_decay()
+
     def save(self, i):
         """ save model """
+        self.apply_deferred_decay()
         if not os.path.isdir(os.path.join('results', self.cfg.results_dir, 'save')):
             os.makedirs(os.path.join('results', self.cfg.results_dir, 'save'))
-        torch.save(self.model.state_dict(),
-                        os.path.join('results', self.cfg.results_dir, 'save', 'model_steps_'+str(i)+'.pt'))
+        file = os.path.join('results', self.cfg.results_dir, 'save', 'model_steps_'+str(i)+'.pt')
+        if self.ema_optimizer:      # the averaged weights are the evaluated ones
+            with self.ema_optimizer.average_parameters():
+                torch.save(self.model.state_dict(), file)
+        else:
+            torch.save(self.model.state_dict(), file)
 
     def repeat_dataloader(self, iterable):
         """ repeat dataloader """
+        epoch = 0
         while True:
+            if hasattr(iterable.sampler, 'set_epoch'):  # DistributedSampler : new shuffle per epoch
+                iterable.sampler.set_epoch(epoch)
             for x in iterable:
-                yield x
\ No newline at end of file
+                yield x
+            epoch += 1
\ No newline at end of file
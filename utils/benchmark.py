@@ -0,0 +1,387 @@
+""" CPU benchmark suite of the hot paths, on synthetic data and a small model config
+
+    python -m utils.benchmark                                   # -> results/benchmark_<commit>.json
+    python -m utils.benchmark --only classifier,loss --repeat 20
+    python -m utils.benchmark --compare results/benchmark_a.json results/benchmark_b.json
+    python -m utils.benchmark --compare results/benchmark_a.json  # run now, compare with a
+
+    Every case is run --warmup_runs times, then timed --repeat times (median and min in ms).
+    Cases whose dependencies are missing (transformers for the HF tokenizer and dataset.py) are
+    recorded as skipped, cases that raise are recorded with their error.
+    --compare flags the cases whose median is slower by more than --threshold and exits with 1.
+"""
+import io
+import os
+import ast
+import sys
+import json
+import time
+import random
+import inspect
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, TensorDataset, SequentialSampler
+
+import models
+from utils.optim import BertAdam, optim4GPU
+from utils.utils import simple_pad, pad_for_word_mixup
+from utils.pad_benchmark import random_batch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Benchmark suite of the hot paths')
+parser.add_argument('--out', default='', type=str)              # default : results/benchmark_<commit>.json
+parser.add_argument('--compare', nargs='+', default=None)       # old.json [new.json]
+parser.add_argument('--threshold', default=0.1, type=float)     # slower by more than 10% : regression
+parser.add_argument('--only', default='', type=str)             # comma separated name prefixes
+parser.add_argument('--repeat', default=10, type=int)
+parser.add_argument('--warmup_runs', default=2, type=int)
+parser.add_argument('--threads', default=0, type=int)           # 0 : torch default
+parser.add_argument('--model_cfg', default='', type=str)        # default : SMALL
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--seq_lens', default='64,128,256', type=str)
+
+SMALL = models.Config(vocab_size=30522, dim=128, n_layers=2, n_heads=4, dim_ff=512, max_len=512)
+
+# main.py loss closures and the batch layout of each loss (default : plain)
+MAIN_LOSSES = ('get_sup_loss', 'get_loss_ict', 'get_distill_loss')
+LOSS_BATCHES = {
+    'get_sup_loss': 'tokens', 'get_loss_ict': 'tokens', 'get_label_guess_loss': 'tokens',
+    'get_loss_mixup': 'tokens', 'get_distill_loss': 'distill',
+}
+
+
+def measure(fn, repeat, warmup_runs, min_sample_ms=10.):
+    """ median / min wall time of fn() in ms, prints of the timed code are dropped.
+        fast cases are called several times per sample (at least min_sample_ms) to keep the timer noise out """
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(max(1, warmup_runs)):
+            fn()
+        first_ms = (time.perf_counter() - start) * 1000 / max(1, warmup_runs)
+        number = max(1, int(min_sample_ms / max(first_ms, 1e-3)))
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) * 1000 / number)
+    return {'median_ms': statistics.median(times), 'min_ms': min(times), 'runs': repeat * number}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def model_config(cfg):
+    return models.Config.from_json(cfg.model_cfg) if cfg.model_cfg else SMALL
+
+
+def classifier(cfg, train=True):
+    torch.manual_seed(0)
+    model = models.Classifier(model_config(cfg), 2)
+    return model.train(train)
+
+
+def sup_batch(batch_size, seq_len, layout='plain'):
+    input_ids, input_mask, num_tokens = random_batch(batch_size, seq_len)
+    batch = [input_ids, torch.zeros_like(input_ids), input_mask, torch.randint(0, 2, (batch_size,))]
+    if layout != 'plain':
+        batch.append(num_tokens)
+    if layout == 'distill':
+        batch.append(torch.randn(batch_size, 2))
+    return batch
+
+
+def unsup_batch(batch_size, seq_len, layout='plain'):
+    ori_ids, ori_mask, ori_num_tokens = random_batch(batch_size, seq_len)
+    aug_ids, aug_mask, aug_num_tokens = random_batch(batch_size, seq_len)
+    batch = [ori_ids, torch.zeros_like(ori_ids), ori_mask, aug_ids, torch.zeros_like(aug_ids), aug_mask]
+    if layout != 'plain':
+        batch += [ori_num_tokens, aug_num_tokens]
+    if layout == 'distill':
+        batch.append(torch.randn(batch_size, 2))
+    return batch
+
+
+def sentences(n, rng):
+    words = ['movie', 'film', 'plot', 'actor', 'great', 'boring', 'scene', 'story', 'unbelievably',
+             'overacted', 'cinematography', 'the', 'a', 'was', 'and', 'but', 'not', '!', ',', '.']
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(20, 200))) for _ in range(n)]
+
+
+def write_vocab(path):
+    "special tokens, words and wordpieces covering sentences() (some words only split into pieces)"
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'movie', 'film', 'plot', 'actor', 'great',
+             'boring', 'scene', 'story', 'the', 'a', 'was', 'and', 'but', 'not', '!', ',', '.',
+             'un', '##believ', '##ably', 'over', '##act', '##ed', 'cinema', '##to', '##graphy']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(vocab) + '\n')
+
+
+def write_tsv(path, n, seq_len, d_type):
+    "preprocessed tsv with the column names read by both CsvDataset and DataSet.retrieve_tensors"
+    import pandas as pd
+    columns = {}
+    prefixes = ['ori_', 'aug_'] if d_type == 'unsup' else ['']
+    for prefix in prefixes:
+        input_ids, input_mask, _ = random_batch(n, seq_len)
+        columns[prefix + 'input_ids'] = [str(r) for r in input_ids.tolist()]
+        columns[prefix + 'input_type_ids'] = [str([0] * seq_len)] * n
+        columns[prefix + 'input_mask'] = [str(r) for r in input_mask.tolist()]
+    if d_type == 'sup':
+        columns['label_ids'] = columns['label'] = torch.randint(0, 2, (n,)).tolist()
+    pd.DataFrame(columns).to_csv(path, sep='\t', index=False)
+
+
+def tokenize_cases(cfg, tmp):
+    rng = random.Random(0)
+    texts = sentences(256, rng)
+    vocab_file = os.path.join(tmp, 'vocab.txt')
+    write_vocab(vocab_file)
+
+    from utils.tokenization import FullTokenizer
+    tokenizer = FullTokenizer(vocab_file, do_lower_case=True)
+    yield 'tokenize/full', lambda: [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(t)) for t in texts]
+
+    from transformers import BertTokenizer
+    hf_tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+
+    def hf_encode():    # the DataSet.preprocess path : tokenize, keep the tail, encode_plus
+        for t in texts:
+            tokens = hf_tokenizer.tokenize(t)[-126:]
+            hf_tokenizer.encode_plus(tokens, add_special_tokens=True, max_length=128, padding='max_length',
+                                     truncation=True, return_attention_mask=True, return_tensors='pt')
+    yield 'tokenize/hf', hf_encode
+
+
+def data_cases(cfg, tmp):
+    import pandas as pd
+    from load_data import CsvDataset
+    files = {}
+    for d_type in ('sup', 'unsup'):
+        files[d_type] = os.path.join(tmp, d_type + '.tsv')
+        write_tsv(files[d_type], 512, 128, d_type)
+        yield 'data/csv_dataset_' + d_type, \
+            lambda d_type=d_type: CsvDataset(files[d_type], False, [], 128, 'train', d_type)
+
+    dataset = TensorDataset(*sup_batch(1024, 128, 'tokens'))
+    loader = DataLoader(dataset, batch_size=32, shuffle=True)
+    yield 'data/collate_b32', lambda: [batch for batch in loader]
+
+    from dataset import DataSet
+    data = DataSet.__new__(DataSet)     # retrieve_tensors does not use the tokenizer
+    frames = {d_type: pd.read_csv(f, sep='\t') for d_type, f in files.items()}
+    for d_type in ('sup', 'unsup'):
+        yield 'data/retrieve_tensors_' + d_type, lambda d_type=d_type: data.retrieve_tensors(frames[d_type], d_type)
+
+
+def classifier_cases(cfg, tmp):
+    model = classifier(cfg)
+    for seq_len in [int(s) for s in cfg.seq_lens.split(',')]:
+        input_ids, segment_ids, input_mask, labels = sup_batch(cfg.batch_size, seq_len)
+
+        def step():
+            model.zero_grad()
+            F.cross_entropy(model(input_ids, segment_ids, input_mask), labels).backward()
+        yield 'classifier/fwd_bwd/seq%d' % seq_len, step
+
+
+def loss_functions(loss_cfg):
+    """ the loss functions of losses.py and the loss closures of main.main, built in a namespace
+        with main.py's globals and the criteria main() creates """
+    import main
+    import torch.nn as nn
+    ns = dict(vars(main))
+    ns.update(
+        cfg=loss_cfg, teacher_cache=None, train_criterion=main.SemiLoss(),
+        sup_criterion=nn.CrossEntropyLoss(reduction='none'), unsup_criterion=nn.KLDivLoss(reduction='none'),
+    )
+    path = os.path.join(ROOT, 'losses.py')
+    losses = dict(ns)
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), losses)
+    functions = {
+        'losses.' + k: v for k, v in losses.items()
+        if inspect.isfunction(v) and v.__code__.co_filename == path and k.startswith(('get_', 'mixmatch_'))
+    }
+
+    # main() closures : compile their defs out of main.main's source
+    tree = ast.parse(inspect.getsource(main.main))
+    for node in tree.body[0].body:
+        if isinstance(node, ast.FunctionDef) and node.name in MAIN_LOSSES:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), main.__file__, 'exec'), ns)
+            functions['main.' + node.name] = ns[node.name]
+    return functions
+
+
+def loss_cases(cfg, tmp):
+    import main
+    loss_cfg = main.parser.parse_args([])
+    loss_cfg.total_steps = 1000
+    model = classifier(cfg)
+    for name, loss in loss_functions(loss_cfg).items():
+        layout = LOSS_BATCHES.get(name.split('.')[1], 'plain')
+        sup, unsup = sup_batch(cfg.batch_size, 128, layout), unsup_batch(cfg.batch_size, 128, layout)
+
+        def step(loss=loss, sup=sup, unsup=unsup):      # the losses pad their batches in place
+            model.zero_grad()
+            loss(model, [t.clone() for t in sup], [t.clone() for t in unsup], 100)[0].backward()
+        yield 'loss/' + name, step
+
+
+def optim_cases(cfg, tmp):
+    model = classifier(cfg)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p) * 1e-3
+    optimizer = BertAdam(model.parameters(), lr=2e-5, warmup=0.1, t_total=100000)
+    yield 'optim/bert_adam_step', optimizer.step
+    del optimizer
+
+    # tok_embed gradient on the rows of one UDA step (sup, ori and aug batches), dense vs --lazy_embedding
+    embed = model.transformer.embed.tok_embed.weight
+    rows = torch.zeros(embed.size(0), dtype=torch.bool)
+    rows[random_batch(3 * cfg.batch_size, 128)[0].unique()] = True
+    embed.grad[~rows] = 0
+    for lazy in (False, True):
+        optimizer = optim4GPU(argparse.Namespace(lr=2e-5, warmup=0.1, total_steps=100000, lazy_embedding=lazy), model)
+        yield 'optim/bert_adam_step_batch_rows' + ('_lazy' if lazy else ''), optimizer.step
+        del optimizer
+
+
+def pad_cases(cfg, tmp):
+    input_ids, input_mask, num_tokens = random_batch(32, 128)
+    idx = torch.randperm(32)
+    yield 'pad/simple_pad_b32', lambda: simple_pad(input_ids.clone(), input_mask.clone(), num_tokens)
+    yield 'pad/pad_for_word_mixup_b32', \
+        lambda: pad_for_word_mixup(input_ids.clone(), input_mask.clone(), num_tokens, idx)
+
+
+def checkpoint_cases(cfg, tmp):
+    model = classifier(cfg)
+    file = os.path.join(tmp, 'model.pt')
+    torch.save(model.state_dict(), file)
+    yield 'checkpoint/save', lambda: torch.save(model.state_dict(), file)
+    yield 'checkpoint/load', lambda: model.load_state_dict(torch.load(file, map_location='cpu'))
+
+
+def eval_cases(cfg, tmp):
+    import train
+    input_ids, segment_ids, input_mask, labels = sup_batch(128, 128)
+    val_loader = DataLoader(TensorDataset(input_ids, input_mask, segment_ids, labels),
+                            sampler=SequentialSampler(input_ids), batch_size=32)
+    trainer_cfg = argparse.Namespace(model='custom', num_labels=2, uda_mode=False, mixmatch_mode=False)
+    trainer = train.Trainer(trainer_cfg, classifier(cfg, train=False), [val_loader, val_loader],
+                            None, torch.device('cpu'), None, None)
+    yield 'eval/validate_128', trainer.validate
+
+
+GROUPS = [
+    ('tokenize', tokenize_cases), ('data', data_cases), ('classifier', classifier_cases), ('loss', loss_cases),
+    ('optim', optim_cases), ('pad', pad_cases), ('checkpoint', checkpoint_cases), ('eval', eval_cases),
+]
+
+
+def selected(name, prefixes):
+    return not prefixes or any(name.startswith(p) or p.startswith(name) for p in prefixes)
+
+
+def run(cfg):
+    if cfg.threads:
+        torch.set_num_threads(cfg.threads)
+    prefixes = [p for p in cfg.only.split(',') if p]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for group, cases in GROUPS:
+            if not selected(group, prefixes):
+                continue
+            try:
+                for name, fn in cases(cfg, tmp):
+                    if not selected(name, prefixes):
+                        continue
+                    try:
+                        results[name] = measure(fn, cfg.repeat, cfg.warmup_runs)
+                    except Exception as e:
+                        results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+                    print_result(name, results[name])
+            except ImportError as e:    # the rest of the group needs a missing package
+                results[group + '/*'] = {'skipped': str(e)}
+                print_result(group + '/*', results[group + '/*'])
+            except Exception as e:      # setup failed, the rest of the group is not run
+                results[group + '/*'] = {'error': '%s: %s' % (type(e).__name__, e)}
+                print_result(group + '/*', results[group + '/*'])
+    return {
+        'meta': {
+            'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__,
+            'python': platform.python_version(), 'threads': torch.get_num_threads(),
+            'model_cfg': model_config(cfg)._asdict(), 'batch_size': cfg.batch_size,
+        },
+        'results': results,
+    }
+
+
+def print_result(name, r):
+    if 'median_ms' in r:
+        print('%-40s %10.2f ms  (min %.2f)' % (name, r['median_ms'], r['min_ms']))
+    else:
+        print('%-40s %s' % (name, r.get('skipped') and 'skipped : ' + r['skipped'] or 'failed : ' + r['error']))
+
+
+def compare(old, new, threshold):
+    "prints old vs new medians, returns the names of the regressed cases"
+    print('\n%-40s %10s %10s %8s' % ('case (%s -> %s)' % (old['meta']['commit'], new['meta']['commit']),
+                                       'old ms', 'new ms', 'ratio'))
+    regressions = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        a, b = old['results'].get(name, {}), new['results'].get(name, {})
+        if 'median_ms' not in a or 'median_ms' not in b:
+            status = 'new' if 'median_ms' in b else 'removed' if 'median_ms' in a else 'n/a'
+            print('%-40s %10s %10s %8s  %s' % (name, '-', '-', '-', status))
+            continue
+        ratio = b['median_ms'] / a['median_ms']
+        status = ''
+        if ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        print('%-40s %10.2f %10.2f %7.2fx  %s' % (name, a['median_ms'], b['median_ms'], ratio, status))
+    if old['meta'].get('threads') != new['meta'].get('threads'):
+        print('warning : the runs used different thread counts')
+    print('%d regression(s) over %.0f%%' % (len(regressions), threshold * 100))
+    return regressions
+
+
+def main(cfg):
+    if cfg.compare and len(cfg.compare) > 2:
+        parser.error('--compare takes old.json [new.json]')
+    if cfg.compare and len(cfg.compare) == 2:
+        with open(cfg.compare[0]) as f0, open(cfg.compare[1]) as f1:
+            return compare(json.load(f0), json.load(f1), cfg.threshold)
+
+    report = run(cfg)
+    out = cfg.out or os.path.join('results', 'benchmark_%s.json' % (report['meta']['commit'] or 'local'))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved the results to', out)
+
+    if cfg.compare:
+        with open(cfg.compare[0]) as f:
+            return compare(json.load(f), report, cfg.threshold)
+    return []
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(parser.parse_args()) else 0)
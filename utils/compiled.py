@@ -0,0 +1,144 @@
+""" Compiled execution of models.Classifier over static sequence-length buckets
+
+Inputs are trimmed (or zero padded) to the smallest bucket that holds every
+real token of the batch, so the compiler only ever sees a handful of shapes.
+Padding positions are masked out in attention, which keeps the [CLS] output
+unchanged. Calls that need the mixup branches run on the eager model.
+"""
+import os
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_BUCKETS = (64, 128, 256)
+
+
+def parse_buckets(buckets):
+    "parse '64,128,256' into a sorted tuple of ints"
+    if isinstance(buckets, str):
+        buckets = [b for b in buckets.split(',') if b.strip()]
+    return tuple(sorted(int(b) for b in buckets))
+
+
+def set_compile_cache(cache_dir):
+    "keep compiled artifacts (inductor FX graph cache) in cache_dir across runs"
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except ImportError:
+        pass
+
+
+def bucket_length(input_mask, seq_len, buckets, n_tokens=None):
+    """ smallest bucket holding the longest sequence of the batch
+        n_tokens : that length known on the host (num_tokens columns), else read from input_mask (device sync) """
+    if n_tokens is None:
+        if input_mask is None:
+            return seq_len
+        n_tokens = int(input_mask.sum(-1).max())
+    for b in buckets:
+        if n_tokens <= b:
+            return b
+    return seq_len
+
+
+def fit_to_length(x, length):
+    "trim or zero pad the sequence dimension of x to length"
+    seq_len = x.size(1)
+    if length < seq_len:
+        return x[:, :length]
+    if length > seq_len:
+        return F.pad(x, (0, length - seq_len))
+    return x
+
+
+class CompiledClassifier(nn.Module):
+    """ models.Classifier wrapper running the plain forward (and its backward) compiled """
+    def __init__(self, model, buckets=DEFAULT_BUCKETS, backend='inductor'):
+        super().__init__()
+        self.module = model
+        self.buckets = parse_buckets(buckets)
+        self.compiled = None
+        self.compile_errors = ()
+        self.n_tokens = None    # longest sequence of the step, set by the trainer from the host batch
+
+        if hasattr(torch, 'compile'):
+            import torch._dynamo as dynamo      # imported here, only --compile pays for it
+            self.compile_errors = (dynamo.exc.BackendCompilerFailed, dynamo.exc.Unsupported, ImportError)
+            # one graph per (bucket, batch size, output_h)
+            dynamo.config.cache_size_limit = max(
+                dynamo.config.cache_size_limit, 8 * len(self.buckets))
+            self.compiled = torch.compile(self._plain_forward, dynamic=False, backend=backend)
+        else:
+            print('torch.compile is not available, running eager')
+
+    def _plain_forward(self, input_ids, segment_ids, input_mask, output_h):
+        return self.module(input_ids, segment_ids, input_mask, output_h=output_h)
+
+    def forward(
+            self,
+            input_ids=None,
+            segment_ids=None,
+            input_mask=None,
+            output_h=False,
+            input_h=None,
+            mixup=None,
+            **kwargs
+        ):
+        # mixup / clone ids / classifier-head-only calls stay eager
+        if self.compiled is None or input_h is not None or mixup or kwargs.get('clone_ids') is not None:
+            return self.module(
+                input_ids, segment_ids, input_mask,
+                output_h=output_h, input_h=input_h, mixup=mixup, **kwargs
+            )
+
+        length = bucket_length(input_mask, input_ids.size(1), self.buckets, self.n_tokens)
+        input_ids, segment_ids, input_mask = (
+            fit_to_length(x, length) if x is not None else None
+            for x in (input_ids, segment_ids, input_mask)
+        )
+        try:
+            return self.compiled(input_ids, segment_ids, input_mask, output_h)
+        except self.compile_errors as e:  # missing toolchain, unsupported op, ... (other errors are raised)
+            print('Compilation failed, falling back to eager:', e)
+            self.compiled = None
+            return self.module(input_ids, segment_ids, input_mask, output_h=output_h)
+
+
+def benchmark(model, compiled, batch_size=16, seq_len=128, n_tokens=50, steps=20, warmup=3):
+    "average train step time (forward + backward) of the eager and compiled model"
+    input_ids = torch.randint(1, model.transformer.embed.tok_embed.num_embeddings, (batch_size, seq_len))
+    input_mask = torch.zeros(batch_size, seq_len, dtype=torch.long)
+    input_mask[:, :n_tokens] = 1
+    input_ids = input_ids * input_mask
+    segment_ids = torch.zeros_like(input_ids)
+
+    results = {}
+    for name, m in (('eager', model), ('compiled', compiled)):
+        for i in range(warmup + steps):
+            if i == warmup:
+                start = time.time()
+            logits = m(input_ids, segment_ids, input_mask)
+            logits.sum().backward()
+        results[name] = (time.time() - start) / steps
+    return results
+
+
+if __name__ == '__main__':
+    import models
+
+    torch.manual_seed(0)
+    set_compile_cache('results/compile_cache')
+    model_cfg = models.Config(vocab_size=30522, dim=256, n_layers=4, n_heads=4, dim_ff=1024)
+    model = models.Classifier(model_cfg, 2)
+    model.train()
+    results = benchmark(model, CompiledClassifier(model))
+    print('eager    : %.1f ms/step' % (results['eager'] * 1000))
+    print('compiled : %.1f ms/step' % (results['compiled'] * 1000))
+    print('speedup  : %.2fx' % (results['eager'] / results['compiled']))
@@ -0,0 +1,81 @@
+""" Scaling benchmark of gloo DistributedDataParallel training on one box
+
+    python -m utils.ddp_benchmark --model_cfg config/bert_base.json --ranks 1,2,4,8
+
+    Every rank trains models.Classifier on synthetic batches of --batch_size (weak scaling) and the
+    throughput (examples / sec over all ranks) is compared with the single-rank run.
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import models
+from utils import configuration
+from utils.optim import BertAdam
+from utils.distributed import wrap_ddp
+
+parser = argparse.ArgumentParser(description='DDP scaling benchmark')
+parser.add_argument('--model_cfg', default='config/bert_base.json', type=str)
+parser.add_argument('--ranks', default='1,2,4,8', type=str)
+parser.add_argument('--batch_size', default=8, type=int)
+parser.add_argument('--seq_len', default=128, type=int)
+parser.add_argument('--steps', default=20, type=int)
+parser.add_argument('--warmup_steps', default=3, type=int)
+
+
+def run_rank(rank, world_size, init_file, cfg, results):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(0)
+    model_cfg = configuration.model.from_json(cfg.model_cfg)
+    model = wrap_ddp(models.Classifier(model_cfg, 2))
+    optimizer = BertAdam(model.parameters(), lr=1e-5, warmup=0.1, t_total=cfg.steps + cfg.warmup_steps)
+
+    g = torch.Generator().manual_seed(rank)
+    input_ids = torch.randint(1, model_cfg.vocab_size, (cfg.batch_size, cfg.seq_len), generator=g)
+    segment_ids, input_mask = torch.zeros_like(input_ids), torch.ones_like(input_ids)
+    labels = torch.randint(0, 2, (cfg.batch_size,), generator=g)
+
+    for step in range(cfg.warmup_steps + cfg.steps):
+        if step == cfg.warmup_steps:
+            dist.barrier()
+            start = time.time()
+        optimizer.zero_grad()
+        F.cross_entropy(model(input_ids, segment_ids, input_mask), labels).backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.time() - start
+
+    # replicas must stay identical after the all-reduced updates
+    flat = torch.cat([p.detach().view(-1) for p in model.parameters()])
+    ref = flat.clone()
+    dist.broadcast(ref, src=0)
+    diff = (flat - ref).abs().max().view(1)
+    dist.all_reduce(diff, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        results[world_size] = (elapsed, diff.item())
+    dist.destroy_process_group()
+
+
+def main(cfg):
+    results = mp.Manager().dict()
+    print('%6s %10s %14s %12s %10s %12s' % ('ranks', 'time(s)', 'examples/sec', 'speedup', 'efficiency', 'max|diff|'))
+    base = None
+    for world_size in [int(r) for r in cfg.ranks.split(',')]:
+        init_file = os.path.join(tempfile.mkdtemp(), 'rendezvous')
+        mp.spawn(run_rank, args=(world_size, init_file, cfg, results), nprocs=world_size)
+        elapsed, diff = results[world_size]
+        throughput = world_size * cfg.batch_size * cfg.steps / elapsed
+        base = base or throughput
+        print('%6d %10.2f %14.1f %11.2fx %9.0f%% %12.2e' % (
+            world_size, elapsed, throughput, throughput / base, 100 * throughput / base / world_size, diff))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
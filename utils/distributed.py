@@ -0,0 +1,52 @@
+""" Multi-process data parallel training with torch.distributed (gloo)
+
+    torchrun --nproc_per_node 4 main.py --distributed ...
+    or, without torchrun, one process per rank :
+    python main.py --distributed --world_size 4 --rank 0 --dist_init_file /tmp/uda_rendezvous ...
+"""
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(cfg):
+    """ join the process group (env:// under torchrun, else file:// rendezvous) and
+        split the CPU threads of the box between the local ranks. returns (rank, world_size) """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:     # torchrun
+        dist.init_process_group('gloo', init_method='env://')
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+        local_rank = int(os.environ.get('LOCAL_RANK', dist.get_rank()))
+    else:
+        dist.init_process_group(
+            'gloo', init_method='file://' + os.path.abspath(cfg.dist_init_file),
+            rank=cfg.rank, world_size=cfg.world_size
+        )
+        local_world_size, local_rank = cfg.world_size, cfg.rank
+
+    threads = cfg.num_threads or max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_process():
+    "rank 0, or the only process when torch.distributed is not used"
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def broadcast_flag(flag):
+    "the value of flag on rank 0, on every rank"
+    if not dist.is_initialized():
+        return flag
+    t = torch.tensor([int(flag)])
+    dist.broadcast(t, src=0)
+    return bool(t.item())
+
+
+def wrap_ddp(model):
+    from torch.nn.parallel import DistributedDataParallel
+    if torch.cuda.is_available():
+        return DistributedDataParallel(model, device_ids=[torch.cuda.current_device()])
+    return DistributedDataParallel(model)
@@ -0,0 +1,74 @@
+""" Exponential moving average of the model weights (MixMatch) """
+from itertools import chain
+from contextlib import contextmanager
+
+import torch
+
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+
+def float_tensors(module):
+    "parameters and floating point buffers of module (looked up on every call, they move with module.to)"
+    return [t.data for t in chain(module.parameters(), module.buffers()) if t.is_floating_point()]
+
+
+class WeightEMA(object):
+    """ Shadow weights updated with multi-tensor (torch._foreach_*) ops.
+        every   : update every k steps with the decay corrected to alpha ** k
+        dtype   : 'fp32' or 'bf16' shadow weights (bf16 drops updates smaller than its precision,
+                  pair it with every > 1)
+        offload : keep the shadow weights in host memory instead of on the model's device
+        The shadow replaces a second model : average_parameters() swaps it into the model for eval """
+    def __init__(self, cfg, model, ema_model=None, alpha=0.999, every=None, dtype=None, offload=None):
+        self.model = model
+        self.alpha = alpha
+        self.every = every or getattr(cfg, 'ema_every', 1)
+        self.dtype = DTYPES[dtype or getattr(cfg, 'ema_dtype', 'fp32')]
+        self.offload = getattr(cfg, 'ema_offload', False) if offload is None else offload
+        self.wd = 0.02 * cfg.lr
+        self.n_steps = 0
+
+        if ema_model is not None:   # start from the weights of ema_model (like the original WeightEMA)
+            self.copy_from(ema_model)
+        self.reset()
+
+    def reset(self):
+        "shadow weights from the current weights of the model (e.g. after its layers were replaced)"
+        self.shadow = [p.to('cpu' if self.offload else p.device, self.dtype, copy=True) for p in float_tensors(self.model)]
+
+    @torch.no_grad()
+    def copy_from(self, module):
+        for param, other in zip(float_tensors(self.model), float_tensors(module)):
+            param.copy_(other)
+
+    @torch.no_grad()
+    def step(self):
+        self.n_steps += 1
+        params = float_tensors(self.model)
+        if not self.offload and self.shadow[0].device != params[0].device:    # follow model.to(device)
+            self.shadow = [s.to(params[0].device) for s in self.shadow]
+        if self.n_steps % self.every == 0:
+            # ema = alpha^k * ema + (1 - alpha^k) * param, one fused lerp over all tensors
+            device = self.shadow[0].device
+            torch._foreach_lerp_(self.shadow, [p.to(device, self.dtype) for p in params], 1.0 - self.alpha ** self.every)
+        # customized weight decay
+        torch._foreach_mul_(params, 1 - self.wd)
+
+    @torch.no_grad()
+    def copy_to(self, module):
+        "write the averaged weights into module (same architecture as the model)"
+        for param, shadow in zip(float_tensors(module), self.shadow):
+            param.copy_(shadow)
+
+    @contextmanager
+    def average_parameters(self):
+        "run the block with the averaged weights loaded in the model, the trained weights are restored after"
+        params = float_tensors(self.model)
+        backup = [p.to(self.shadow[0].device, copy=True) for p in params]
+        self.copy_to(self.model)
+        try:
+            yield self.model
+        finally:
+            with torch.no_grad():
+                for param, b in zip(params, backup):
+                    param.copy_(b)
@@ -0,0 +1,79 @@
+""" Cache of the frozen lower part of models.Transformer (--freeze_layers) for the sup and eval sets """
+import os
+
+import torch
+
+_weights = {}
+
+
+def fingerprint(*tensors):
+    "int64 hash of every row of the (B, S) tensors (random linear hash, wraps around)"
+    seq_len = tensors[0].size(1)
+    if seq_len not in _weights:
+        g = torch.Generator().manual_seed(seq_len)
+        _weights[seq_len] = torch.randint(-2 ** 62, 2 ** 62, (3, seq_len), generator=g)
+    key = 0
+    for t, w in zip(tensors, _weights[seq_len]):
+        key = key + (t.long() * w.to(t.device)).sum(1)
+    return key.tolist()
+
+
+class FrozenCache(object):
+    """ fp16 outputs of the embeddings and the frozen blocks for the rows of datasets (sup, eval)
+        - rows are found by a hash of their input_ids, the loss functions and validate() pass
+          their batches as usual. Other rows (unsup) and other lengths run the frozen blocks
+        - a row is filled the first time it is seen, for the (input_ids, segment_ids, input_mask)
+          it is called with, after the checkpoint / pretrained weights were loaded
+        - kept in host memory, or memory-mapped in cache_dir (large eval sets)
+        - sup word mixup defeats most of it : pad_for_word_mixup / simple_pad fill the shorter rows
+          with tokens of their partner, those rows are new inputs (their frozen output differs from
+          the unpadded row's) and run the frozen blocks every step """
+    def __init__(self, datasets, dim, cache_dir=''):
+        ids = [d.tensors[0] for d in datasets if d]
+        self.seq_len = ids[0].size(1)
+        assert all(t.size(1) == self.seq_len for t in ids), 'the cached datasets have different lengths'
+        self.admit = set(fingerprint(torch.cat(ids)))
+        shape = (len(self.admit), self.seq_len, dim)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            file = os.path.join(cache_dir, 'frozen_%d_%d_%d.bin' % shape)
+            if os.path.exists(file):
+                os.remove(file)     # entries of an older run / model
+            self.h = torch.from_file(file, shared=True, size=shape[0] * shape[1] * shape[2], dtype=torch.float16).view(shape)
+        else:
+            self.h = torch.empty(shape, dtype=torch.float16)
+        self.slots = {}     # hash of (input_ids, segment_ids, input_mask) -> row of self.h
+        self.hits = 0
+        self.lookups = 0
+
+    def lookup(self, x, seg, mask, forward):
+        "frozen output of the batch, forward(x, seg, mask) only runs for the rows not cached yet"
+        if x.size(1) != self.seq_len:
+            return forward(x, seg, mask)
+        keys = fingerprint(x, seg, mask)
+        slots = [self.slots.get(k, -1) for k in keys]
+        hit = [i for i, s in enumerate(slots) if s >= 0]
+        miss = [i for i, s in enumerate(slots) if s < 0]
+        self.lookups += len(keys)
+        self.hits += len(hit)
+
+        if not miss:
+            return self.h[slots].to(x.device, torch.float32, non_blocking=True)
+        h = forward(x[miss], seg[miss], mask[miss]) if hit else forward(x, seg, mask)
+        if hit:
+            h_all = h.new_empty(x.size(0), *h.shape[1:])
+            h_all[hit] = self.h[[slots[i] for i in hit]].to(h.device, h.dtype)
+            h_all[miss] = h
+            h = h_all
+
+        # admit the rows of the cached datasets while there is room
+        rows, free = [], []
+        for i, k in zip(miss, fingerprint(x[miss])):
+            if k in self.admit and keys[i] not in self.slots and len(self.slots) < len(self.h):
+                self.slots[keys[i]] = len(self.slots)
+                rows.append(i)
+                free.append(self.slots[keys[i]])
+        if rows:
+            self.h[free] = h[rows].to('cpu', torch.float16)
+            h[rows] = self.h[free].to(h.device, h.dtype)   # same (fp16) values as the later hits
+        return h
@@ -0,0 +1,200 @@
+""" Memory accounting of training steps : activations per module, parameter / gradient /
+    optimizer state sizes, peak RSS and allocator stats per step (--memory_report) """
+import json
+import resource
+from collections import defaultdict
+
+import torch
+
+import models
+
+MB = 1024. ** 2
+CFG_KEYS = ('train_batch_size', 'unsup_ratio', 'unsup_overdraw', 'max_seq_length', 'sup_mixup', 'mixup',
+            'simple_pad', 'no_grad_clone', 'confidence_skip', 'uda_mode', 'mixmatch_mode')
+
+
+def storage_bytes(tensors):
+    "bytes of the distinct storages behind tensors (views and repeats counted once)"
+    storages = {}
+    for t in tensors:
+        s = t.untyped_storage()
+        storages[s.data_ptr()] = s.nbytes()
+    return sum(storages.values())
+
+
+def output_tensors(out):
+    if torch.is_tensor(out):
+        return [out]
+    if isinstance(out, (tuple, list)):
+        return [t for o in out for t in output_tensors(o)]
+    return []
+
+
+def hooked_modules(model):
+    "(name, module) of Embeddings, every Block, Classifier.fc and the classifier head"
+    named, heads = [], []
+    for name, module in model.named_modules():
+        if isinstance(module, (models.Embeddings, models.Block)):
+            named.append((name, module))
+        elif isinstance(module, models.Classifier):
+            prefix = name + '.' if name else ''
+            heads += [(prefix + 'fc', module.fc), (prefix + 'classifier', module.classifier)]
+    return named + heads    # in forward order
+
+
+def read_rss():
+    "(current, peak) resident set size in bytes, the peak since the last reset_peak_rss()"
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):     # no procfs : lifetime peak only
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, peak
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')    # resets VmHWM to the current RSS (linux)
+        return True
+    except OSError:
+        return False
+
+
+class MemoryReport(object):
+    """ --memory_report : for the first --memory_steps training steps, record
+        - per hooked module : bytes of the outputs and of the tensors saved for backward
+          (parameters excluded), summed over the calls of the step (sup / ori / aug / clone forwards)
+        - peak RSS of the step, and the CUDA allocator peak / reserved / retries
+        - parameter, gradient and optimizer state (BertAdam next_m / next_v) bytes per module
+        then print a table, write file (json) and remove the hooks """
+    def __init__(self, cfg, model, optimizer, device, file=None):
+        self.enabled = getattr(cfg, 'memory_report', False)
+        self.n_steps = getattr(cfg, 'memory_steps', 5)
+        self.cfg = {k: getattr(cfg, k, None) for k in CFG_KEYS}
+        self.model = model
+        self.optimizer = optimizer
+        self.cuda = torch.device(device).type == 'cuda'
+        self.file = file
+        self.steps = []
+        self.handles = []
+        if self.enabled:
+            self.modules = hooked_modules(model)
+            self._attach()
+
+    def _attach(self):
+        self.param_ptrs = {p.untyped_storage().data_ptr() for p in self.model.parameters()}
+        for name, module in self.modules:
+            self.handles.append(module.register_forward_pre_hook(self._enter(name)))
+            self.handles.append(module.register_forward_hook(self._exit(name)))
+
+    def _enter(self, name):
+        def pack(t):
+            s = t.untyped_storage()
+            if s.data_ptr() not in self.param_ptrs:
+                self.saved[name][s.data_ptr()] = s.nbytes()
+            return t
+
+        def hook(module, args):
+            ctx = torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t)
+            ctx.__enter__()
+            self.contexts.append(ctx)
+        return hook
+
+    def _exit(self, name):
+        def hook(module, args, out):
+            self.contexts.pop().__exit__(None, None, None)
+            self.outputs[name] += storage_bytes(output_tensors(out))
+            self.calls[name] += 1
+        return hook
+
+    def step_begin(self):
+        if not self.enabled:
+            return
+        self.contexts = []
+        self.saved = defaultdict(dict)      # module -> {storage : bytes}
+        self.outputs = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.rss_peak_reset = reset_peak_rss()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def step_end(self, step):
+        if not self.enabled:
+            return
+        rss, rss_peak = read_rss()
+        row = {
+            'step': step, 'rss_mb': rss / MB, 'rss_peak_mb': rss_peak / MB,
+            'rss_peak_is_per_step': self.rss_peak_reset,
+            'activations': {
+                name: {'calls': self.calls[name], 'output_mb': self.outputs[name] / MB,
+                       'saved_mb': sum(self.saved[name].values()) / MB}
+                for name, _ in self.modules
+            },
+        }
+        row['saved_total_mb'] = sum(a['saved_mb'] for a in row['activations'].values())
+        if self.cuda:
+            stats = torch.cuda.memory_stats()
+            row.update(
+                cuda_allocated_mb=torch.cuda.memory_allocated() / MB,
+                cuda_peak_allocated_mb=torch.cuda.max_memory_allocated() / MB,
+                cuda_reserved_mb=torch.cuda.memory_reserved() / MB,
+                cuda_alloc_retries=stats.get('num_alloc_retries', 0),
+                cuda_ooms=stats.get('num_ooms', 0),
+            )
+        self.steps.append(row)
+        if len(self.steps) == self.n_steps:
+            self.report()
+            self.close()
+
+    def state_sizes(self):
+        "parameter, gradient and optimizer state MB per hooked module ('other' for the rest)"
+        names = [name for name, _ in self.modules]
+        sizes = defaultdict(lambda: defaultdict(float))
+        for pname, p in self.model.named_parameters():
+            owner = next((n for n in names if pname.startswith(n + '.')), 'other')
+            sizes[owner]['params_mb'] += p.numel() * p.element_size() / MB
+            if p.grad is not None:
+                sizes[owner]['grads_mb'] += p.grad.numel() * p.grad.element_size() / MB
+            for key, v in self.optimizer.state.get(p, {}).items():
+                if torch.is_tensor(v) and v.dim() > 0:
+                    sizes[owner][key + '_mb'] += v.numel() * v.element_size() / MB
+        return {k: dict(v) for k, v in sizes.items()}
+
+    def report(self):
+        states = self.state_sizes()
+        if self.file:
+            with open(self.file, 'w') as f:
+                json.dump({'cfg': self.cfg, 'state': states, 'steps': self.steps}, f, indent=2)
+
+        # table : activations of the largest step, state sizes
+        peak = max(self.steps, key=lambda r: r['saved_total_mb'])
+        state_keys = sorted({k for v in states.values() for k in v if k not in ('params_mb', 'grads_mb')})
+        columns = ['calls', 'output_mb', 'saved_mb', 'params_mb', 'grads_mb'] + state_keys
+        print('\nMemory per module (MB, activations of step %d)' % peak['step'])
+        print('%-24s' % 'module' + ''.join('%12s' % c.replace('_mb', '') for c in columns))
+        totals = defaultdict(float)
+        for name in [n for n, _ in self.modules] + (['other'] if 'other' in states else []):
+            values = dict(peak['activations'].get(name, {}), **states.get(name, {}))
+            for c in columns:
+                totals[c] += values.get(c, 0)
+            print('%-24s' % name + ''.join(
+                '%12d' % values.get(c, 0) if c == 'calls' else '%12.2f' % values.get(c, 0) for c in columns))
+        print('%-24s' % 'total' + ''.join(
+            '%12d' % totals[c] if c == 'calls' else '%12.2f' % totals[c] for c in columns))
+        for r in self.steps:
+            line = 'step %4d  rss %8.1f MB  peak rss %8.1f MB%s' % (
+                r['step'], r['rss_mb'], r['rss_peak_mb'], '' if r['rss_peak_is_per_step'] else ' (lifetime)')
+            if self.cuda:
+                line += '  cuda peak %8.1f MB  reserved %8.1f MB  retries %d' % (
+                    r['cuda_peak_allocated_mb'], r['cuda_reserved_mb'], r['cuda_alloc_retries'])
+            print(line)
+        if self.file:
+            print('Saved the memory report to', self.file)
+
+    def close(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.enabled = False
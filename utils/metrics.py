@@ -0,0 +1,112 @@
+""" Buffered metrics sink : scalars are queued in memory and written by a background thread
+    to tensorboard events and / or a columnar file (<log_dir>/metrics.jsonl) """
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import defaultdict
+
+
+class MetricsSink(object):
+    """ Drop-in for the SummaryWriter calls of Trainer.train (add_scalars / add_scalar / close).
+        - every scalar goes to one event file : add_scalars('data/lr', {'lr': v}) is tag 'data/lr',
+          multi-key dicts are tag 'main_tag/key' (no sub-writer and event file per tag)
+        - the caller only appends to a list, the files are written every flush_secs (or when
+          max_buffer scalars are queued) by a daemon thread. values may be device tensors, they are
+          read back on that thread
+        - columnar : one json line per flush with the columns tags / tag / step / value / wall_time
+        - close() is registered with atexit and called by Trainer.train when training ends, no queued
+          scalar is lost. Signal handling is left to the process (a plain SIGTERM skips atexit) """
+    def __init__(self, log_dir, formats=('tensorboard', 'columnar'), flush_secs=10., max_buffer=10000):
+        os.makedirs(log_dir, exist_ok=True)
+        self.flush_secs = flush_secs
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.lock = threading.Lock()            # buffer swap
+        self.write_lock = threading.Lock()      # background writes vs flush() / close()
+        self.wake = threading.Event()
+        self.closed = False
+
+        self.writer = None
+        if 'tensorboard' in formats:
+            from tensorboardX import SummaryWriter
+            self.writer = SummaryWriter(log_dir=log_dir)
+        self.columnar_file = os.path.join(log_dir, 'metrics.jsonl') if 'columnar' in formats else None
+
+        self.thread = threading.Thread(target=self._run, name='metrics-sink', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add_scalar(self, tag, value, global_step=None, walltime=None):
+        if hasattr(value, 'detach'):
+            value = value.detach()
+        with self.lock:
+            self.buffer.append((tag, global_step, value, walltime or time.time()))
+            full = len(self.buffer) >= self.max_buffer
+        if full:
+            self.wake.set()
+
+    def add_scalars(self, main_tag, tag_scalar_dict, global_step=None, walltime=None):
+        walltime = walltime or time.time()
+        for key, value in tag_scalar_dict.items():
+            tag = main_tag if len(tag_scalar_dict) == 1 and main_tag.endswith('/' + key) else main_tag + '/' + key
+            self.add_scalar(tag, value, global_step, walltime)
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_secs)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:      # never take the training down with the logging
+                print('MetricsSink : write failed (%s : %s)' % (type(e).__name__, e), file=sys.stderr)
+
+    def flush(self):
+        "write the queued scalars now (on the calling thread)"
+        with self.write_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+            if not rows:
+                return
+            rows = [(tag, step, float(value), t) for tag, step, value, t in rows]
+            if self.writer is not None:
+                for tag, step, value, t in rows:
+                    self.writer.add_scalar(tag, value, step, walltime=t)
+                self.writer.flush()
+            if self.columnar_file:
+                tags = sorted({r[0] for r in rows})
+                index = {tag: i for i, tag in enumerate(tags)}
+                chunk = {
+                    'tags': tags, 'tag': [index[r[0]] for r in rows], 'step': [r[1] for r in rows],
+                    'value': [r[2] for r in rows], 'wall_time': [r[3] for r in rows],
+                }
+                with open(self.columnar_file, 'a') as f:
+                    f.write(json.dumps(chunk) + '\n')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        atexit.unregister(self.close)
+
+
+def read_columnar(file):
+    "{tag: (steps, values, wall_times)} from a metrics.jsonl written by MetricsSink"
+    columns = defaultdict(lambda: ([], [], []))
+    with open(file) as f:
+        for line in f:
+            chunk = json.loads(line)
+            for i, step, value, t in zip(chunk['tag'], chunk['step'], chunk['value'], chunk['wall_time']):
+                steps, values, times = columns[chunk['tags'][i]]
+                steps.append(step)
+                values.append(value)
+                times.append(t)
+    return dict(columns)
@@ -21,6 +21,8 @@ import torch
 from torch.optim import Optimizer
 from torch.nn.utils import clip_grad_norm_
 
+from utils.schedules import schedule_tables
+
 def warmup_cosine(x, warmup=0.002):
     if x < warmup:
         return x/warmup
@@ -42,6 +44,8 @@ SCHEDULES = {
     'warmup_linear':warmup_linear,
 }
 
+EMBEDDINGS = ('tok_embed.weight', 'word_embeddings.weight')     # models.Classifier, models_bert
+
 class BertAdam(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix.
     Params:
@@ -55,10 +59,12 @@ class BertAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay_rate: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+        lazy: row-wise (lazy) Adam for the 2D params of the group (embedding tables), only the rows
+            with a gradient are updated. Default: False
     """
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay_rate=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, lazy=False):
         assert lr > 0.0, "Learning rate: %f - should be > 0.0" % (lr)
         assert schedule in SCHEDULES, "Invalid schedule : %s" % (schedule)
         assert 0.0 <= warmup < 1.0 or warmup == -1.0, \
@@ -68,23 +74,25 @@ class BertAdam(Optimizer):
         assert e > 0.0, "epsilon: %f - should be > 0.0" % (e)
         defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total,
                         b1=b1, b2=b2, e=e, weight_decay_rate=weight_decay_rate,
-                        max_grad_norm=max_grad_norm)
+                        max_grad_norm=max_grad_norm, lazy=lazy)
         super(BertAdam, self).__init__(params, defaults)
+        self.deferred = False   # lazy rows with weight decay not applied yet
 
     def get_lr(self):
-        """ get learning rate in training """
+        """ get learning rate in training (one entry per param group, read from the host table) """
         lr = []
         for group in self.param_groups:
-            for p in group['params']:
-                state = self.state[p]
-                if not state:
-                    return [0]
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-                lr.append(lr_scheduled)
+            if not group['params']:
+                continue
+            state = self.state[group['params'][0]]
+            if not state:
+                return [0]
+            if group['t_total'] != -1:
+                table = schedule_tables(group['t_total'])
+                lr_scheduled = group['lr'] * table.lr(group['schedule'], group['warmup'], state['step']).item()
+            else:
+                lr_scheduled = group['lr']
+            lr.append(lr_scheduled)
         return lr
 
     def step(self, closure=None):
@@ -99,15 +107,28 @@ class BertAdam(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            lrs = {}    # scheduled lr (device tensor) per (device, step), shared by the params of the group
             for p in group['params']:
                 if p.grad is None:
                     continue
                 grad = p.grad.data
+                state = self.state[p]
+
+                if group['t_total'] != -1:
+                    key = (p.device, state.get('step', 0))
+                    if key not in lrs:
+                        table = schedule_tables(group['t_total'], p.device)
+                        lrs[key] = group['lr'] * table.lr(group['schedule'], group['warmup'], state.get('step', 0))
+                    lr_scheduled = lrs[key]
+                else:
+                    lr_scheduled = group['lr']
+
+                if group['lazy'] and p.dim() == 2:
+                    self.lazy_step(p, grad, state, group, lr_scheduled)
+                    continue
                 if grad.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
 
-                state = self.state[p]
-
                 # State initialization
                 if not state:
                     state['step'] = 0
@@ -139,12 +160,6 @@ class BertAdam(Optimizer):
                 if group['weight_decay_rate'] > 0.0:
                     update += group['weight_decay_rate'] * p.data
 
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-
                 update_with_lr = lr_scheduled * update
                 p.data.add_(-update_with_lr)
 
@@ -157,15 +172,82 @@ class BertAdam(Optimizer):
 
         return loss
 
+    def lazy_step(self, p, grad, state, group, lr):
+        """ Adam on the rows of p with a nonzero gradient (the tokens of the batch for tok_embed).
+            The other rows are left alone : their moments are decayed by b1 ** k / b2 ** k when they
+            next have a gradient, k steps later, and their weight decay (the product of 1 - lr * wd
+            over those steps, kept as a log sum) is applied then or by apply_deferred_decay().
+            Rows that always or never have a gradient follow the dense update exactly, rows in
+            between skip the momentum-only moves of the steps without gradient (lazy Adam) """
+        if grad.is_sparse:
+            grad = grad.coalesce()
+            rows, g = grad.indices()[0], grad.values()
+        else:
+            rows = grad.ne(0).any(1).nonzero().squeeze(1)
+            g = grad[rows]
+
+        if not state:
+            state['step'] = 0
+            state['next_m'] = torch.zeros_like(p.data)
+            state['next_v'] = torch.zeros_like(p.data)
+            state['row_step'] = torch.zeros(p.size(0), dtype=torch.long, device=p.device)
+            # sum over the steps of log(1 - lr * wd), and its value at the last update of each row
+            state['log_decay'] = torch.zeros((), dtype=torch.float64, device=p.device)
+            state['row_log_decay'] = torch.zeros(p.size(0), dtype=torch.float64, device=p.device)
+
+        beta1, beta2, wd = group['b1'], group['b2'], group['weight_decay_rate']
+        if group['max_grad_norm'] > 0:      # same as clip_grad_norm_ on the dense gradient
+            g = g * (group['max_grad_norm'] / (g.norm() + 1e-6)).clamp(max=1.0)
+
+        skipped = (state['step'] - state['row_step'][rows]).to(p.dtype)[:, None]
+        next_m = state['next_m'][rows] * beta1 ** skipped
+        next_v = state['next_v'][rows] * beta2 ** skipped
+        next_m.mul_(beta1).add_(g, alpha=1 - beta1)
+        next_v.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+        weight = p.data[rows]
+        update = next_m / (next_v.sqrt() + group['e'])
+        if wd > 0.0:
+            weight.mul_(torch.exp(state['log_decay'] - state['row_log_decay'][rows]).to(p.dtype)[:, None])
+            update += wd * weight
+
+        p.data.index_copy_(0, rows, weight - lr * update)
+        state['next_m'].index_copy_(0, rows, next_m)
+        state['next_v'].index_copy_(0, rows, next_v)
+        state['step'] += 1
+        state['row_step'][rows] = state['step']
+        if wd > 0.0:
+            state['log_decay'] += torch.log1p(-torch.as_tensor(lr * wd, dtype=torch.float64, device=p.device))
+            state['row_log_decay'][rows] = state['log_decay']
+            self.deferred = True
+
+    @torch.no_grad()
+    def apply_deferred_decay(self):
+        "apply the pending weight decay of the rows lazy groups skipped (before evaluating or saving)"
+        if not self.deferred:
+            return
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state[p]
+                if group['lazy'] and 'log_decay' in state:
+                    p.data.mul_(torch.exp(state['log_decay'] - state['row_log_decay']).to(p.dtype)[:, None])
+                    state['row_log_decay'].fill_(state['log_decay'].item())
+        self.deferred = False
+
 
 
 def optim4GPU(cfg, model):
     """ optimizer for GPU training """
     param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'gamma', 'beta']
+    # --lazy_embedding : the token embedding table gets row-wise updates (BertAdam.lazy_step)
+    lazy = [n for n, _ in param_optimizer if getattr(cfg, 'lazy_embedding', False) and n.endswith(EMBEDDINGS)]
+    param_optimizer = [(n, p) for n, p in param_optimizer if n not in lazy]
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if n not in no_decay], 'weight_decay_rate': 0.01},
         {'params': [p for n, p in param_optimizer if n in no_decay], 'weight_decay_rate': 0.0}]
+    if lazy:
+        params = dict(model.named_parameters())
+        optimizer_grouped_parameters.append({'params': [params[n] for n in lazy], 'weight_decay_rate': 0.01, 'lazy': True})
     return BertAdam(optimizer_grouped_parameters,
                     lr=cfg.lr,
                     warmup=cfg.warmup,
@@ -0,0 +1,95 @@
+""" Checks the batched simple_pad / pad_for_word_mixup against the original per-row loops
+    and times both over batch sizes : python -m utils.pad_benchmark
+"""
+import time
+
+import torch
+
+from utils.utils import simple_pad, pad_for_word_mixup
+
+
+def simple_pad_loop(input_ids, input_mask, num_tokens):
+    "original per-row implementation (reference)"
+    batch_size = input_ids.size(0)
+    max_count, max_index = num_tokens.max(0)
+    max_count = int(max_count)
+    max_index = int(max_index)
+    for i in range(0, batch_size):
+        i_count = int(num_tokens[i])
+        if i_count < max_count:
+            first = input_ids[i][0:i_count-1]
+            second = torch.tensor([1] * (max_count - i_count)).to(input_ids.device)
+            third = input_ids[max_index][max_count-1:]
+            input_ids[i] = torch.cat((first, second, third), 0)
+            input_mask[i] = input_mask[max_index]
+
+
+def pad_for_word_mixup_loop(input_ids, input_mask, num_tokens, idx):
+    "original per-row implementation (reference)"
+    batch_size = input_ids.size(0)
+    c_input_ids = input_ids.clone()
+    for i in range(0, batch_size):
+        j = idx[i]
+        i_count = int(num_tokens[i])
+        j_count = int(num_tokens[j])
+        if i_count < j_count:
+            small, big, small_count, big_count = i, j, i_count, j_count
+            small_ids, big_ids = input_ids, c_input_ids
+        elif i_count > j_count:
+            small, big, small_count, big_count = j, i, j_count, i_count
+            small_ids, big_ids = c_input_ids, input_ids
+        if i_count != j_count:
+            first = small_ids[small][0:small_count-1]
+            second = torch.tensor([1] * (big_count - small_count)).to(input_ids.device)
+            third = big_ids[big][big_count-1:]
+            small_ids[small] = torch.cat((first, second, third), 0)
+            if i_count < j_count:
+                input_mask[i] = input_mask[j]
+    return input_ids, c_input_ids
+
+
+def random_batch(batch_size, seq_len, device='cpu'):
+    "[CLS] tokens [SEP] 0.. rows with random lengths (num_tokens counts [CLS] and [SEP])"
+    num_tokens = torch.randint(2, seq_len + 1, (batch_size,))
+    pos = torch.arange(seq_len)
+    input_mask = (pos < num_tokens.view(-1, 1)).long()
+    input_ids = torch.randint(1000, 30000, (batch_size, seq_len)) * input_mask
+    input_ids[:, 0] = 101
+    input_ids[torch.arange(batch_size), num_tokens - 1] = 102
+    return input_ids.to(device), input_mask.to(device), num_tokens.to(device)
+
+
+def check_and_time(batch_sizes=(8, 16, 32, 64, 128), seq_len=128, runs=20, device='cpu'):
+    for batch_size in batch_sizes:
+        torch.manual_seed(batch_size)
+        input_ids, input_mask, num_tokens = random_batch(batch_size, seq_len, device)
+        idx = torch.randperm(batch_size)
+        # identical results (in-place updates and returned tensors)
+        same = True
+        a = [input_ids.clone(), input_mask.clone()]
+        b = [input_ids.clone(), input_mask.clone()]
+        simple_pad(a[0], a[1], num_tokens)
+        simple_pad_loop(b[0], b[1], num_tokens)
+        same &= all(torch.equal(x, y) for x, y in zip(a, b))
+        a = [input_ids.clone(), input_mask.clone()]
+        b = [input_ids.clone(), input_mask.clone()]
+        ra = pad_for_word_mixup(a[0], a[1], num_tokens, idx)
+        rb = pad_for_word_mixup_loop(b[0], b[1], num_tokens, idx)
+        same &= all(torch.equal(x, y) for x, y in zip(a + list(ra), b + list(rb)))
+
+        times = []
+        for fn, args in [(simple_pad_loop, ()), (simple_pad, ()), (pad_for_word_mixup_loop, (idx,)), (pad_for_word_mixup, (idx,))]:
+            start = time.time()
+            for _ in range(runs):
+                fn(input_ids.clone(), input_mask.clone(), num_tokens, *args)
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            times.append((time.time() - start) / runs * 1000)
+        print('batch %4d  identical %-5s  simple_pad %7.2fms -> %6.2fms  pad_for_word_mixup %7.2fms -> %6.2fms' % (
+            batch_size, same, *times))
+
+
+if __name__ == '__main__':
+    check_and_time()
+    if torch.cuda.is_available():
+        check_and_time(device='cuda')
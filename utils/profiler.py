@@ -0,0 +1,101 @@
+""" Per-phase step timers and a torch.profiler trace window for Trainer.train """
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+PHASES = ('data', 'h2d', 'forward', 'backward', 'optimizer', 'ema', 'validate', 'save')
+
+
+class StepProfiler(object):
+    """ --profile       : time the phases of every step, the device is synchronized around each phase
+        --profile_steps : 'N:M', capture steps N..M with torch.profiler into <results_dir>/trace
+                          (tensorboard profiler plugin format)
+        log() writes the per-step phase times, real / padded tokens per sec and the data-wait
+        fraction since the previous log. Disabled, phase() is a shared no-op context """
+    def __init__(self, cfg, device, trace_dir=None):
+        self.enabled = getattr(cfg, 'profile', False)
+        steps = getattr(cfg, 'profile_steps', '')
+        self.trace_steps = tuple(int(s) for s in steps.split(':')) if steps else None
+        self.trace_dir = trace_dir or os.path.join('results', 'trace')
+        self.sync = torch.device(device).type == 'cuda'
+        self.trace = None
+        self._null = nullcontext()
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(PHASES, 0.)
+        self.n_steps = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.window_start = self.last_end = time.perf_counter()
+
+    def _synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        if not self.enabled and self.trace is None:
+            return self._null
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        with torch.profiler.record_function(name) if self.trace is not None else self._null:
+            if self.enabled:
+                self._synchronize()
+                start = time.perf_counter()
+            yield
+            if self.enabled:
+                self._synchronize()
+                self.times[name] += time.perf_counter() - start
+
+    def step_begin(self, step, id_tensors=()):
+        """ step : the step about to run, id_tensors : input_ids of the batch on the host (0 is padding)
+            the time since the end of the previous step is the wait for the data loaders (sup and unsup) """
+        if self.trace_steps and step == self.trace_steps[0]:
+            self._start_trace()
+        if self.enabled:
+            self.times['data'] += time.perf_counter() - self.last_end
+            for ids in id_tensors:
+                self.tokens += int((ids != 0).sum())
+                self.padded_tokens += ids.numel()
+
+    def step_end(self, step):
+        if self.enabled:
+            self.n_steps += 1
+            self.last_end = time.perf_counter()
+        if self.trace is not None and step >= self.trace_steps[1]:
+            self.close()
+
+    def log(self, writer, step):
+        if not self.enabled or not self.n_steps:
+            return
+        wall = time.perf_counter() - self.window_start
+        for name, t in self.times.items():
+            writer.add_scalars('profile/' + name + '_ms', {name + '_ms': 1000 * t / self.n_steps}, step)
+        writer.add_scalars('profile/step_ms', {'step_ms': 1000 * wall / self.n_steps}, step)
+        writer.add_scalars('profile/tokens_per_sec', {
+            'real': self.tokens / wall, 'padded': self.padded_tokens / wall}, step)
+        writer.add_scalars('profile/padding_frac', {'padding_frac': 1 - self.tokens / max(self.padded_tokens, 1)}, step)
+        writer.add_scalars('profile/data_wait_frac', {'data_wait_frac': self.times['data'] / wall}, step)
+        self.reset()
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.sync:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir)
+        )
+        self.trace.start()
+
+    def close(self):
+        "stop the trace window if it is still open (end of training)"
+        if self.trace is not None:
+            trace, self.trace = self.trace, None
+            trace.stop()
+            print(trace.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+            print('Saved the profiler trace to', self.trace_dir)
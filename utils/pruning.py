@@ -0,0 +1,79 @@
+""" Structured pruning of models.Classifier : importance of the attention heads and the feed-forward
+    neurons, and removal of the least important ones (the Linear layers are physically shrunk) """
+import torch
+import torch.nn.functional as F
+
+import models
+
+
+def blocks_of(model):
+    return [m for m in model.modules() if isinstance(m, models.Block)]
+
+
+def importance(model, loader, device, n_batches=-1):
+    """ |dL / d mask| accumulated over the batches, with a mask of ones on the output of every head
+        (input of Block.proj) and every neuron (input of pwff.fc2), Michel et al. 2019.
+        returns ([per block : head scores], [per block : neuron scores]), each normalized per block """
+    blocks = blocks_of(model)
+    head_masks = [torch.ones(b.attn.n_heads, device=device, requires_grad=True) for b in blocks]
+    neuron_masks = [torch.ones(b.pwff.fc1.out_features, device=device, requires_grad=True) for b in blocks]
+    head_scores = [torch.zeros_like(m) for m in head_masks]
+    neuron_scores = [torch.zeros_like(m) for m in neuron_masks]
+
+    def masked(mask, repeat=1):
+        return lambda module, args: (args[0] * mask.repeat_interleave(repeat),)
+
+    handles = []
+    for block, head_mask, neuron_mask in zip(blocks, head_masks, neuron_masks):
+        width = block.attn.proj_q.out_features // block.attn.n_heads
+        handles.append(block.proj.register_forward_pre_hook(masked(head_mask, width)))
+        handles.append(block.pwff.fc2.register_forward_pre_hook(masked(neuron_mask)))
+
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    for p in model.parameters():     # only the masks need gradients
+        p.requires_grad = False
+    model.eval()
+    try:
+        for i, batch in enumerate(loader):
+            if i == n_batches:
+                break
+            input_ids, segment_ids, input_mask, label_ids = [t.to(device) for t in batch[:4]]
+            loss = F.cross_entropy(model(input_ids, segment_ids, input_mask), label_ids)
+            grads = torch.autograd.grad(loss, head_masks + neuron_masks)
+            for score, grad in zip(head_scores + neuron_scores, grads):
+                score += grad.abs()
+    finally:
+        for handle in handles:
+            handle.remove()
+        for p, r in zip(model.parameters(), requires_grad):
+            p.requires_grad = r
+
+    normalize = lambda scores: [s / (s.norm() + 1e-20) for s in scores]
+    return normalize(head_scores), normalize(neuron_scores)
+
+
+def lowest(scores, sparsity):
+    """ {block : [indices]} of the sparsity fraction of units with the lowest score over all blocks,
+        the best unit of every block is never selected """
+    total = sum(s.numel() for s in scores)
+    n_prune = int(sparsity * total)
+    candidates = []
+    for b, s in enumerate(scores):
+        best = s.argmax().item()
+        candidates += [(v, b, i) for i, v in enumerate(s.tolist()) if i != best]
+    pruned = {b: [] for b in range(len(scores))}
+    for _, b, i in sorted(candidates)[:n_prune]:
+        pruned[b].append(i)
+    return pruned
+
+
+def prune(model, head_scores, neuron_scores, head_sparsity, neuron_sparsity):
+    "remove the least important heads / neurons in place, returns the numbers of removed (heads, neurons)"
+    heads = lowest(head_scores, head_sparsity)
+    neurons = lowest(neuron_scores, neuron_sparsity)
+    for b, block in enumerate(blocks_of(model)):
+        if heads[b]:
+            block.prune_heads(heads[b])
+        if neurons[b]:
+            block.prune_neurons(neurons[b])
+    return sum(map(len, heads.values())), sum(map(len, neurons.values()))
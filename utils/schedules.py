@@ -0,0 +1,89 @@
+""" Per-step schedule tables (TSA thresholds, consistency ramp-ups, warmup LR)
+
+    Every value a loss or the optimizer needs at global_step is computed once for all steps
+    and kept on the training device, so a lookup is a device-side index with no host round-trip.
+"""
+import math
+from functools import lru_cache
+
+import torch
+
+
+def tsa_curve(schedule, progress):
+    "TSA threshold in [0, 1] for training progress (tensor)"
+    if schedule == 'linear_schedule':
+        return progress
+    elif schedule == 'exp_schedule':
+        scale = 5
+        return torch.exp((progress - 1) * scale)
+    elif schedule == 'log_schedule':
+        scale = 5
+        return 1 - torch.exp((-progress) * scale)
+    raise ValueError('unknown tsa schedule : %s' % schedule)
+
+
+def warmup_curve(schedule, x, warmup):
+    "vectorized utils.optim.SCHEDULES : lr multiplier for progress x (tensor)"
+    if schedule == 'warmup_cosine':
+        after = 0.5 * (1.0 + torch.cos(math.pi * x))
+    elif schedule == 'warmup_constant':
+        after = torch.ones_like(x)
+    elif schedule == 'warmup_linear':
+        after = 1.0 - x
+    else:
+        raise ValueError('unknown lr schedule : %s' % schedule)
+    return torch.where(x < warmup, x / warmup, after)
+
+
+class ScheduleTables(object):
+    """ Tables indexed by global_step 0 .. total_steps, built lazily per schedule and kept on device.
+        Steps past total_steps read the last entry """
+    def __init__(self, total_steps, device='cpu'):
+        self.total_steps = total_steps
+        self.device = device
+        self.steps = torch.arange(total_steps + 1, dtype=torch.float64)
+        self.one = torch.tensor(1., device=device)
+        self.tables = {}
+
+    def table(self, key, build):
+        if key not in self.tables:
+            self.tables[key] = build(self.steps).float().to(self.device)
+        return self.tables[key]
+
+    def at(self, table, step):
+        return table[min(step, len(table) - 1)]
+
+    def tsa(self, schedule, step, start, end):
+        "same value as get_tsa_thresh(schedule, step, total_steps, start, end)"
+        table = self.table(
+            ('tsa', schedule, start, end),
+            lambda s: tsa_curve(schedule, s / self.total_steps) * (end - start) + start
+        )
+        return self.at(table, step)
+
+    def sigmoid_rampup(self, step, length):
+        "same value as utils.utils.sigmoid_rampup(step, length)"
+        if length == 0:
+            return self.one
+        table = self.table(
+            ('sigmoid_rampup', length),
+            lambda s: torch.exp(-5.0 * (1.0 - s.clamp(0, length) / length) ** 2)
+        )
+        return self.at(table, step)
+
+    def linear_rampup(self, step, length):
+        if length == 0:
+            return self.one
+        table = self.table(('linear_rampup', length), lambda s: (s / length).clamp(0, 1))
+        return self.at(table, step)
+
+    def lr(self, schedule, warmup, step):
+        "warmup lr multiplier of utils.optim.SCHEDULES at step (t_total = total_steps)"
+        table = self.table(('lr', schedule, warmup), lambda s: warmup_curve(schedule, s / self.total_steps, warmup))
+        return self.at(table, step)
+
+
+@lru_cache(maxsize=None)
+def schedule_tables(total_steps, device='cpu'):
+    "shared ScheduleTables per (total_steps, device)"
+    return ScheduleTables(total_steps, device)
@@ -0,0 +1,47 @@
+""" Index-keyed cache of teacher probabilities for unlabeled originals """
+import torch
+
+
+class TeacherCache(object):
+    """ Keeps softmax(model(ori_input)) per unsup example in fp16 so the no_grad ori forward
+        only runs for stale rows.
+        An entry is stale when it is empty, was computed max_age or more steps ago,
+        or has already been served max_reuse times since its last refresh (0 : no limit) """
+    def __init__(self, n_examples, n_labels, max_age=1000, max_reuse=0, device='cpu'):
+        self.max_age = max_age
+        self.max_reuse = max_reuse
+        self.probs = torch.zeros(n_examples, n_labels, dtype=torch.float16, device=device)
+        self.step = torch.full((n_examples,), -1, dtype=torch.long, device=device)   # -1 : empty
+        self.uses = torch.zeros(n_examples, dtype=torch.long, device=device)
+        self.hits = 0
+        self.lookups = 0
+
+    def stale(self, idx, global_step):
+        step = self.step[idx]
+        stale = (step < 0) | (global_step - step >= self.max_age)
+        if self.max_reuse > 0:
+            stale |= self.uses[idx] >= self.max_reuse
+        return stale
+
+    def get(self, forward, idx, global_step):
+        """ cached probabilities of the examples idx (float32)
+            forward(rows) : fresh probabilities of batch rows `rows`, only called for stale rows """
+        idx = idx.to(self.step.device)
+        rows = self.stale(idx, global_step).nonzero().view(-1)
+        n_stale = rows.numel()
+        if n_stale == idx.numel():
+            probs = forward(slice(None))
+        elif n_stale:
+            probs = forward(rows.to(self.probs.device))
+        if n_stale:
+            self.probs[idx[rows]] = probs.to(self.probs.device, torch.float16)
+            self.step[idx[rows]] = global_step
+            self.uses[idx[rows]] = 0
+        self.uses[idx] += 1
+
+        self.lookups += idx.numel()
+        self.hits += idx.numel() - n_stale
+        return self.probs[idx].float()
+
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
@@ -104,10 +104,11 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
     """Runs end-to-end tokenziation."""
 
-    def __init__(self, vocab_file, do_lower_case=True):
+    def __init__(self, vocab_file, do_lower_case=True, vocab_map=None):
         self.vocab = load_vocab(vocab_file) # vocab -> idx
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+        self.vocab_map = vocab_map  # utils.vocab.VocabMap : ids of a task-specific (pruned) vocab
 
     def tokenize(self, text):
         split_tokens = []
@@ -118,7 +119,8 @@ class FullTokenizer(object):
         return split_tokens
 
     def convert_tokens_to_ids(self, tokens):
-        return convert_tokens_to_ids(self.vocab, tokens)
+        ids = convert_tokens_to_ids(self.vocab, tokens)
+        return self.vocab_map.map_ids(ids) if self.vocab_map else ids
 
     def convert_to_unicode(self, text):
         return convert_to_unicode(text)
@@ -0,0 +1,160 @@
+""" Fused UDA objective : TSA-masked supervised cross-entropy + confidence-masked unsup KL (or MSE)
+
+    The sup and aug logits are concatenated as in the losses ([sup ; aug]), so one log_softmax
+    over all rows (aug rows scaled by 1 / softmax_temp) and one closed-form backward replace the
+    ~15 small ops of each loss. python -m utils.uda_objective checks it against the reference chain.
+"""
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class UDAObjective(torch.autograd.Function):
+    """ forward : logits (sup_size + n_aug, n_labels), sup_targets (sup_size, n_labels) probabilities,
+                  ori_prob (n_aug, n_labels) KL / MSE target or None, mse : squared error of the probabilities
+        returns : final_loss, sup_loss, unsup_loss, sup_mask, unsup_mask """
+    @staticmethod
+    def forward(ctx, logits, sup_targets, ori_prob, tsa_thresh, confidence_thresh, softmax_temp, coeff, mse):
+        sup_size = sup_targets.size(0)
+        n_aug = logits.size(0) - sup_size
+        scale = logits.new_ones(logits.size(0), 1)
+        scale[sup_size:] = 1. / softmax_temp
+        log_prob = F.log_softmax(logits * scale, dim=-1)     # single pass over sup and aug rows
+
+        # sup : cross-entropy, rows above the TSA threshold are masked out
+        sup_loss = -torch.sum(log_prob[:sup_size] * sup_targets, dim=-1)
+        if tsa_thresh is not None:
+            sup_mask = (torch.exp(-sup_loss) <= tsa_thresh).type_as(logits)
+        else:
+            sup_mask = torch.ones_like(sup_loss)
+        sup_denom = sup_mask.sum().clamp(min=1.)
+        sup = torch.sum(sup_loss * sup_mask) / sup_denom
+
+        # unsup : KL(ori_prob || aug_prob) or mean squared error of the probabilities,
+        # rows with max(ori_prob) <= confidence_thresh are masked out
+        targets, weights = sup_targets, sup_mask / sup_denom
+        if n_aug:
+            if mse:
+                unsup_loss = torch.mean((torch.exp(log_prob[sup_size:]) - ori_prob) ** 2, dim=-1)
+            else:
+                unsup_loss = torch.sum(torch.xlogy(ori_prob, ori_prob) - ori_prob * log_prob[sup_size:], dim=-1)
+            if confidence_thresh != -1:
+                unsup_mask = (ori_prob.max(dim=-1)[0] > confidence_thresh).type_as(logits)
+            else:
+                unsup_mask = torch.ones_like(unsup_loss)
+            unsup_denom = unsup_mask.sum().clamp(min=1.)
+            unsup = torch.sum(unsup_loss * unsup_mask) / unsup_denom
+            targets = torch.cat((sup_targets, ori_prob), dim=0)
+            weights = torch.cat((weights, unsup_mask / unsup_denom), dim=0)
+        else:
+            unsup_mask = logits.new_zeros(0)
+            unsup = logits.new_zeros(())
+
+        ctx.save_for_backward(log_prob, targets, weights, scale)
+        ctx.sup_size = sup_size
+        ctx.coeff = coeff
+        ctx.mse = mse
+        ctx.mark_non_differentiable(sup_mask, unsup_mask)
+        return sup + coeff * unsup, sup, unsup, sup_mask, unsup_mask
+
+    @staticmethod
+    def backward(ctx, grad_final, grad_sup, grad_unsup, grad_sup_mask, grad_unsup_mask):
+        log_prob, targets, weights, scale = ctx.saved_tensors
+        sup_size = ctx.sup_size
+        # d(row loss)/d(logits) = scale * (softmax * sum(target) - target)
+        grad = torch.exp(log_prob) * targets.sum(dim=-1, keepdim=True) - targets
+        if ctx.mse:     # d mean((p - t) ** 2) / d(logits) = 2 / n_labels * p * (d - sum(p * d)), d = p - t
+            prob = torch.exp(log_prob[sup_size:])
+            d = prob - targets[sup_size:]
+            grad[sup_size:] = 2. / prob.size(-1) * prob * (d - torch.sum(prob * d, dim=-1, keepdim=True))
+        row_grad = weights.clone()
+        row_grad[:sup_size] *= grad_final + grad_sup
+        row_grad[sup_size:] *= grad_final * ctx.coeff + grad_unsup
+        grad = grad * (row_grad.unsqueeze(-1) * scale)
+        return grad, None, None, None, None, None, None, None
+
+
+def uda_objective(logits, sup_targets, ori_prob=None, tsa_thresh=None, confidence_thresh=-1, softmax_temp=1., coeff=1.,
+                  criterion='KL'):
+    """ fused UDA loss over logits = [sup ; aug]
+        sup_targets : label ids or (mixed) label probabilities, ori_prob : KL / MSE target of the aug rows
+        tsa_thresh : None (no TSA) or threshold tensor, softmax_temp <= 0 means 1,
+        criterion : 'KL' (losses.get_loss) or 'MSE' of the probabilities (main.get_loss_ict) """
+    if not sup_targets.is_floating_point():
+        sup_targets = F.one_hot(sup_targets, logits.size(-1)).type_as(logits)
+    if ori_prob is None:
+        ori_prob = logits.new_zeros(0, logits.size(-1))
+    softmax_temp = softmax_temp if softmax_temp > 0 else 1.
+    return UDAObjective.apply(logits, sup_targets, ori_prob.detach(), tsa_thresh, confidence_thresh, softmax_temp, coeff,
+                              criterion == 'MSE')
+
+
+def uda_objective_reference(logits, sup_targets, ori_prob=None, tsa_thresh=None, confidence_thresh=-1, softmax_temp=1., coeff=1.,
+                            criterion='KL'):
+    "the op chain of losses.get_loss / get_uda_mixup_loss / main.get_loss_ict, kept as the reference of uda_objective"
+    sup_size = sup_targets.size(0)
+    if not sup_targets.is_floating_point():
+        sup_targets = F.one_hot(sup_targets, logits.size(-1)).type_as(logits)
+    one = torch.tensor(1.)
+    sup_loss = -torch.sum(F.log_softmax(logits[:sup_size], dim=1) * sup_targets, dim=1)
+    if tsa_thresh is not None:
+        larger_than_threshold = torch.exp(-sup_loss) > tsa_thresh
+        loss_mask = torch.ones(sup_size, dtype=torch.float32) * (1 - larger_than_threshold.type(torch.float32))
+        sup_loss = torch.sum(sup_loss * loss_mask, dim=-1) / torch.max(torch.sum(loss_mask, dim=-1), one)
+    else:
+        sup_loss = torch.mean(sup_loss)
+    if ori_prob is None:
+        return sup_loss, sup_loss, None
+
+    if confidence_thresh != -1:
+        unsup_loss_mask = (torch.max(ori_prob, dim=-1)[0] > confidence_thresh).type(torch.float32)
+    else:
+        unsup_loss_mask = torch.ones(len(ori_prob), dtype=torch.float32)
+    softmax_temp = softmax_temp if softmax_temp > 0 else 1.
+    if criterion == 'MSE':
+        unsup_loss = torch.mean((torch.softmax(logits[sup_size:] / softmax_temp, dim=1) - ori_prob)**2, dim=-1)
+    else:
+        aug_log_prob = F.log_softmax(logits[sup_size:] / softmax_temp, dim=-1)
+        unsup_loss = torch.sum(nn.KLDivLoss(reduction='none')(aug_log_prob, ori_prob), dim=-1)
+    unsup_loss = torch.sum(unsup_loss * unsup_loss_mask, dim=-1) / torch.max(torch.sum(unsup_loss_mask, dim=-1), one)
+    return sup_loss + coeff * unsup_loss, sup_loss, unsup_loss
+
+
+def check(sup_size=16, n_aug=16, n_labels=4, runs=200):
+    "max |fused - reference| of the losses and logits gradients, and time per forward+backward"
+    torch.manual_seed(0)
+    logits = torch.randn(sup_size + n_aug, n_labels) * 3
+    hard = torch.randint(0, n_labels, (sup_size,))
+    l, idx = 0.7, torch.randperm(sup_size)      # get_uda_mixup_loss : mixed labels and mixed ori_prob
+    one_hot = F.one_hot(hard, n_labels).float()
+    ori_prob = F.softmax(torch.randn(n_aug, n_labels) * 2, dim=-1)
+    aug_idx = torch.randperm(n_aug)
+    uda = dict(tsa_thresh=torch.tensor(0.6), confidence_thresh=0.45, softmax_temp=0.85, coeff=1.)
+    cases = {
+        'get_loss': (hard, ori_prob, uda),
+        'get_uda_mixup_loss': (l * one_hot + (1 - l) * one_hot[idx], l * ori_prob + (1 - l) * ori_prob[aug_idx], uda),
+        # main.get_loss_ict : mixed labels, MSE to the mixed ori_prob, no confidence mask or temperature
+        'get_loss_ict': (l * one_hot + (1 - l) * one_hot[idx], l * ori_prob + (1 - l) * ori_prob[aug_idx],
+                         dict(tsa_thresh=torch.tensor(0.6), coeff=0.4, criterion='MSE')),
+    }
+    for name, (targets, target_prob, kwargs) in cases.items():
+        diffs, times = [], {}
+        for fn in (uda_objective_reference, uda_objective):
+            x = logits.clone().requires_grad_()
+            out = fn(x, targets, target_prob, **kwargs)
+            (out[0] + 0.3 * out[1]).backward()
+            diffs.append((torch.stack([o.detach() for o in out[:3]]), x.grad))
+            start = time.time()
+            for _ in range(runs):
+                x.grad = None
+                fn(x, targets, target_prob, **kwargs)[0].backward()
+            times[fn.__name__] = (time.time() - start) / runs * 1e6
+        print('%-20s loss diff %.2e  grad diff %.2e  reference %.0fus  fused %.0fus' % (
+            name, (diffs[0][0] - diffs[1][0]).abs().max(), (diffs[0][1] - diffs[1][1]).abs().max(),
+            times['uda_objective_reference'], times['uda_objective']))
+
+
+if __name__ == '__main__':
+    check()
@@ -35,57 +35,51 @@ def sigmoid_rampup(current, rampup_length):
         return float(np.exp(-5.0 * phase * phase))
 
 
-def simple_pad(input_ids, input_mask, num_tokens):
-    batch_size = input_ids.size(0)
+def _pad_rows(small_ids, big_ids, small_count, big_count):
+    """ rows of small_ids re-aligned to big_ids : tokens before [SEP], 1s up to the [SEP] position
+        of big_ids, then the tail of big_ids (one where over the batch, no host sync) """
+    pos = torch.arange(small_ids.size(1), device=small_ids.device)
+    small_count, big_count = small_count.view(-1, 1), big_count.view(-1, 1)
+    return torch.where(pos < small_count - 1, small_ids,
+                       torch.where(pos < big_count - 1, torch.ones_like(small_ids), big_ids))
 
-    max_count, max_index = num_tokens.max(0)
-    max_count = int(max_count)
-    max_index = int(max_index)
 
-    for i in range(0, batch_size):
-        i_count = int(num_tokens[i])
+def simple_pad(input_ids, input_mask, num_tokens):
+    "pad every sentence (in place) to the [SEP] position of the longest one"
+    num_tokens = num_tokens.to(input_ids.device)
+    max_count, max_index = num_tokens.max(0)
 
-        if i_count < max_count:
-            first = input_ids[i][0:i_count-1]
-            second = torch.tensor([1] * (max_count - i_count)).cuda()
-            third = input_ids[max_index][max_count-1:128]
-            combined = torch.cat((first, second, third), 0)
-            input_ids[i] = combined
-            input_mask[i] = input_mask[max_index]
+    short = (num_tokens < max_count).view(-1, 1)
+    max_ids = input_ids[max_index].expand_as(input_ids)
+    padded = _pad_rows(input_ids, max_ids, num_tokens, max_count.expand_as(num_tokens))
+    input_ids.copy_(torch.where(short, padded, input_ids))
+    input_mask.copy_(torch.where(short, input_mask[max_index].expand_as(input_mask), input_mask))
 
 def pad_for_word_mixup(input_ids, input_mask, num_tokens, idx):
+    """ for each pair (i, idx[i]), pad the shorter sentence to the [SEP] position of the longer one
+        input_ids (and input_mask) are updated in place, returns input_ids and the padded partner copy """
     batch_size = input_ids.size(0)
+    device = input_ids.device
+    idx = idx.to(device)
+    num_tokens = num_tokens.to(device)
+    i_count, j_count = num_tokens, num_tokens[idx]
+    ids_i, ids_j = input_ids, input_ids[idx]
+
+    i_small = (i_count < j_count).view(-1, 1)
+    j_small = (i_count > j_count).view(-1, 1)
     c_input_ids = input_ids.clone()
-
-    for i in range(0, batch_size):
-        j = idx[i]
-        i_count = int(num_tokens[i])
-        j_count = int(num_tokens[j])
-
-        if i_count < j_count:
-            small = i
-            big = j
-            small_count = i_count
-            big_count = j_count
-            small_ids = input_ids
-            big_ids = c_input_ids
-        elif i_count > j_count:
-            small = j
-            big = i
-            small_count = j_count
-            big_count = i_count
-            small_ids = c_input_ids
-            big_ids = input_ids
-
-        if i_count != j_count:
-            first = small_ids[small][0:small_count-1]
-            second = torch.tensor([1] * (big_count - small_count)).cuda()
-            third = big_ids[big][big_count-1:128]
-            combined = torch.cat((first, second, third), 0)
-            small_ids[small] = combined
-            if i_count < j_count:
-                input_mask[i] = input_mask[j]
-
+    c_input_ids[idx] = torch.where(j_small, _pad_rows(ids_j, ids_i, j_count, i_count), ids_j)
+
+    # input_mask[i] takes input_mask[j] (as it is when row i is reached in batch order, i.e. already
+    # updated if j < i) : follow the chain of such copies with pointer jumping
+    rows = torch.arange(batch_size, device=device)
+    follow = i_small.view(-1) & (idx < rows)
+    src = torch.where(i_small.view(-1), idx, rows)    # mask row used when the chain stops here
+    ptr = torch.where(follow, idx, rows)
+    for _ in range(max(batch_size - 1, 1).bit_length()):
+        ptr = ptr[ptr]
+    input_mask.copy_(input_mask[src[ptr]])
+    input_ids.copy_(torch.where(i_small, _pad_rows(ids_i, ids_j, i_count, j_count), ids_i))
 
     return input_ids, c_input_ids
 
@@ -114,8 +108,14 @@ def multi_accuracy(output, target, topk=(1,)):
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
+_DEVICE_ONE = {}
+
 def torch_device_one():
-    return torch.tensor(1.).to(_get_device())
+    "constant 1. on the training device, allocated once"
+    device = _get_device()
+    if device not in _DEVICE_ONE:
+        _DEVICE_ONE[device] = torch.tensor(1.).to(device)
+    return _DEVICE_ONE[device]
 
 def set_seeds(seed):
     "set random seeds"
@@ -272,3 +272,63 @@ class AverageMeter:
 
     def __format__(self, format):
         return "{self.val:{format}} ({self.avg:{format}})".format(self=self, format=format)
+
+
+class DeviceMeterSet(AverageMeterSet):
+    """AverageMeterSet that keeps tensor updates on their device : the running sums are
+    accumulated as tensors and read back together (one sync) when a meter is read"""
+
+    def __init__(self):
+        super().__init__()
+        self.pending = {}   # name -> [sum, last value, count]
+
+    def update(self, name, value, n=1):
+        if not torch.is_tensor(value):
+            return super().update(name, value, n)
+        value = value.detach().double()
+        if name in self.pending:
+            pending = self.pending[name]
+            pending[0] += value * n
+            pending[1] = value
+            pending[2] += n
+        else:
+            self.pending[name] = [value * n, value, n]
+
+    def sync(self):
+        if not self.pending:
+            return
+        names = list(self.pending)
+        values = torch.stack([t for name in names for t in self.pending[name][:2]]).tolist()
+        for i, name in enumerate(names):
+            if not name in self.meters:
+                self.meters[name] = AverageMeter()
+            meter = self.meters[name]
+            meter.sum += values[2 * i]
+            meter.count += self.pending[name][2]
+            meter.avg = meter.sum / meter.count
+            meter.val = values[2 * i + 1]
+        self.pending = {}
+
+    def __getitem__(self, key):
+        self.sync()
+        return super().__getitem__(key)
+
+    def reset(self):
+        self.pending = {}
+        super().reset()
+
+    def values(self, postfix=''):
+        self.sync()
+        return super().values(postfix)
+
+    def averages(self, postfix='/avg'):
+        self.sync()
+        return super().averages(postfix)
+
+    def sums(self, postfix='/sum'):
+        self.sync()
+        return super().sums(postfix)
+
+    def counts(self, postfix='/count'):
+        self.sync()
+        return super().counts(postfix)
@@ -0,0 +1,80 @@
+""" Task-specific vocabulary : the token ids a task's data uses, renumbered into a compact embedding table """
+import json
+from collections import Counter
+
+import torch
+from torch.utils.data import TensorDataset
+
+SPECIAL_TOKENS = ('[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]')
+ID_COLUMNS = {'sup': (0,), 'unsup': (0, 3)}     # input_ids columns of the DataSet splits
+EMBED_KEY = 'embed.tok_embed.weight'
+
+
+class VocabMap(object):
+    """ old_ids[new_id] = id in the full vocab. ids outside the task vocab map to the new [UNK] id """
+    def __init__(self, old_ids, full_size, unk_id):
+        self.old_ids = list(old_ids)
+        self.full_size = full_size
+        self.unk_id = unk_id        # id of [UNK] in the full vocab
+        self.lookup = torch.full((full_size,), self.old_ids.index(unk_id), dtype=torch.long)
+        self.lookup[torch.tensor(self.old_ids)] = torch.arange(len(self.old_ids))
+        self.table = self.lookup.tolist()
+
+    def __len__(self):
+        return len(self.old_ids)
+
+    def map_ids(self, ids):
+        return [self.table[i] for i in ids]
+
+    def map_tensor(self, ids):
+        return self.lookup.to(ids.device)[ids]
+
+    def save(self, file):
+        with open(file, 'w') as f:
+            json.dump({'full_size': self.full_size, 'unk_id': self.unk_id, 'old_ids': self.old_ids}, f)
+
+    @classmethod
+    def load(cls, file):
+        with open(file) as f:
+            d = json.load(f)
+        return cls(d['old_ids'], d['full_size'], d['unk_id'])
+
+
+def count_ids(datasets):
+    "Counter of the token ids in the input_ids columns of (train, val, unsup)"
+    counts = Counter()
+    for dataset, split in zip(datasets, ('sup', 'sup', 'unsup')):
+        if dataset:
+            for c in ID_COLUMNS[split]:
+                ids, n = dataset.tensors[c].unique(return_counts=True)
+                counts.update(dict(zip(ids.tolist(), n.tolist())))
+    return counts
+
+
+def build(counts, vocab, min_count=1):
+    "VocabMap of the special tokens and the ids seen at least min_count times, in full vocab order"
+    special = {vocab[t] for t in SPECIAL_TOKENS if t in vocab}
+    kept = sorted(special | {i for i, n in counts.items() if n >= min_count})
+    return VocabMap(kept, len(vocab), vocab['[UNK]'])
+
+
+def remap_datasets(datasets, vocab_map):
+    "(train, val, unsup) with the input_ids columns renumbered to the task vocab"
+    remapped = []
+    for dataset, split in zip(datasets, ('sup', 'sup', 'unsup')):
+        if dataset:
+            tensors = list(dataset.tensors)
+            for c in ID_COLUMNS[split]:
+                tensors[c] = vocab_map.map_tensor(tensors[c])
+            dataset = TensorDataset(*tensors)
+        remapped.append(dataset)
+    return tuple(remapped)
+
+
+def prune_state_dict(state_dict, vocab_map, prefix=''):
+    "copy of state_dict with the rows of the token embedding (prefix + EMBED_KEY) sliced to the task vocab"
+    state_dict = dict(state_dict)
+    weight = state_dict[prefix + EMBED_KEY]
+    assert weight.size(0) == vocab_map.full_size, 'the embedding table is not the full vocab %d' % weight.size(0)
+    state_dict[prefix + EMBED_KEY] = weight[torch.tensor(vocab_map.old_ids)].clone()
+    return state_dict